@@ -1,10 +1,13 @@
 import theano
 import numpy as np
+import os
 import pickle
 import theano.tensor as T
+from collections import OrderedDict
 from os.path import join as pjoin
 
 from dipy.tracking.streamline import set_number_of_points
+from numpy.lib.stride_tricks import as_strided
 
 from smartlearner.interfaces import BatchScheduler
 from smartlearner.utils import sharedX
@@ -12,12 +15,27 @@ from smartlearner.utils import sharedX
 floatX = theano.config.floatX
 
 
+def _stack_sequences(data, offsets, length):
+    """ Gathers the `length` rows of `data` following each offset in an array of shape (len(offsets), length, data.shape[1]). """
+    return data[offsets[:, None] + np.arange(length)]
+
+
+def _sliding_windows(x, width):
+    """ Read-only view of the `width` consecutive elements starting at every position along the second axis of `x`.
+
+    The result has shape (x.shape[0], x.shape[1] - width + 1, width) + x.shape[2:] but no data is copied.
+    """
+    shape = (x.shape[0], x.shape[1] - width + 1, width) + x.shape[2:]
+    strides = (x.strides[0], x.strides[1], x.strides[1]) + x.strides[2:]
+    return as_strided(x, shape=shape, strides=strides, writeable=False)
+
+
 class TractographyBatchScheduler(BatchScheduler):
     """ Batch scheduler for streamlines coming from multiple subjects. """
 
     def __init__(self, dataset, batch_size, noisy_streamlines_sigma=None, seed=1234, use_data_augment=True, normalize_target=False,
                  shuffle_streamlines=True, resample_streamlines=True, feed_previous_direction=False, sort_streamlines_by_length=False,
-                 learn_to_stop=False):
+                 learn_to_stop=False, features=None):
         """
         Parameters
         ----------
@@ -42,7 +60,15 @@ class TractographyBatchScheduler(BatchScheduler):
             Streamlines will be approximatively regrouped according to their length.
         learn_to_stop : bool
             Predict whether the streamline being generated should stop or not
+        features : ndarray of shape (nb_points, n_features), optional
+            Diffusion data precomputed at every point of the streamlines (see `datasets.compute_streamlines_features`).
+            If specified, inputs are these features instead of the streamlines coordinates (and DWI ID), so the model
+            doesn't have to interpolate the volumes. Streamlines can then neither be resampled nor noisy.
         """
+        if features is not None and (resample_streamlines or noisy_streamlines_sigma is not None):
+            raise ValueError("Precomputed features can only be used if streamlines are neither resampled nor noisy.")
+
+        self.features = features
         self.dataset = dataset
         self.batch_size = batch_size
         self.use_augment_by_flipping = use_data_augment
@@ -92,7 +118,7 @@ class TractographyBatchScheduler(BatchScheduler):
 
     @property
     def nb_updates_per_epoch(self):
-        return int(np.ceil(len(self.dataset) / self.batch_size))
+        return int(np.ceil(len(self.indices) / self.batch_size))
 
     @property
     def batch_size(self):
@@ -134,6 +160,12 @@ class TractographyBatchScheduler(BatchScheduler):
         if self.use_augment_by_flipping:
             batch_size *= 2
 
+        # Inputs are either the streamlines coordinates or the features precomputed at each of their points.
+        input_offsets = streamlines._offsets
+        if self.features is not None:
+            inputs = self.features
+            input_offsets = self.dataset.streamlines._offsets[np.asarray(indices)]
+
         max_streamline_length = np.max(streamlines._lengths)  # Sequences are padded so that they have the same length.
         batch_masks = np.zeros((batch_size, max_streamline_length-1), dtype=floatX)
         batch_inputs = np.zeros((batch_size, max_streamline_length-1, inputs.shape[1]), dtype=floatX)
@@ -141,14 +173,14 @@ class TractographyBatchScheduler(BatchScheduler):
         if self.learn_to_stop:
             batch_stopping = np.zeros((batch_size, max_streamline_length-1))
 
-        for i, (offset, length, volume_id) in enumerate(zip(streamlines._offsets, streamlines._lengths, volume_ids)):
+        for i, (offset, input_offset, length) in enumerate(zip(streamlines._offsets, input_offsets, streamlines._lengths)):
             batch_masks[i, :length-1] = 1
-            batch_inputs[i, :length-1] = inputs[offset:offset+length-1]  # [0, 1, 2, 3, 4] => [0, 1, 2, 3]
+            batch_inputs[i, :length-1] = inputs[input_offset:input_offset+length-1]  # [0, 1, 2, 3, 4] => [0, 1, 2, 3]
             batch_targets[i, :length-1] = targets[offset:offset+length-1]  # [1-0, 2-1, 3-2, 4-3] => [1-0, 2-1, 3-2, 4-3]
 
             if self.use_augment_by_flipping:
                 batch_masks[i+len(streamlines), :length-1] = 1
-                batch_inputs[i+len(streamlines), :length-1] = inputs[offset+1:offset+length][::-1]  # [0, 1, 2, 3, 4] => [4, 3, 2, 1]
+                batch_inputs[i+len(streamlines), :length-1] = inputs[input_offset+1:input_offset+length][::-1]  # [0, 1, 2, 3, 4] => [4, 3, 2, 1]
                 batch_targets[i+len(streamlines), :length-1] = -targets[offset:offset+length-1][::-1]  # [1-0, 2-1, 3-2, 4-3] => [4-3, 3-2, 2-1, 1-0]
 
             if self.learn_to_stop:
@@ -157,8 +189,9 @@ class TractographyBatchScheduler(BatchScheduler):
                 batch_stopping[i, :length-1] = np.linspace(1., 0.5, num=length-1)
                 batch_stopping[i+len(streamlines), :length - 1] = np.linspace(1., 0.5, num=length - 1)
 
-        batch_volume_ids = np.tile(volume_ids[:, None, None], (1 + self.use_augment_by_flipping, max_streamline_length-1, 1))
-        batch_inputs = np.concatenate([batch_inputs, batch_volume_ids], axis=2)  # Streamlines coords + dwi ID
+        if self.features is None:
+            batch_volume_ids = np.tile(volume_ids[:, None, None], (1 + self.use_augment_by_flipping, max_streamline_length-1, 1))
+            batch_inputs = np.concatenate([batch_inputs, batch_volume_ids], axis=2)  # Streamlines coords + dwi ID
 
         if self.feed_previous_direction:
             previous_directions = np.concatenate([np.zeros((batch_size, 1, 3), dtype=floatX), batch_targets[:, :-1]], axis=1)
@@ -182,7 +215,7 @@ class TractographyBatchScheduler(BatchScheduler):
                 self.dataset.symb_targets: self._shared_batch_targets,
                 self.dataset.symb_mask: self._shared_batch_mask}
 
-    def __iter__(self):
+    def _shuffle_indices(self):
         if self.shuffle_streamlines:
             self.rng.shuffle(self.indices)
 
@@ -192,6 +225,9 @@ class TractographyBatchScheduler(BatchScheduler):
             intervals = range(step, len(lengths), step)
             self.indices = np.argpartition(lengths, intervals)
 
+    def __iter__(self):
+        self._shuffle_indices()
+
         for batch_count in range(self.nb_updates_per_epoch):
             batch_inputs, batch_targets, batch_mask = self._next_batch(batch_count)
             self._shared_batch_inputs.set_value(batch_inputs)
@@ -260,6 +296,193 @@ class TractographyBatchScheduler(BatchScheduler):
         self.set_state(state)
 
 
+class TBPTTBatchScheduler(TractographyBatchScheduler):
+    """ Batch scheduler for truncated backpropagation through time (TBPTT).
+
+    Each batch of streamlines is split into windows of `window_size` steps given one after the other.
+    The model's hidden states at the end of a window are used as initial states for the next one
+    (see `set_model_states`) and are reset to zeros when a new batch of streamlines starts.
+    Gradients only flow within a window, so memory no longer grows with the length of the streamlines.
+
+    Without `resample_streamlines`, streamlines of a batch are padded to the length of the longest one.
+    They are then sorted by decreasing length so that the streamlines still going on in a window are
+    the first rows of the batch: the other ones are left out of the window (and out of the loss,
+    which would otherwise be divided by an empty mask) and their hidden states are dropped.
+    """
+
+    def __init__(self, dataset, batch_size, window_size, **kwargs):
+        """
+        Parameters
+        ----------
+        dataset : :class:`TractographyDataset`
+            Dataset from which to get the examples.
+        batch_size : int
+            Nb. of streamlines per batch.
+        window_size : int
+            Nb. of steps per window.
+        kwargs : dict
+            See :class:`TractographyBatchScheduler`.
+        """
+        self.window_size = window_size
+        self.init_states = []
+        self.final_states = []
+        super().__init__(dataset, batch_size, **kwargs)
+
+    def set_model_states(self, init_states, final_states):
+        """ Carries `final_states` over to `init_states` after each window (see `GRU.enable_truncated_bptt`). """
+        self.init_states = init_states
+        self.final_states = final_states
+
+    @property
+    def nb_batches_per_epoch(self):
+        return int(np.ceil(len(self.indices) / self.batch_size))
+
+    def _nb_windows(self, indices):
+        if self.resample_streamlines:
+            # Streamlines are resampled to the length of the shortest one in the batch.
+            nb_steps = np.min(self.dataset.streamlines._lengths[indices]) - 1
+        else:
+            # Streamlines are padded to the length of the longest one in the batch.
+            nb_steps = np.max(self.dataset.streamlines._lengths[indices]) - 1
+
+        return int(np.ceil(nb_steps / self.window_size))
+
+    @property
+    def nb_updates_per_epoch(self):
+        # Depends on how streamlines are grouped in batches, i.e. it may vary a little between epochs when shuffling.
+        return sum(self._nb_windows(self.indices[batch_count*self.batch_size:(batch_count+1)*self.batch_size])
+                   for batch_count in range(self.nb_batches_per_epoch))
+
+    def _reset_model_states(self, batch_size):
+        for init_state in self.init_states:
+            hidden_size = init_state.get_value(borrow=True).shape[1]
+            init_state.set_value(np.zeros((batch_size, hidden_size), dtype=floatX))
+
+    def _keep_model_states(self, nb_streamlines):
+        # Hidden states of the streamlines that ended in the previous window are dropped.
+        for init_state in self.init_states:
+            init_state.set_value(init_state.get_value()[:nb_streamlines])
+
+    def __iter__(self):
+        self._shuffle_indices()
+
+        update_count = 0
+        for batch_count in range(self.nb_batches_per_epoch):
+            batch_inputs, batch_targets, batch_mask = self._next_batch(batch_count)
+
+            # Sort streamlines by decreasing length, so the ones still going on in a window come first.
+            nb_steps = batch_mask.sum(axis=1).astype(int)
+            order = np.argsort(-nb_steps, kind="mergesort")
+            batch_inputs, batch_targets, batch_mask, nb_steps = batch_inputs[order], batch_targets[order], batch_mask[order], nb_steps[order]
+            self._reset_model_states(len(batch_inputs))
+
+            for start in range(0, batch_inputs.shape[1], self.window_size):
+                end = start + self.window_size
+                nb_streamlines = np.sum(nb_steps > start)  # Leave out streamlines entirely masked in this window.
+                if nb_streamlines < len(batch_inputs):
+                    self._keep_model_states(nb_streamlines)
+
+                self._shared_batch_inputs.set_value(batch_inputs[:nb_streamlines, start:end])
+                self._shared_batch_targets.set_value(batch_targets[:nb_streamlines, start:end])
+                self._shared_batch_mask.set_value(batch_mask[:nb_streamlines, start:end])
+
+                update_count += 1
+                yield update_count
+
+    @property
+    def updates(self):
+        return OrderedDict(zip(self.init_states, self.final_states))
+
+    def get_state(self):
+        state = super().get_state()
+        state["window_size"] = self.window_size
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.window_size = int(state["window_size"])
+
+
+class CachedBatchScheduler(BatchScheduler):
+    """ Replays the batches of a deterministic batch scheduler (e.g. for validation).
+
+    Batches are built once, the first time they are needed, then simply given back at every epoch.
+    They are kept in memory or, if `cache_dir` is specified, memory-mapped from .npy files.
+
+    Notes
+    -----
+    The arrays returned by `batch_scheduler._next_batch` must be in the same order as `batch_scheduler.givens`.
+    """
+
+    def __init__(self, batch_scheduler, cache_dir=None):
+        """
+        Parameters
+        ----------
+        batch_scheduler : :class:`BatchScheduler` object
+            Batch scheduler that doesn't shuffle nor add noise to the streamlines.
+        cache_dir : str, optional
+            Folder where to write the batches. Default: keep them in memory.
+        """
+        self.batch_scheduler = batch_scheduler
+        self.cache_dir = cache_dir
+        self._batches = None
+
+    @property
+    def input_size(self):
+        return self.batch_scheduler.input_size
+
+    @property
+    def target_size(self):
+        return self.batch_scheduler.target_size
+
+    @property
+    def nb_updates_per_epoch(self):
+        return self.batch_scheduler.nb_updates_per_epoch
+
+    def _build_cache(self):
+        if self.cache_dir is not None and not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        batches = []
+        for batch_count in range(self.nb_updates_per_epoch):
+            arrays = self.batch_scheduler._next_batch(batch_count)
+            if self.cache_dir is not None:
+                filenames = [pjoin(self.cache_dir, "batch{:06d}_{}.npy".format(batch_count, i)) for i in range(len(arrays))]
+                for filename, array in zip(filenames, arrays):
+                    np.save(filename, array)
+
+                arrays = [np.load(filename, mmap_mode='r') for filename in filenames]
+
+            batches.append(arrays)
+
+        return batches
+
+    @property
+    def givens(self):
+        return self.batch_scheduler.givens
+
+    def __iter__(self):
+        if self._batches is None:
+            self._batches = self._build_cache()
+
+        shared_variables = list(self.givens.values())
+        for batch_count, arrays in enumerate(self._batches):
+            for shared_variable, array in zip(shared_variables, arrays):
+                shared_variable.set_value(np.asarray(array))
+
+            yield batch_count + 1
+
+    @property
+    def updates(self):
+        return self.batch_scheduler.updates
+
+    def save(self, savedir):
+        pass  # Batches are rebuilt when needed.
+
+    def load(self, loaddir):
+        pass
+
+
 class TractographyBatchSchedulerWithProportionalSamplingFromBundles(BatchScheduler):
     """ TODO
 
@@ -441,16 +664,33 @@ class MultistepSequenceBatchScheduler(TractographyBatchSchedulerWithProportional
         batch_inputs = np.zeros((batch_size, max_streamline_length - self.k, inputs.shape[1]), dtype=floatX)
         batch_targets = np.zeros((batch_size, max_streamline_length - 1, self.target_size), dtype=floatX)
 
-        for i, (offset, length) in enumerate(zip(streamlines._offsets, streamlines._lengths)):
-            n = length - self.k
-            batch_masks[i, :n] = 1
-            batch_inputs[i, :n] = inputs[offset:offset + n]
-            batch_targets[i, :length - 1] = targets[offset:offset + length - 1]
+        if self.resample_streamlines:
+            # All streamlines have the same number of points, so they are processed all at once.
+            # The K targets of each input are taken (sliding window style) from `batch_targets` by the loss.
+            nb_streamlines = len(streamlines)
+            n = max_streamline_length - self.k
+            points = _stack_sequences(inputs, streamlines._offsets, max_streamline_length)
+            directions = _stack_sequences(targets, streamlines._offsets, max_streamline_length - 1)
+
+            batch_masks[:] = 1
+            batch_inputs[:nb_streamlines] = points[:, :n]
+            batch_targets[:nb_streamlines] = directions
 
             if self.use_augment_by_flipping:
-                batch_masks[i + len(streamlines), :n] = 1
-                batch_inputs[i + len(streamlines), :n] = inputs[offset + self.k:offset + length][::-1]
-                batch_targets[i + len(streamlines), :length - 1] = -targets[offset:offset + length - 1][::-1]
+                batch_inputs[nb_streamlines:] = points[:, self.k:][:, ::-1]
+                batch_targets[nb_streamlines:] = -directions[:, ::-1]
+
+        else:
+            for i, (offset, length) in enumerate(zip(streamlines._offsets, streamlines._lengths)):
+                n = length - self.k
+                batch_masks[i, :n] = 1
+                batch_inputs[i, :n] = inputs[offset:offset + n]
+                batch_targets[i, :length - 1] = targets[offset:offset + length - 1]
+
+                if self.use_augment_by_flipping:
+                    batch_masks[i + len(streamlines), :n] = 1
+                    batch_inputs[i + len(streamlines), :n] = inputs[offset + self.k:offset + length][::-1]
+                    batch_targets[i + len(streamlines), :length - 1] = -targets[offset:offset + length - 1][::-1]
 
         batch_volume_ids = np.tile(volume_ids[:, None, None], (1 + self.use_augment_by_flipping, max_streamline_length - self.k, 1))
         batch_inputs = np.concatenate([batch_inputs, batch_volume_ids], axis=2)  # Streamlines coords + dwi ID
@@ -575,34 +815,31 @@ class MultistepSequenceBatchSchedulerWithoutMask(BatchScheduler):
         streamline_length = np.min(streamlines._lengths)  # Sequences are resampled so that they have the same length.
         streamlines._lengths = streamlines._lengths.astype("int64")
         streamlines = set_number_of_points(streamlines, nb_points=streamline_length)
-        inputs = streamlines._data  # Streamlines coordinates
-        targets = streamlines._data[1:] - streamlines._data[:-1]  # Unnormalized directions
-
-        batch_size = len(streamlines)
-        if self.use_augment_by_flipping:
-            batch_size *= 2
 
         if self.include_last_point:  # only for the input
             raise NotImplementedError()
 
         else:
-            batch_inputs = np.zeros((batch_size, streamline_length - self.k, inputs.shape[1]), dtype=floatX)
-            batch_targets = np.zeros((batch_size, streamline_length - self.k, self.k, self.target_size), dtype=floatX)
+            # All streamlines have the same number of points, so they are processed all at once.
+            # points.shape : (batch_size, streamline_length, 3)
+            points = _stack_sequences(streamlines._data, streamlines._offsets, streamline_length)
+            directions = points[:, 1:] - points[:, :-1]  # Unnormalized directions
 
-            for i, (offset, length) in enumerate(zip(streamlines._offsets, streamlines._lengths)):
-                n = length - self.k
-                batch_inputs[i, :n] = inputs[offset:offset + n]
-                batch_targets[i, :n] = self._window_stack(targets[offset:offset + length - 1, None], self.k)
+            if self.use_augment_by_flipping:
+                points = np.concatenate([points, points[:, ::-1]], axis=0)  # [0, 1, 2, 3, 4] => [4, 3, 2, 1, 0]
+                directions = np.concatenate([directions, -directions[:, ::-1]], axis=0)  # [1-0, ..., 4-3] => [3-4, ..., 0-1]
 
-                if self.use_augment_by_flipping:
-                    batch_inputs[i + len(streamlines), :n] = inputs[offset + self.k:offset + length][::-1]
-                    batch_targets[i + len(streamlines), :n] = self._window_stack(-targets[offset:offset + length - 1, None][::-1], self.k)
+            batch_inputs = points[:, :streamline_length - self.k].astype(floatX)
+
+            # K targets for each input (sliding window style), viewed from a single buffer of directions.
+            # batch_targets.shape : (batch_size, streamline_length - k, k, 3)
+            batch_targets = self._window_stack(directions.astype(floatX, copy=False), self.k)
 
         return batch_inputs, batch_targets
 
     @staticmethod
     def _window_stack(x, width):
-        return np.hstack(x[i:1 + i - width or None] for i in range(width))
+        return _sliding_windows(x, width)
 
     def _next_batch(self, batch_count):
         if not self.use_sample_from_bundle:
@@ -745,7 +982,7 @@ class SingleInputTractographyBatchScheduler(BatchScheduler):
 
     @property
     def nb_updates_per_epoch(self):
-        return int(np.ceil(len(self.dataset) / self.batch_size))
+        return int(np.ceil(len(self.indices) / self.batch_size))
 
     @property
     def batch_size(self):
@@ -954,7 +1191,7 @@ class MaskClassifierBatchScheduler(BatchScheduler):
 
     @property
     def nb_updates_per_epoch(self):
-        return int(np.ceil(len(self.dataset) / self.batch_size))
+        return int(np.ceil(len(self.indices) / self.batch_size))
 
     @property
     def batch_size(self):
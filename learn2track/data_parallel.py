@@ -0,0 +1,225 @@
+import atexit
+import multiprocessing
+import numpy as np
+import theano
+import theano.tensor as T
+from collections import OrderedDict
+from threading import BrokenBarrierError
+
+from smartlearner.interfaces import Loss, BatchScheduler
+from smartlearner.utils import sharedX
+
+floatX = theano.config.floatX
+
+STOP = -1
+
+
+class DataParallelLoss(Loss):
+    """ Loss whose value and gradients are the ones averaged over the workers of a :class:`DataParallel`.
+
+    Its value is the (shared) averaged loss and its gradient w.r.t. each parameter is the (shared) averaged
+    gradient. The optimizer is thus used as usual, but the model is never evaluated by the training function.
+    """
+    def __init__(self, model, dataset):
+        super().__init__(model, dataset)
+        self.shared_loss = sharedX(np.array(0.), name="averaged_loss")
+        self.shared_gradients = OrderedDict((param, sharedX(np.zeros_like(param.get_value()), name="averaged_grad_" + str(param.name)))
+                                            for param in model.parameters)
+
+    def _get_updates(self):
+        return {}  # There is no updates for DataParallelLoss.
+
+    def _compute_losses(self, model_output):
+        surrogate = sum(T.sum(param * gradient) for param, gradient in self.shared_gradients.items())
+        return T.shape_padleft(self.shared_loss + surrogate - theano.gradient.zero_grad(surrogate))
+
+
+class DataParallelBatchScheduler(BatchScheduler):
+    """ Splits every batch of a :class:`TractographyBatchScheduler` among the workers of a :class:`DataParallel`.
+
+    The wrapped batch scheduler only picks the streamlines of each batch, the workers build their own shard
+    and compute its gradients. The averaged gradients are ready when an update is yielded.
+    Its state is the one of the wrapped batch scheduler, it is saved under the same name.
+    """
+    def __init__(self, batch_scheduler, data_parallel):
+        self.batch_scheduler = batch_scheduler
+        self.data_parallel = data_parallel
+
+    @property
+    def input_size(self):
+        return self.batch_scheduler.input_size
+
+    @property
+    def target_size(self):
+        return self.batch_scheduler.target_size
+
+    @property
+    def nb_updates_per_epoch(self):
+        return self.batch_scheduler.nb_updates_per_epoch
+
+    @property
+    def givens(self):
+        return self.batch_scheduler.givens
+
+    @property
+    def updates(self):
+        return self.batch_scheduler.updates
+
+    def __iter__(self):
+        self.batch_scheduler._shuffle_indices()
+
+        batch_size = self.batch_scheduler.batch_size
+        for batch_count in range(self.nb_updates_per_epoch):
+            indices = self.batch_scheduler.indices[batch_count * batch_size:(batch_count + 1) * batch_size]
+            # Drawn from the wrapped batch scheduler, so noise is reproducible when resuming.
+            seed = self.batch_scheduler.rng_noise.randint(2**31)
+            self.data_parallel.compute_gradients(indices, seed)
+            yield batch_count + 1
+
+    def save(self, savedir):
+        self.batch_scheduler.save(savedir)
+
+    def load(self, loaddir):
+        self.batch_scheduler.load(loaddir)
+
+
+class DataParallel(object):
+    """ Synchronous data-parallel training on CPU.
+
+    `nb_workers` processes are forked, each one holding a replica of the model and computing the
+    gradients of its shard of every batch. Gradients are averaged through shared memory and given to
+    the optimizer by a :class:`DataParallelLoss`, so that a single update is done by the main process.
+    The updated parameters are copied back to the workers before the next batch.
+
+    Parameters
+    ----------
+    model : :class:`Model` object
+        Model to train. It must be initialized and no Theano function should have been compiled yet.
+    loss_factory : callable
+        Builds the loss of a replica of the model, i.e. `loss_factory(model)`.
+    batch_scheduler : :class:`TractographyBatchScheduler` object
+        Training batch scheduler, without truncated BPTT.
+    nb_workers : int
+        Number of worker processes.
+    seed : int, optional
+        Seed of the dropout/zoneout masks of the workers (offset by their rank).
+
+    Notes
+    -----
+    Workers are forked, so loaded datasets and volumes are shared (copy-on-write). Each worker uses its own
+    BLAS threads, setting e.g. `OMP_NUM_THREADS` to the number of cores divided by `nb_workers` is advised.
+    Results depend on `nb_workers` since streamlines are resampled per shard and the noise added to
+    them is seeded per rank. The number of workers is thus part of the hyperparameters of an experiment.
+    """
+    def __init__(self, model, loss_factory, batch_scheduler, nb_workers, seed=1234):
+        self.model = model
+        self.nb_workers = nb_workers
+        self.params = list(model.parameters)
+        self.shapes = [param.get_value().shape for param in self.params]
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+        nb_params = sum(self.sizes)
+
+        ctx = multiprocessing.get_context("fork")
+        ctype = np.ctypeslib.as_ctypes_type(np.dtype(floatX))
+        self._params = np.frombuffer(ctx.RawArray(ctype, nb_params), dtype=floatX)
+        self._gradients = np.frombuffer(ctx.RawArray(ctype, nb_workers * nb_params), dtype=floatX).reshape((nb_workers, nb_params))
+        self._losses = np.frombuffer(ctx.RawArray('d', nb_workers * 2), dtype=np.float64).reshape((nb_workers, 2))
+        self._indices = np.frombuffer(ctx.RawArray('q', batch_scheduler.batch_size), dtype=np.int64)
+        self._header = np.frombuffer(ctx.RawArray('q', 2), dtype=np.int64)  # Nb. of indices (or STOP), seed.
+        self._start = ctx.Barrier(nb_workers + 1)
+        self._done = ctx.Barrier(nb_workers + 1)
+
+        self.workers = [ctx.Process(target=self._worker, args=(rank, loss_factory, batch_scheduler, seed), daemon=True)
+                        for rank in range(nb_workers)]
+        for worker in self.workers:
+            worker.start()
+
+        self.loss = DataParallelLoss(model, batch_scheduler.dataset)
+        self.batch_scheduler = DataParallelBatchScheduler(batch_scheduler, self)
+        atexit.register(self.close)
+
+    def _split(self, flat):
+        return [flat[start:start + size] for start, size in zip(np.cumsum([0] + self.sizes[:-1]), self.sizes)]
+
+    def _worker(self, rank, loss_factory, batch_scheduler, seed):
+        try:
+            loss = loss_factory(self.model)
+            if hasattr(self.model, "srng"):
+                self.model.srng.seed(seed + rank)
+
+            gradients = T.grad(loss.loss, self.params)
+            compute_gradients = theano.function([],
+                                                [loss.loss] + gradients,
+                                                givens=batch_scheduler.givens,
+                                                updates=self.model.updates,
+                                                name="compute_gradients")
+
+            shared_variables = list(batch_scheduler.givens.values())
+            while True:
+                self._start.wait()
+                nb_indices, batch_seed = self._header
+                if nb_indices == STOP:
+                    break
+
+                for param, shape, value in zip(self.params, self.shapes, self._split(self._params)):
+                    param.set_value(value.reshape(shape))
+
+                indices = self._indices[:nb_indices][rank::self.nb_workers].copy()
+                if len(indices) == 0:
+                    self._gradients[rank] = 0
+                    self._losses[rank] = 0
+                else:
+                    batch_scheduler.rng_noise = np.random.RandomState(batch_seed + rank)
+                    arrays = batch_scheduler._prepare_batch(indices)
+                    for shared_variable, array in zip(shared_variables, arrays):
+                        shared_variable.set_value(array)
+
+                    # Gradients and loss are weighted by the number of sequences in the shard.
+                    nb_sequences = len(arrays[0])
+                    outputs = compute_gradients()
+                    self._losses[rank] = float(outputs[0]) * nb_sequences, nb_sequences
+                    for gradient, value in zip(self._split(self._gradients[rank]), outputs[1:]):
+                        gradient[:] = np.asarray(value).ravel() * nb_sequences
+
+                self._done.wait()
+
+        except BrokenBarrierError:
+            pass  # Another process failed.
+        except Exception:
+            self._start.abort()
+            self._done.abort()
+            raise
+
+    def compute_gradients(self, indices, seed):
+        """ Computes the gradients averaged over all shards of a batch and stores them in `self.loss`. """
+        for param, value in zip(self.params, self._split(self._params)):
+            value[:] = param.get_value().ravel()
+
+        self._indices[:len(indices)] = indices
+        self._header[:] = len(indices), seed
+
+        try:
+            self._start.wait()
+            self._done.wait()
+        except BrokenBarrierError:
+            raise RuntimeError("A data-parallel worker failed, see its traceback above.")
+
+        nb_sequences = self._losses[:, 1].sum()
+        self.loss.shared_loss.set_value(np.array(self._losses[:, 0].sum() / nb_sequences, dtype=floatX))
+        gradients = self._gradients.sum(axis=0) / nb_sequences
+        for (param, shared_gradient), shape, value in zip(self.loss.shared_gradients.items(), self.shapes, self._split(gradients)):
+            shared_gradient.set_value(value.reshape(shape).astype(floatX))
+
+    def close(self):
+        """ Stops the workers. """
+        if not any(worker.is_alive() for worker in self.workers):
+            return
+
+        self._header[0] = STOP
+        try:
+            self._start.wait(timeout=60)
+        except BrokenBarrierError:
+            pass
+
+        for worker in self.workers:
+            worker.join(timeout=60)
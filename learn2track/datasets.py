@@ -1,7 +1,9 @@
 from __future__ import division
 
+import os
 import re
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
 import theano
 import theano.tensor as T
@@ -199,27 +201,183 @@ class TractographyDataset(MaskedSequenceDataset):
         return self.streamlines[idx], self.streamline_id_to_volume_id[idx]
 
 
-def load_tractography_dataset(subject_files, volume_manager, name="HCP", use_sh_coeffs=False, mean_centering=True):
+def get_stratified_subsample_indices(dataset, proportion):
+    """ Selects a fixed subset of the streamlines of a dataset, stratified by subject and by length.
+
+    For every subject, streamlines are sorted by length and `proportion` of them are taken at
+    evenly spaced ranks, so the subsample covers the same range of lengths as the whole dataset.
+
+    Parameters
+    ----------
+    dataset : :class:`TractographyDataset` object
+        Dataset from which to select the streamlines.
+    proportion : float
+        Proportion of the streamlines of each subject to keep, between 0 and 1.
+
+    Returns
+    -------
+    indices : ndarray
+        Indices of the selected streamlines, sorted by length.
+    """
+    lengths = dataset.streamlines._lengths
+    indices = []
+    for nb_streamlines, start in zip(dataset.nb_streamlines_per_sujet, dataset.streamlines_per_sujet_offsets):
+        if nb_streamlines == 0:
+            continue
+
+        subject_indices = start + np.argsort(lengths[start:start + nb_streamlines], kind="mergesort")
+        nb_selected = max(1, int(np.ceil(proportion * nb_streamlines)))
+        ranks = np.round(np.linspace(0, nb_streamlines - 1, num=nb_selected)).astype(int)
+        indices.append(subject_indices[np.unique(ranks)])
+
+    indices = np.concatenate(indices)
+    return indices[np.argsort(lengths[indices], kind="mergesort")]
+
+
+def compute_streamlines_features(dataset, volume_manager, neighborhood_directions=None, dtype=np.float32, filename=None, chunk_size=100000):
+    """ Evaluates the diffusion data at every point of the streamlines of a dataset.
+
+    Features are aligned with `dataset.streamlines._data`, i.e. the features of the i-th
+    streamline are `features[offsets[i]:offsets[i] + lengths[i]]`. Since they only depend on
+    the position of each point, the same features serve streamlines fed forward or flipped.
+
+    Parameters
+    ----------
+    dataset : :class:`TractographyDataset` object
+        Dataset containing the streamlines (in voxel space).
+    volume_manager : :class:`VolumeManager` object
+        Volume manager where the volume of each subject of `dataset` has been registered.
+    neighborhood_directions : ndarray of shape (n_directions, 3), optional
+        If specified, the data at each of these offsets are concatenated (see `get_neighborhood_directions`).
+    dtype : str or dtype, optional
+        Type used to store the features, e.g. float16 to halve their size. Default: float32.
+    filename : str, optional
+        If specified, features are written in this .npy file (memory-mapped) instead of in memory.
+    chunk_size : int, optional
+        Number of points evaluated at the same time. Default: 100000.
+
+    Returns
+    -------
+    features : ndarray or memmap with shape (len(dataset.streamlines._data), n_features)
+    """
+    streamlines = dataset.streamlines
+    directions = np.zeros((1, 3)) if neighborhood_directions is None else np.asarray(neighborhood_directions)
+    nb_features = volume_manager.volumes[0].get_value(borrow=True).shape[-1] * len(directions)
+    shape = (len(streamlines._data), nb_features)
+
+    if filename is None:
+        features = np.zeros(shape, dtype=dtype)
+    else:
+        features = np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=shape)
+
+    for subject, start in zip(dataset.subjects, dataset.streamlines_per_sujet_offsets):
+        if len(subject.streamlines) == 0:
+            continue
+
+        # Streamlines of a same subject are contiguous in the dataset.
+        end = start + len(subject.streamlines) - 1
+        first_point = streamlines._offsets[start]
+        last_point = streamlines._offsets[end] + streamlines._lengths[end]
+
+        volume = volume_manager.volumes[subject.subject_id].get_value(borrow=True)
+        index = volume_manager.indices[subject.subject_id]
+        index = None if index is None else index.get_value(borrow=True)
+        for chunk_start in range(first_point, last_point, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, last_point)
+            coords = streamlines._data[chunk_start:chunk_end]
+            values = [eval_volume_at_3d_coordinates(volume, coords + direction, index=index, brick_size=volume_manager.brick_size,
+                                                    shape=volume_manager.volumes_shapes[subject.subject_id])
+                      for direction in directions]
+            if volume_manager.scales[subject.subject_id] is not None:
+                scale, offset = volume_manager.scales[subject.subject_id], volume_manager.offsets[subject.subject_id]
+                values = [value * scale + offset for value in values]
+
+            features[chunk_start:chunk_end] = np.concatenate(values, axis=1)
+
+    if filename is not None:
+        features.flush()
+
+    return features
+
+
+# Peak memory needed to load and preprocess a subject, relative to the size of its file.
+SUBJECT_MEMORY_FACTOR = 3
+
+
+def _load_subject(data_class, subject_file, use_sh_coeffs, mean_centering):
+    """ Loads a subject and computes the volume to register (might be run in a worker process). """
+    subject_data = data_class.load(subject_file)
+
+    dwi = subject_data.signal
+    bvals = subject_data.gradients.bvals
+    bvecs = subject_data.gradients.bvecs
+    if use_sh_coeffs:
+        # Use 45 spherical harmonic coefficients to represent the diffusion signal.
+        volume = neurotools.get_spherical_harmonics_coefficients(dwi, bvals, bvecs, mean_centering=mean_centering).astype(np.float32, copy=False)
+    else:
+        # Resample the diffusion signal to have 100 directions.
+        volume = neurotools.resample_dwi(dwi, bvals, bvecs, mean_centering=mean_centering).astype(np.float32, copy=False)
+
+    subject_data.signal.uncache()  # Free some memory as we don't need the original signal.
+    return subject_data, volume
+
+
+def _load_subjects(data_class, subject_files, volume_manager, use_sh_coeffs=False, mean_centering=True, nb_processes=1, memory_budget=None):
+    """ Loads and preprocesses subjects, possibly in parallel, then registers their volume.
+
+    Volumes are always registered in the order of the sorted `subject_files`, so subject IDs don't depend on `nb_processes`.
+
+    Parameters
+    ----------
+    nb_processes : int, optional
+        Number of processes used to load and preprocess the subjects. Default: 1 (no parallelism)
+    memory_budget : int, optional
+        If specified, maximum number of bytes subjects being loaded (or waiting to be registered) are expected
+        to need at once, estimated as `SUBJECT_MEMORY_FACTOR` times the size of their file.
+        At least one subject is always being loaded. Default: no limit
+    """
+    subject_files = sorted(subject_files)
     subjects = []
-    with Timer("  Loading subject(s)", newline=True):
-        for subject_file in sorted(subject_files):
+
+    def _register(subject_data, volume):
+        subject_data.subject_id = volume_manager.register(volume)
+        subjects.append(subject_data)
+
+    if nb_processes <= 1:
+        for subject_file in subject_files:
             print("    {}".format(subject_file))
-            tracto_data = TractographyData.load(subject_file)
-
-            dwi = tracto_data.signal
-            bvals = tracto_data.gradients.bvals
-            bvecs = tracto_data.gradients.bvecs
-            if use_sh_coeffs:
-                # Use 45 spherical harmonic coefficients to represent the diffusion signal.
-                volume = neurotools.get_spherical_harmonics_coefficients(dwi, bvals, bvecs, mean_centering=mean_centering).astype(np.float32)
-            else:
-                # Resample the diffusion signal to have 100 directions.
-                volume = neurotools.resample_dwi(dwi, bvals, bvecs, mean_centering=mean_centering).astype(np.float32)
-
-            tracto_data.signal.uncache()  # Free some memory as we don't need the original signal.
-            subject_id = volume_manager.register(volume)
-            tracto_data.subject_id = subject_id
-            subjects.append(tracto_data)
+            _register(*_load_subject(data_class, subject_file, use_sh_coeffs, mean_centering))
+
+        return subjects
+
+    costs = [SUBJECT_MEMORY_FACTOR * os.path.getsize(subject_file) for subject_file in subject_files]
+    with ProcessPoolExecutor(max_workers=nb_processes) as executor:
+        futures = []
+        nb_submitted = 0
+        used_memory = 0
+        for i, subject_file in enumerate(subject_files):
+            # Submit as many subjects as the budget allows, in order.
+            while nb_submitted < len(subject_files) and (nb_submitted == i or memory_budget is None or used_memory + costs[nb_submitted] <= memory_budget):
+                futures.append(executor.submit(_load_subject, data_class, subject_files[nb_submitted], use_sh_coeffs, mean_centering))
+                used_memory += costs[nb_submitted]
+                nb_submitted += 1
+
+            print("    {}".format(subject_file))
+            _register(*futures[i].result())
+            futures[i] = None  # Free the memory of the subject once registered.
+            used_memory -= costs[i]
+
+    return subjects
+
+
+def load_tractography_dataset(subject_files, volume_manager, name="HCP", use_sh_coeffs=False, mean_centering=True, nb_processes=1, memory_budget=None):
+    """ Loads subjects (as generated by `process_streamlines.py`) and registers their volume in `volume_manager`.
+
+    See `_load_subjects` for `nb_processes` and `memory_budget`.
+    """
+    with Timer("  Loading subject(s)", newline=True):
+        subjects = _load_subjects(TractographyData, subject_files, volume_manager, use_sh_coeffs=use_sh_coeffs, mean_centering=mean_centering,
+                                  nb_processes=nb_processes, memory_budget=memory_budget)
 
     return TractographyDataset(subjects, name, keep_on_cpu=True)
 
@@ -263,10 +421,10 @@ def load_tractography_dataset_from_dwi_and_tractogram(dwi, tractogram, volume_ma
 
     if use_sh_coeffs:
         # Use 45 spherical harmonic coefficients to represent the diffusion signal.
-        volume = neurotools.get_spherical_harmonics_coefficients(dwi, bvals, bvecs, mean_centering=mean_centering).astype(np.float32)
+        volume = neurotools.get_spherical_harmonics_coefficients(dwi, bvals, bvecs, mean_centering=mean_centering).astype(np.float32, copy=False)
     else:
         # Resample the diffusion signal to have 100 directions.
-        volume = neurotools.resample_dwi(dwi, bvals, bvecs, mean_centering=mean_centering).astype(np.float32)
+        volume = neurotools.resample_dwi(dwi, bvals, bvecs, mean_centering=mean_centering).astype(np.float32, copy=False)
 
     tracto_data.signal.uncache()  # Free some memory as we don't need the original signal.
     subject_id = volume_manager.register(volume)
@@ -321,26 +479,13 @@ class MaskClassifierDataset(Dataset):
         return self.inputs.get_value()[idx], self.input_id_to_volume_id[idx], self.targets.get_value()[idx]
 
 
-def load_mask_classifier_dataset(subject_files, volume_manager, name="HCP", use_sh_coeffs=False):
-    subjects = []
+def load_mask_classifier_dataset(subject_files, volume_manager, name="HCP", use_sh_coeffs=False, nb_processes=1, memory_budget=None):
+    """ Loads subjects (as generated by `process_mask_classifier_data.py`) and registers their volume in `volume_manager`.
+
+    See `_load_subjects` for `nb_processes` and `memory_budget`.
+    """
     with Timer("  Loading subject(s)", newline=True):
-        for subject_file in sorted(subject_files):
-            print("    {}".format(subject_file))
-            mask_data = MaskClassifierData.load(subject_file)
-
-            dwi = mask_data.signal
-            bvals = mask_data.gradients.bvals
-            bvecs = mask_data.gradients.bvecs
-            if use_sh_coeffs:
-                # Use 45 spherical harmonic coefficients to represent the diffusion signal.
-                volume = neurotools.get_spherical_harmonics_coefficients(dwi, bvals, bvecs).astype(np.float32)
-            else:
-                # Resample the diffusion signal to have 100 directions.
-                volume = neurotools.resample_dwi(dwi, bvals, bvecs).astype(np.float32)
-
-            mask_data.signal.uncache()  # Free some memory as we don't need the original signal.
-            subject_id = volume_manager.register(volume)
-            mask_data.subject_id = subject_id
-            subjects.append(mask_data)
+        subjects = _load_subjects(MaskClassifierData, subject_files, volume_manager, use_sh_coeffs=use_sh_coeffs,
+                                  nb_processes=nb_processes, memory_budget=memory_budget)
 
     return MaskClassifierDataset(subjects, name, keep_on_cpu=True)
@@ -1,4 +1,6 @@
+import numpy as np
 import theano.tensor as T
+from scipy.special import logsumexp
 
 import smartlearner.initializers as initer
 from learn2track.initializers import OrthogonalInitializer
@@ -254,7 +256,103 @@ def loss_factory(hyperparams, model, dataset, loss_type=None):
         raise ValueError("Unknown model!")
 
 
-def batch_scheduler_factory(hyperparams, dataset, train_mode=True, batch_size_override=None, use_data_augment=True):
+def step_loss_factory(hyperparams, model):
+    """
+    Build a NumPy function computing, for one tracking step, the loss term `loss_factory`
+    would have computed for it. This allows the tracker to accumulate a streamline's loss
+    as it grows it, directly from the regression output the sequence generator produced.
+
+    Parameters
+    ----------
+    hyperparams : dict
+        model's training hyperparams
+    model : :class:`Model`
+        Model used for tracking.
+
+    Returns
+    -------
+    function
+        Expects the regression output of the model, with shape (batch_size, regression_layer_size),
+        and the direction actually followed, with shape (batch_size, 3). Returns the loss of every
+        sequence for that step, with shape (batch_size,).
+
+    Notes
+    -----
+    For models trained with `learn_to_stop`, only the direction term of the loss is computed.
+    """
+    eps = 1e-6
+    normalize = hyperparams.get('normalize', False)
+
+    def _normalize(x, eps=0.):
+        return x / np.sqrt(np.sum(x**2, axis=-1, keepdims=True) + eps)
+
+    def _get_targets(directions):
+        if normalize:
+            return _normalize(directions)  # Same as the batch scheduler's `normalize_target`.
+
+        return directions
+
+    if hyperparams['model'] == 'gru_regression':
+        def _l2_distance(regression_output, directions):
+            if normalize:
+                regression_output = _normalize(regression_output, eps=eps)
+
+            return np.sqrt(np.sum((regression_output - _get_targets(directions))**2, axis=-1) + eps)
+
+        return _l2_distance
+
+    elif hyperparams['model'] == 'gru_gaussian':
+        def _gaussian_nll(regression_output, directions):
+            mu = regression_output[:, :3]
+            sigma = np.exp(regression_output[:, 3:6])
+            square_mahalanobis_dist = np.sum(((_get_targets(directions) - mu) / sigma)**2, axis=-1)
+            return 0.5 * (3 * np.log(2 * np.pi) + 2 * np.sum(np.log(sigma), axis=-1) + square_mahalanobis_dist)
+
+        return _gaussian_nll
+
+    elif hyperparams['model'] == 'gru_mixture':
+        n = model.n_gaussians
+
+        def _mixture_nll(regression_output, directions):
+            # mixture_weights.shape : (batch_size, n_gaussians)
+            # means.shape : (batch_size, n_gaussians, 3)
+            # stds.shape : (batch_size, n_gaussians, 3)
+            logits = regression_output[:, :n]
+            log_mixture_weights = logits - logsumexp(logits, axis=1)[:, None]
+            means = regression_output[:, n:n*4].reshape((-1, n, 3))
+            stds = np.exp(regression_output[:, n*4:n*7]).reshape((-1, n, 3))
+
+            targets = _get_targets(directions)[:, None, :]
+            log_prefix = -2 * log_mixture_weights + 3 * np.log(2*np.pi) + 2 * np.sum(np.log(stds), axis=-1)
+            square_mahalanobis_dist = np.sum(((targets - means) / stds)**2, axis=-1)
+            return -logsumexp(-0.5 * (log_prefix + square_mahalanobis_dist), axis=1)
+
+        return _mixture_nll
+
+    elif hyperparams['model'] == 'gru_multistep':
+        def _multistep_nll(distribution_params, directions):
+            # With K=1 and M=1, the Monte-Carlo estimate is the gaussian NLL itself.
+            mu = distribution_params[:, :3]
+            sigma = distribution_params[:, 3:6]
+            log_likelihood = -1.5 * np.log(2 * np.pi) + np.sum(-np.log(sigma) - 0.5 * ((_get_targets(directions) - mu) / sigma)**2, axis=-1)
+            return -log_likelihood
+
+        return _multistep_nll
+
+    elif hyperparams['model'] == 'ffnn_regression':
+        def _cosine_squared(regression_output, directions):
+            if normalize:
+                regression_output = _normalize(regression_output, eps=eps)
+
+            return -np.sum(regression_output * _get_targets(directions), axis=-1)**2
+
+        return _cosine_squared
+
+    else:
+        raise ValueError("Unknown model!")
+
+
+def batch_scheduler_factory(hyperparams, dataset, train_mode=True, batch_size_override=None, use_data_augment=True, features=None):
     """
     Build the right batch scheduler for the model and chosen mode
 
@@ -270,22 +368,30 @@ def batch_scheduler_factory(hyperparams, dataset, train_mode=True, batch_size_ov
         override batch_size hyperparam
     use_data_augment : bool
         Feed streamlines in both directions (doubles the batch size)
+    features : ndarray, optional
+        Diffusion data precomputed at every point of the streamlines (only for GRU models, except gru_multistep).
     """
     batch_size = hyperparams['batch_size'] if batch_size_override is None else batch_size_override
 
     if hyperparams['model'] in ['gru_regression', 'gru_mixture', 'gru_gaussian']:
-        from learn2track.batch_schedulers import TractographyBatchScheduler
-        return TractographyBatchScheduler(dataset,
-                                          batch_size=batch_size,
-                                          use_data_augment=use_data_augment,
-                                          seed=hyperparams['seed'],
-                                          normalize_target=hyperparams['normalize'],
-                                          noisy_streamlines_sigma=hyperparams['noisy_streamlines_sigma'],
-                                          shuffle_streamlines=train_mode,
-                                          resample_streamlines=(not hyperparams['keep_step_size']) and train_mode,
-                                          feed_previous_direction=hyperparams['feed_previous_direction'],
-                                          sort_streamlines_by_length=hyperparams['sort_streamlines'] and train_mode,
-                                          learn_to_stop=hyperparams['learn_to_stop'])
+        from learn2track.batch_schedulers import TractographyBatchScheduler, TBPTTBatchScheduler
+        kwargs = dict(batch_size=batch_size,
+                      use_data_augment=use_data_augment,
+                      seed=hyperparams['seed'],
+                      normalize_target=hyperparams['normalize'],
+                      noisy_streamlines_sigma=hyperparams['noisy_streamlines_sigma'],
+                      shuffle_streamlines=train_mode,
+                      resample_streamlines=(not hyperparams['keep_step_size']) and train_mode,
+                      feed_previous_direction=hyperparams['feed_previous_direction'],
+                      sort_streamlines_by_length=hyperparams['sort_streamlines'] and train_mode,
+                      learn_to_stop=hyperparams['learn_to_stop'],
+                      features=features)
+
+        # Truncated BPTT is only used for training, evaluation is done on whole streamlines.
+        if train_mode and hyperparams.get('tbptt_window') is not None:
+            return TBPTTBatchScheduler(dataset, window_size=hyperparams['tbptt_window'], **kwargs)
+
+        return TractographyBatchScheduler(dataset, **kwargs)
 
     elif hyperparams['model'] == 'gru_multistep':
         from learn2track.batch_schedulers import MultistepSequenceBatchScheduler
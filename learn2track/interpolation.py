@@ -1,8 +1,5 @@
 import numpy as np
 
-import theano
-import theano.tensor as T
-
 
 B1 = np.array([[1, 0, 0, 0, 0, 0, 0, 0],
                [-1, 0, 0, 0, 1, 0, 0, 0],
@@ -23,22 +20,64 @@ idx = np.array([[0, 0, 0],
                 [1, 1, 1]], dtype="float32")
 
 
+def get_bricked_rows(x, y, z, shape, brick_size):
+    """ Gives the rows of a bricked volume (see `learn2track.neurotools.make_bricked_volume`) containing some voxels.
+
+    Works both with NumPy arrays and Theano tensors.
+
+    Parameters
+    ----------
+    x, y, z : arrays of int
+        Voxel coordinates (inside the volume).
+    shape : tuple of int
+        Shape of the volume before it was bricked, i.e. (X, Y, Z).
+    brick_size : int
+        Size of the bricks along each axis.
+
+    Returns
+    -------
+    rows : array of int
+    """
+    nb_bricks_y = -(-shape[1] // brick_size)
+    nb_bricks_z = -(-shape[2] // brick_size)
+    brick = (x // brick_size * nb_bricks_y + y // brick_size) * nb_bricks_z + z // brick_size
+    voxel = ((x % brick_size) * brick_size + y % brick_size) * brick_size + z % brick_size
+    return brick * brick_size**3 + voxel
+
+
 def advanced_indexing(volume, *indices_list, **kwargs):
     """ Performs advanced indexing on `volume`.
 
     This function exists because in Theano<=0.9 advanced indexing is
     only supported along the first dimension.
 
+    If `index` is given, `volume` is a sparse volume (see `learn2track.neurotools.make_sparse_volume`):
+    `index` is indexed instead and gives the rows of `volume` to return.
+
+    If `brick_size` is given, `volume` is a bricked volume (see `learn2track.neurotools.make_bricked_volume`)
+    and `shape` must be the shape of the volume before it was bricked.
+
     Notes
     -----
-    Assuming `volume` is C contiguous.
+    Assuming `volume` (or `index`) is C contiguous.
     """
+    import theano
+    import theano.tensor as T
+
     strides = kwargs.get("strides")
+    index = kwargs.get("index")
+    brick_size = kwargs.get("brick_size")
+    if brick_size is not None:
+        shape = kwargs["shape"]
+        indices_list = [T.cast(T.clip(indices, 0, size - 1), dtype="int32") for indices, size in zip(indices_list, shape)]
+        return volume[get_bricked_rows(*indices_list, shape=shape, brick_size=brick_size)]
+
+    grid = volume if index is None else index
     if strides is None:
-        shapes = T.cast(volume.shape[:len(indices_list)], dtype=theano.config.floatX)
+        shapes = T.cast(grid.shape[:len(indices_list)], dtype=theano.config.floatX)
         strides = T.concatenate([T.ones((1,)), T.cumprod(shapes[::-1])[:-1]], axis=0)[::-1]
 
-    shapes = T.cast(volume.shape, dtype=theano.config.floatX)
+    shapes = T.cast(grid.shape, dtype=theano.config.floatX)
 
     indices = T.maximum(0, T.minimum(indices_list[-1], shapes[len(indices_list)-1]-1))
     for i in range(len(indices_list)-1):
@@ -47,10 +86,13 @@ def advanced_indexing(volume, *indices_list, **kwargs):
 
     # indices = T.sum(T.stack(indices_list, axis=1)*strides[:len(indices_list)], axis=1)
     indices = T.cast(indices, dtype="int32")
+    if index is not None:
+        return volume[index.flatten()[indices]]
+
     return volume.reshape((-1, volume.shape[-1]))[indices]
 
 
-def eval_volume_at_3d_coordinates_in_theano(volume, coords, strides=None):
+def eval_volume_at_3d_coordinates_in_theano(volume, coords, strides=None, index=None, brick_size=None, shape=None):
     """ Evaluates the data volume at given coordinates using trilinear interpolation.
 
     This function is a Theano version of `learn2track.utils.eval_volume_at_3d_coordinates`.
@@ -63,11 +105,22 @@ def eval_volume_at_3d_coordinates_in_theano(volume, coords, strides=None):
         3D coordinates where to evaluate the volume data.
     strides : tuple
         Strides of the volume (for speedup). Default: detected automatically.
+    index : 3D array of int32, optional
+        If specified, `volume` is a sparse volume, i.e. a 2D array whose rows are the data
+        of the voxels referenced by `index` (see `learn2track.neurotools.make_sparse_volume`).
+    brick_size : int, optional
+        If specified, `volume` is a bricked volume, i.e. a 2D array whose rows are the data of the
+        voxels stored brick by brick (see `learn2track.neurotools.make_bricked_volume`).
+    shape : tuple of int, optional
+        Shape of the volume before it was bricked, i.e. (X, Y, Z). Required if `brick_size` is specified.
 
     References
     ----------
     [1] https://spie.org/samples/PM159.pdf
     """
+    import theano
+    import theano.tensor as T
+
     if volume.ndim == 3:
         print("eval_volume_at_3d_coordinates_in_theano with volume.ndim == 3 has not been tested.")
         indices = T.cast((coords[:, None, :] + idx).reshape((-1, 3)), dtype="int32")
@@ -80,10 +133,14 @@ def eval_volume_at_3d_coordinates_in_theano(volume, coords, strides=None):
         values = T.sum(P * T.dot(B1.T, Q1), axis=0)
         return values
 
-    elif volume.ndim == 4:
+    elif volume.ndim == 4 or index is not None or brick_size is not None:
         indices = T.floor((coords[:, None, :] + idx).reshape((-1, 3)))
 
-        P = advanced_indexing(volume, indices[:, 0], indices[:, 1], indices[:, 2], strides=strides).reshape((coords.shape[0], 8, volume.shape[-1])).T
+        P = advanced_indexing(volume, indices[:, 0], indices[:, 1], indices[:, 2], strides=strides, index=index,
+                              brick_size=brick_size, shape=shape)
+        P = P.reshape((coords.shape[0], 8, volume.shape[-1])).T
+        if P.dtype != theano.config.floatX:
+            P = T.cast(P, dtype=theano.config.floatX)  # Volume stored with a reduced precision (e.g. float16 or int16).
 
         d = coords - T.floor(coords)
         dx, dy, dz = d[:, 0], d[:, 1], d[:, 2]
@@ -98,8 +98,9 @@ class FFNN_Regression(FFNN):
         batch_size = Xi.shape[0]
         coords = Xi[:, :4]
 
-        # Repeat coords and apply the neighborhood transformations
-        if self.neighborhood_radius:
+        # Repeat coords and apply the neighborhood transformations, unless the volumes already have the neighborhood stacked.
+        eval_neighborhood = self.neighborhood_radius and not self.volume_manager.has_stacked_neighborhood(self.neighborhood_directions)
+        if eval_neighborhood:
             # coords.shape : (batch_size*len(neighbors_positions), 4)
             coords = T.repeat(coords, self.neighborhood_directions.shape[0], axis=0)
             coords = T.set_subtensor(coords[:, :3], coords[:, :3] + T.tile(self.neighborhood_directions, (batch_size, 1)))
@@ -109,7 +110,7 @@ class FFNN_Regression(FFNN):
         data_at_coords = self.volume_manager.eval_at_coords(coords)
 
         # Concatenate back the neighborhood data into a single input vector
-        if self.neighborhood_radius:
+        if eval_neighborhood:
             data_at_coords = T.reshape(data_at_coords, (batch_size, self.model_input_size))
 
         if self.use_previous_direction:
@@ -133,7 +134,7 @@ class FFNN_Regression(FFNN):
 
         return layer_outputs + (regression_out,)
 
-    def make_sequence_generator(self, subject_id=0, **_):
+    def make_sequence_generator(self, subject_id=0, return_regression_output=False, **_):
         """ Makes functions that return the prediction for x_{t+1} for every
         sequence in the batch given x_{t}.
 
@@ -141,6 +142,8 @@ class FFNN_Regression(FFNN):
         ----------
         subject_id : int, optional
             ID of the subject from which its diffusion data will be used. Default: 0.
+        return_regression_output : bool, optional
+            Also return the raw output of the regression layer (used to compute the loss on-the-fly).
         """
 
         # Build the sequence generator as a theano function.
@@ -172,6 +175,8 @@ class FFNN_Regression(FFNN):
                 Directions to follow.
             new_states : list of 2D array of shape (batch_size, hidden_size)
                 Updated states of the network after seeing x_t.
+            regression_output : ndarray with shape (batch_size, 3)
+                Raw output of the regression layer (only if `return_regression_output`).
             """
             # Append the DWI ID of each sequence after the 3D coordinates.
             subject_ids = np.array([subject_id] * len(x_t), dtype=floatX)[:, None]
@@ -183,6 +188,7 @@ class FFNN_Regression(FFNN):
 
             results = f(x_t)
             next_x_t = results[-1]
+            regression_output = next_x_t
 
             next_x_t_both_directions = np.stack([next_x_t, -next_x_t], axis=-1)
 
@@ -194,6 +200,9 @@ class FFNN_Regression(FFNN):
             # FFNN_Regression is not a recurrent network, return original states
             new_states = states
 
+            if return_regression_output:
+                return next_x_t, new_states, regression_output
+
             return next_x_t, new_states
 
         return _gen
@@ -6,6 +6,7 @@ from collections import OrderedDict
 from os.path import join as pjoin
 from smartlearner import utils as smartutils
 from smartlearner.interfaces import Model
+from smartlearner.utils import sharedX
 from theano.sandbox.rng_mrg import MRG_RandomStreams
 
 from learn2track.models.layers import LayerGRU, LayerGruNormalized
@@ -45,6 +46,10 @@ class GRU(Model):
         self.graph_updates = OrderedDict()
         self._gen = None
 
+        # Truncated BPTT (see `enable_truncated_bptt`).
+        self.init_states = None
+        self.final_states = None
+
         self.input_size = input_size
         self.hidden_sizes = [hidden_sizes] if type(hidden_sizes) is int else hidden_sizes
         self.activation = activation
@@ -109,6 +114,34 @@ class GRU(Model):
 
         return states_h
 
+    def enable_truncated_bptt(self):
+        """ Makes the next graphs built by `get_output` start from shared hidden states instead of zeros.
+
+        Used for truncated backpropagation through time (TBPTT): no gradient flows through the initial
+        states, and `self.final_states` holds the hidden states after the last step of the sequence so
+        they can be carried over to the next window (see :class:`TBPTTBatchScheduler`).
+
+        Returns
+        -------
+        init_states : list of shared variables
+            Initial hidden state of each layer, shape (batch_size, hidden_size).
+        """
+        self.init_states = []
+        for i, hidden_size in enumerate(self.hidden_sizes):
+            self.init_states.append(sharedX(np.zeros((0, hidden_size)), name="layer{}_init_state_h".format(i)))
+
+        return self.init_states
+
+    def _get_outputs_info_h(self, X):
+        if self.init_states is not None:
+            return list(self.init_states)
+
+        outputs_info_h = []
+        for hidden_size in self.hidden_sizes:
+            outputs_info_h.append(T.zeros((X.shape[0], hidden_size)))
+
+        return outputs_info_h
+
     def _fprop(self, Xi, *args):
         layers_h = []
 
@@ -136,15 +169,14 @@ class GRU(Model):
 
     def get_output(self, X):
 
-        outputs_info_h = []
-        for hidden_size in self.hidden_sizes:
-            outputs_info_h.append(T.zeros((X.shape[0], hidden_size)))
+        outputs_info_h = self._get_outputs_info_h(X)
 
         results, updates = theano.scan(fn=self._fprop,
                                        outputs_info=outputs_info_h,
                                        sequences=[T.transpose(X, axes=(1, 0, 2))])  # We want to scan over sequence elements, not the examples.
 
         self.graph_updates = updates
+        self.final_states = [results_h[-1] for results_h in results[:len(self.hidden_sizes)]]
         # Put back the examples so they are in the first dimension.
         self.h = T.transpose(results[0], axes=(1, 0, 2))
         return self.h
@@ -127,7 +127,7 @@ class GRU_Mixture(GRU_Regression):
 
         return samples
 
-    def make_sequence_generator(self, subject_id=0, use_max_component=False):
+    def make_sequence_generator(self, subject_id=0, use_max_component=False, return_regression_output=False, samples_per_input=1):
         """ Makes functions that return the prediction for x_{t+1} for every
         sequence in the batch given x_{t} and the current state of the model h^{l}_{t}.
 
@@ -135,6 +135,15 @@ class GRU_Mixture(GRU_Regression):
         ----------
         subject_id : int, optional
             ID of the subject from which its diffusion data will be used. Default: 0.
+        use_max_component : bool, optional
+            Use the maximum of the probability distribution instead of sampling values
+        return_regression_output : bool, optional
+            Also return the raw output of the regression layer, i.e. the parameters of the
+            mixture the samples were drawn from (used to compute the loss on-the-fly).
+        samples_per_input : int, optional
+            Number of samples to draw for every input sequence. Outputs and states are repeated
+            accordingly, i.e. the generator returns `batch_size * samples_per_input` rows where
+            the samples of the i-th sequence are consecutive. Default: 1.
         """
 
         # Build the sequence generator as a theano function.
@@ -150,6 +159,11 @@ class GRU_Mixture(GRU_Regression):
 
         # regression_output.shape : (batch_size, target_size)
         regression_output = new_states[-1]
+        if samples_per_input > 1:
+            # Fork every sequence after its features and states have been computed only once.
+            regression_output = T.repeat(regression_output, samples_per_input, axis=0)
+            new_states_h = [T.repeat(state_h, samples_per_input, axis=0) for state_h in new_states_h]
+
         mixture_params = self.get_mixture_parameters(regression_output, ndim=3)
 
         if use_max_component:
@@ -160,12 +174,19 @@ class GRU_Mixture(GRU_Regression):
 
         if self.learn_to_stop:
             stopping = new_states[-2]
+            if samples_per_input > 1:
+                stopping = T.repeat(stopping, samples_per_input, axis=0)
+
             predictions = [stopping, samples]
         else:
             predictions = [samples]
 
+        outputs = list(predictions) + list(new_states_h)
+        if return_regression_output:
+            outputs += [regression_output]
+
         f = theano.function(inputs=[symb_x_t] + states_h,
-                            outputs=list(predictions) + list(new_states_h))
+                            outputs=outputs)
 
         def _gen(x_t, states, previous_direction=None):
             """ Returns the prediction for x_{t+1} for every
@@ -187,6 +208,8 @@ class GRU_Mixture(GRU_Regression):
                 Directions to follow.
             new_states : list of 2D array of shape (batch_size, hidden_size)
                 Updated states of the network after seeing x_t.
+            regression_output : ndarray with shape (batch_size, regression_layer_size)
+                Raw output of the regression layer (only if `return_regression_output`).
             """
             # Append the DWI ID of each sequence after the 3D coordinates.
             subject_ids = np.array([subject_id] * len(x_t), dtype=floatX)[:, None]
@@ -197,6 +220,10 @@ class GRU_Mixture(GRU_Regression):
                 x_t = np.c_[x_t, subject_ids, previous_direction]
 
             results = f(x_t, *states)
+            if return_regression_output:
+                regression_output = results[-1]
+                results = results[:-1]
+
             if self.learn_to_stop:
                 stopping = results[0]
                 next_x_t = results[1]
@@ -207,8 +234,15 @@ class GRU_Mixture(GRU_Regression):
                 new_states = results[1:]
                 output = next_x_t
 
+            if return_regression_output:
+                return output, new_states, regression_output
+
             return output, new_states
 
+        if not use_max_component:
+            # Lets trackers restart the random stream, e.g. so streamlines don't depend on previous calls.
+            _gen.seed = srng.seed
+
         return _gen
 
 
@@ -96,9 +96,9 @@ class GRU_Multistep_Gaussian(GRU):
         batch_size = Xi.shape[0]
 
         if self.k > 1:
-            # Random noise used for sampling at each step (t+2)...(t+k)
-            # epsilon.shape : (K-1, batch_size, target_dimensions)
-            epsilon = self.srng.normal((self.k - 1, batch_size, self.target_dims))
+            # Random noise used for sampling at each step (t+2)...(t+k) of the M sampled branches
+            # epsilon.shape : (K-1, batch_size*M, target_dimensions)
+            epsilon = self.srng.normal((self.k - 1, batch_size * self.m, self.target_dims))
 
         # Get diffusion data.
         # data_at_coords.shape : (batch_size, input_size)
@@ -118,10 +118,18 @@ class GRU_Multistep_Gaussian(GRU):
         # Compute the distribution parameters for step (t)
         # distribution_params.shape : (batch_size, target_size)
         distribution_params = self._predict_distribution_params(next_hidden_state[-1])
-        # k_distribution_params = T.set_subtensor(k_distribution_params[:, 0, :, :], distribution_params)
-        k_distribution_params = [distribution_params]
 
-        sample_hidden_state = next_hidden_state
+        # Only the sampled steps (t+1)...(t+k) differ between the M branches, so the teacher-forced step (t)
+        # is computed once and then forked M times (each example's M branches are contiguous).
+        # distribution_params.shape : (batch_size*M, target_size)
+        if self.m > 1:
+            distribution_params = T.repeat(distribution_params, self.m, axis=0)
+            coords = T.repeat(coords, self.m, axis=0)
+            sample_hidden_state = tuple(T.repeat(h, self.m, axis=0) for h in next_hidden_state)
+        else:
+            sample_hidden_state = next_hidden_state
+
+        k_distribution_params = [distribution_params]
 
         for k in range(1, self.k):
             # Sample an input for the next step
@@ -145,7 +153,9 @@ class GRU_Multistep_Gaussian(GRU):
             distribution_params = self._predict_distribution_params(sample_hidden_state[-1])
             k_distribution_params += [distribution_params]
 
+        # k_distribution_params.shape : (batch_size, M, K, target_size)
         k_distribution_params = T.stack(k_distribution_params, axis=1)
+        k_distribution_params = T.reshape(k_distribution_params, (batch_size, self.m, self.k, self.target_size))
 
         return next_hidden_state + (k_distribution_params,)
 
@@ -185,37 +195,27 @@ class GRU_Multistep_Gaussian(GRU):
         # X.shape : (batch_size, seq_len, n_features=4)
         # For tractography n_features is (x,y,z) + (dwi_id,)
 
-        # Repeat Xs to compute M sample sequences for each input
-        # inputs.shape : (batch_size*M, seq_len, n_features)
-        inputs = T.repeat(X, self.m, axis=0)
-
-        # outputs_info_h.shape : n_layers * (batch_size*M, layer_size)
+        # outputs_info_h.shape : n_layers * (batch_size, layer_size)
         outputs_info_h = []
         for hidden_size in self.hidden_sizes:
-            outputs_info_h.append(T.zeros((inputs.shape[0], hidden_size)))
+            outputs_info_h.append(T.zeros((X.shape[0], hidden_size)))
 
-        # results.shape : n_layers * (seq_len, batch_size*M, layer_size), (seq_len, batch_size*M, K, target_size)
+        # The M sample sequences are forked inside `_fprop_step`.
+        # results.shape : n_layers * (seq_len, batch_size, layer_size), (seq_len, batch_size, M, K, target_size)
         results, updates = theano.scan(fn=self._fprop_step, # We want to scan over sequence elements, not the examples.
-                                       sequences=[T.transpose(inputs, axes=(1, 0, 2))], outputs_info=outputs_info_h + [None],
-                                       non_sequences=self.parameters + self.volume_manager.volumes, strict=True)
+                                       sequences=[T.transpose(X, axes=(1, 0, 2))], outputs_info=outputs_info_h + [None],
+                                       non_sequences=self.parameters + self.volume_manager.shared_variables, strict=True)
 
         self.graph_updates = updates
 
-        # Put back the examples so they are in the first dimension
-        # transposed.shape : (batch_size*M, seq_len, K, target_size)
-        transposed = T.transpose(results[-1], axes=(1, 0, 2, 3))
-
-        # Split the M sample sequences into a new dimension
-        # reshaped.shape : (batch_size, M, seq_len, K, target_size)
-        reshaped = T.reshape(transposed, (X.shape[0], self.m, X.shape[1], self.k, self.target_size))
-
-        # Transpose the output to get the M sequences dimension in the right place
+        # Put back the examples so they are in the first dimension and
+        # the M sequences dimension in the right place.
         # regression_out.shape : (batch_size, seq_len, K, M, target_size)
-        regression_out = T.transpose(reshaped, (0, 2, 3, 1, 4))
+        regression_out = T.transpose(results[-1], axes=(1, 0, 3, 2, 4))
 
         return regression_out
 
-    def make_sequence_generator(self, subject_id=0, use_max_component=False):
+    def make_sequence_generator(self, subject_id=0, use_max_component=False, return_regression_output=False):
         """ Makes functions that return the prediction for x_{t+1} for every
         sequence in the batch given x_{t} and the current state of the model h^{l}_{t}.
 
@@ -223,6 +223,10 @@ class GRU_Multistep_Gaussian(GRU):
         ----------
         subject_id : int, optional
             ID of the subject from which its diffusion data will be used. Default: 0.
+        use_max_component : bool, optional
+            Use the maximum of the probability distribution instead of sampling values
+        return_regression_output : bool, optional
+            Also return the distribution parameters the predictions were drawn from (used to compute the loss on-the-fly).
         """
 
         # Build the sequence generator as a theano function.
@@ -233,17 +237,18 @@ class GRU_Multistep_Gaussian(GRU):
 
         symb_x_t = T.matrix(name="x_t")
 
-        # Temporarily set $k$ to one.
-        k_bak = self.k
+        # Temporarily set $k$ and $m$ to one.
+        k_bak, m_bak = self.k, self.m
         self.k = 1
+        self.m = 1
 
         new_states = self._fprop_step(symb_x_t, *states_h)
         new_states_h = new_states[:len(self.hidden_sizes)]
 
-        # model_output.shape : (batch_size, K=1, target_size)
+        # model_output.shape : (batch_size, M=1, K=1, target_size)
         model_output = new_states[-1]
 
-        distribution_params = model_output[:, 0, :]
+        distribution_params = model_output[:, 0, 0, :]
 
         if use_max_component:
             predictions = self.get_max_component_samples(distribution_params)
@@ -257,10 +262,14 @@ class GRU_Multistep_Gaussian(GRU):
             # predictions.shape : (batch_size, target_dims)
             predictions = self.get_stochastic_samples(distribution_params, noise)
 
+        outputs = [predictions] + list(new_states_h)
+        if return_regression_output:
+            outputs += [distribution_params]
+
         f = theano.function(inputs=[symb_x_t] + states_h,
-                            outputs=[predictions] + list(new_states_h))
+                            outputs=outputs)
 
-        self.k = k_bak  # Restore original $k$.
+        self.k, self.m = k_bak, m_bak  # Restore original $k$ and $m$.
 
         def _gen(x_t, states, previous_direction=None):
             """ Returns the prediction for x_{t+1} for every
@@ -282,6 +291,8 @@ class GRU_Multistep_Gaussian(GRU):
                 Directions to follow.
             new_states : list of 2D array of shape (batch_size, hidden_size)
                 Updated states of the network after seeing x_t.
+            distribution_params : ndarray with shape (batch_size, target_size)
+                Parameters of the distribution (only if `return_regression_output`).
             """
             # Append the DWI ID of each sequence after the 3D coordinates.
             subject_ids = np.array([subject_id] * len(x_t), dtype=floatX)[:, None]
@@ -292,10 +303,19 @@ class GRU_Multistep_Gaussian(GRU):
                 x_t = np.c_[x_t, subject_ids, previous_direction]
 
             results = f(x_t, *states)
+            if return_regression_output:
+                next_x_t = results[0]
+                new_states = results[1:-1]
+                return next_x_t, new_states, results[-1]
+
             next_x_t = results[0]
             new_states = results[1:]
             return next_x_t, new_states
 
+        if not use_max_component:
+            # Lets trackers restart the random stream, e.g. so streamlines don't depend on previous calls.
+            _gen.seed = srng.seed
+
         return _gen
 
     def save(self, path):
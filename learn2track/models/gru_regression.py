@@ -16,6 +16,9 @@ class GRU_Regression(GRU):
     """ A standard GRU model with a regression layer stacked on top of it.
     """
 
+    # If True, inputs are the diffusion data precomputed at the streamlines coordinates instead of the coordinates (training only).
+    use_precomputed_features = False
+
     def __init__(self, volume_manager, input_size, hidden_sizes, output_size, activation='tanh', use_previous_direction=False, predict_offset=False,
                  use_layer_normalization=False, drop_prob=0., use_zoneout=False, use_skip_connections=False, neighborhood_radius=None,
                  learn_to_stop=False, seed=1234, **_):
@@ -104,18 +107,12 @@ class GRU_Regression(GRU):
 
         return all_params
 
-    def _fprop_step(self, Xi, *args):
-        # Xi.shape : (batch_size, 4)    *if self.use_previous_direction, Xi.shape : (batch_size,7)
-        # coords + dwi ID (+ previous_direction)
+    def _eval_data_at_coords(self, coords):
+        batch_size = coords.shape[0]
 
-        # coords : streamlines 3D coordinates.
-        # coords.shape : (batch_size, 4) where the last column is a dwi ID.
-        # args.shape : n_layers * (batch_size, layer_size)
-        batch_size = Xi.shape[0]
-        coords = Xi[:, :4]
-
-        # Repeat coords and apply the neighborhood transformations
-        if self.neighborhood_radius:
+        # Repeat coords and apply the neighborhood transformations, unless the volumes already have the neighborhood stacked.
+        eval_neighborhood = self.neighborhood_radius and not self.volume_manager.has_stacked_neighborhood(self.neighborhood_directions)
+        if eval_neighborhood:
             # coords.shape : (batch_size*len(neighbors_positions), 4)
             coords = T.repeat(coords, self.neighborhood_directions.shape[0], axis=0)
             coords = T.set_subtensor(coords[:, :3], coords[:, :3] + T.tile(self.neighborhood_directions, (batch_size, 1)))
@@ -125,12 +122,29 @@ class GRU_Regression(GRU):
         data_at_coords = self.volume_manager.eval_at_coords(coords)
 
         # Concatenate back the neighborhood data into a single input vector
-        if self.neighborhood_radius:
+        if eval_neighborhood:
             data_at_coords = T.reshape(data_at_coords, (batch_size, self.model_input_size))
 
+        return data_at_coords
+
+    def _fprop_step(self, Xi, *args):
+        # Xi.shape : (batch_size, 4)    *if self.use_previous_direction, Xi.shape : (batch_size,7)
+        # coords + dwi ID (+ previous_direction)
+
+        # coords : streamlines 3D coordinates.
+        # coords.shape : (batch_size, 4) where the last column is a dwi ID.
+        # args.shape : n_layers * (batch_size, layer_size)
+
+        if self.use_precomputed_features:
+            # Diffusion data have already been evaluated at the streamlines coordinates (see `compute_streamlines_features`).
+            # data_at_coords.shape : (batch_size, n_features)
+            data_at_coords = Xi[:, :-3] if self.use_previous_direction else Xi
+        else:
+            data_at_coords = self._eval_data_at_coords(Xi[:, :4])
+
         if self.use_previous_direction:
             # previous_direction.shape : (batch_size, 3)
-            previous_direction = Xi[:, 4:]
+            previous_direction = Xi[:, -3:]
             fprop_input = T.concatenate([data_at_coords, previous_direction], axis=1)
         else:
             fprop_input = data_at_coords
@@ -158,9 +172,7 @@ class GRU_Regression(GRU):
         # X.shape : (batch_size, seq_len, n_features=[4|7])
         # For tractography n_features is (x,y,z) + (dwi_id,) + [previous_direction]
 
-        outputs_info_h = []
-        for hidden_size in self.hidden_sizes:
-            outputs_info_h.append(T.zeros((X.shape[0], hidden_size)))
+        outputs_info_h = self._get_outputs_info_h(X)
 
         outputs_info = outputs_info_h + [None]
         if self.learn_to_stop:
@@ -170,10 +182,11 @@ class GRU_Regression(GRU):
                                        # We want to scan over sequence elements, not the examples.
                                        sequences=[T.transpose(X, axes=(1, 0, 2))],
                                        outputs_info=outputs_info,
-                                       non_sequences=self.parameters + self.volume_manager.volumes,
+                                       non_sequences=self.parameters + self.volume_manager.shared_variables,
                                        strict=True)
 
         self.graph_updates = updates
+        self.final_states = [results_h[-1] for results_h in results[:len(self.hidden_sizes)]]
         # Put back the examples so they are in the first dimension.
         # regression_out.shape : (batch_size, seq_len, target_size=3)
         self.regression_out = T.transpose(results[-1], axes=(1, 0, 2))
@@ -185,7 +198,7 @@ class GRU_Regression(GRU):
 
         return model_output
 
-    def make_sequence_generator(self, subject_id=0, **_):
+    def make_sequence_generator(self, subject_id=0, return_regression_output=False, **_):
         """ Makes functions that return the prediction for x_{t+1} for every
         sequence in the batch given x_{t} and the current state of the model h^{l}_{t}.
 
@@ -193,6 +206,8 @@ class GRU_Regression(GRU):
         ----------
         subject_id : int, optional
             ID of the subject from which its diffusion data will be used. Default: 0.
+        return_regression_output : bool, optional
+            Also return the raw output of the regression layer (used to compute the loss on-the-fly).
         """
 
         # Build the sequence generator as a theano function.
@@ -234,6 +249,8 @@ class GRU_Regression(GRU):
                 Directions to follow.
             new_states : list of 2D array of shape (batch_size, hidden_size)
                 Updated states of the network after seeing x_t.
+            regression_output : ndarray with shape (batch_size, 3)
+                Raw output of the regression layer (only if `return_regression_output`).
             """
             # Append the DWI ID of each sequence after the 3D coordinates.
             subject_ids = np.array([subject_id] * len(x_t), dtype=floatX)[:, None]
@@ -254,6 +271,10 @@ class GRU_Regression(GRU):
                 new_states = results[1:]
                 output = next_x_t
 
+            if return_regression_output:
+                # The regression layer directly outputs the direction to follow.
+                return output, new_states, next_x_t.copy()
+
             return output, new_states
 
         return _gen
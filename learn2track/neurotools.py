@@ -1,21 +1,20 @@
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import nibabel as nib
 import numpy as np
-import theano
-import theano.tensor as T
-from dipy.align.bundlemin import distance_matrix_mdf
 from dipy.core.sphere import Sphere, HemiSphere
 from dipy.data import get_sphere
 from dipy.reconst.shm import sph_harm_lookup, smooth_pinv
 from dipy.segment.quickbundles import QuickBundles
 from dipy.tracking.streamline import set_number_of_points
-from scipy.ndimage import map_coordinates
-from smartlearner.utils import sharedX
+from scipy.ndimage import map_coordinates, shift
+from scipy.spatial import cKDTree
 
-from learn2track.interpolation import eval_volume_at_3d_coordinates_in_theano
+# Theano is imported lazily across learn2track, so data-only tools don't need it.
+from learn2track.interpolation import eval_volume_at_3d_coordinates_in_theano, get_bricked_rows
 
-floatX = theano.config.floatX
+STORAGE_DTYPES = ["float32", "float16", "int16"]
 
 
 class TractographyData(object):
@@ -149,31 +148,113 @@ class TractographyData(object):
 
 
 class VolumeManager(object):
-    def __init__(self):
+    def __init__(self, neighborhood_directions=None, sparse=False, storage_dtype="float32", brick_size=None):
+        """
+        Parameters
+        ----------
+        neighborhood_directions : ndarray of shape (n_directions, 3), optional
+            If specified, volumes are stacked with copies of themselves shifted along each
+            direction when registered (see `make_neighborhood_stacked_volume`). A single lookup
+            then returns the signal at every neighbor position (n_directions * data_dimension values).
+        sparse : bool, optional
+            If True, only the data of the brain voxels are kept in memory (see `make_sparse_volume`).
+            Default: False
+        storage_dtype : {'float32', 'float16', 'int16'}, optional
+            Type used to store the registered volumes (see `quantize_volume`). Interpolation is
+            still done in floatX, values being dequantized once gathered. Default: 'float32'
+        brick_size : int, optional
+            If specified, registered volumes are stored brick by brick (see `make_bricked_volume`),
+            which makes the memory accesses of the interpolation more local. Incompatible with `sparse`.
+        """
+        if storage_dtype not in STORAGE_DTYPES:
+            raise ValueError("Unknown storage dtype: {} (choices: {})".format(storage_dtype, ", ".join(STORAGE_DTYPES)))
+
+        if sparse and brick_size is not None:
+            raise ValueError("Sparse volumes can't be bricked.")
+
         self.volumes = []
         self.volumes_strides = []
+        self.volumes_shapes = []
+        self.indices = []
+        self.scales = []
+        self.offsets = []
+        self.neighborhood_directions = neighborhood_directions
+        self.sparse = sparse
+        self.storage_dtype = storage_dtype
+        self.brick_size = brick_size
 
     @property
     def data_dimension(self):
-        return self.volumes[0].get_value().shape[-1]
+        """ Size of the signal at a single position (i.e. without the stacked neighborhood). """
+        data_dimension = self.volumes[0].get_value(borrow=True).shape[-1]
+        if self.neighborhood_directions is not None:
+            data_dimension //= len(self.neighborhood_directions)
+
+        return data_dimension
+
+    @property
+    def shared_variables(self):
+        """ Every shared variable used by `eval_at_coords` (e.g. to be given as non_sequences to a scan). """
+        return self.volumes + [index for index in self.indices if index is not None]
+
+    def has_stacked_neighborhood(self, neighborhood_directions):
+        """ Tells if registered volumes already contain the signal at these `neighborhood_directions`. """
+        return (self.neighborhood_directions is not None and
+                np.shape(self.neighborhood_directions) == np.shape(neighborhood_directions) and
+                np.allclose(self.neighborhood_directions, neighborhood_directions))
 
     def register(self, volume):
+        import theano
+        from smartlearner.utils import sharedX
+
         volume_id = len(self.volumes)
-        shape = np.array(volume.shape[:-1], dtype=floatX)
+        data_dimension = volume.shape[-1]
+        if self.neighborhood_directions is not None:
+            volume = make_neighborhood_stacked_volume(volume, self.neighborhood_directions)
+
+        shape = np.array(volume.shape[:-1], dtype=theano.config.floatX)
         strides = np.r_[1, np.cumprod(shape[::-1])[:-1]][::-1]
         self.volumes_strides.append(strides)
-        self.volumes.append(sharedX(volume, name='volume_{}'.format(volume_id)))
+        self.volumes_shapes.append(tuple(int(size) for size in volume.shape[:-1]))
+
+        index = None
+        if self.sparse:
+            index, volume = make_sparse_volume(volume)
+            index = theano.shared(index, name='index_{}'.format(volume_id))
+        elif self.brick_size is not None:
+            volume = make_bricked_volume(volume, self.brick_size)
+
+        self.indices.append(index)
+
+        if self.storage_dtype == "float32":
+            self.volumes.append(sharedX(volume, name='volume_{}'.format(volume_id)))
+            self.scales.append(None)
+            self.offsets.append(None)
+        else:
+            volume, scale, offset = quantize_volume(volume, self.storage_dtype)
+            self.volumes.append(theano.shared(volume, name='volume_{}'.format(volume_id)))
+            self.scales.append(scale)
+            self.offsets.append(offset)
 
         # Sanity check: make sure the size of the last dimension is the same for all volumes.
-        assert self.data_dimension == volume.shape[-1]
+        assert self.data_dimension == data_dimension
         return volume_id
 
     def eval_at_coords(self, coords):
+        import theano
+        import theano.tensor as T
+
+        floatX = theano.config.floatX
         data_at_coords = T.zeros((coords.shape[0], self.volumes[0].shape[-1]))
-        for i, (volume, strides) in enumerate(zip(self.volumes, self.volumes_strides)):
+        for i, (volume, strides, index) in enumerate(zip(self.volumes, self.volumes_strides, self.indices)):
             selection = T.eq(coords[:, 3], i).nonzero()[0]  # Theano's way of doing: coords[:, 3] == i
             selected_coords = coords[selection, :3]
-            data_at_selected_coords = eval_volume_at_3d_coordinates_in_theano(volume, selected_coords, strides=strides)
+            data_at_selected_coords = eval_volume_at_3d_coordinates_in_theano(volume, selected_coords, strides=strides, index=index,
+                                                                              brick_size=self.brick_size, shape=self.volumes_shapes[i])
+            if self.scales[i] is not None:
+                # Trilinear interpolation is linear, dequantizing the interpolated values is the same as dequantizing every corner.
+                data_at_selected_coords = data_at_selected_coords * self.scales[i].astype(floatX) + self.offsets[i].astype(floatX)
+
             data_at_coords = T.set_subtensor(data_at_coords[selection], data_at_selected_coords)
 
         return data_at_coords
@@ -297,7 +378,7 @@ def map_coordinates_3d_4d(input_array, indices, affine=None, order=1):
         return np.ascontiguousarray(np.array(values_4d).T)
 
 
-def eval_volume_at_3d_coordinates(volume, coords):
+def eval_volume_at_3d_coordinates(volume, coords, index=None, brick_size=None, shape=None):
     """ Evaluates the volume data at the given coordinates using trilinear interpolation.
 
     Parameters
@@ -306,28 +387,213 @@ def eval_volume_at_3d_coordinates(volume, coords):
         Data volume.
     coords : ndarray of shape (N, 3)
         3D coordinates where to evaluate the volume data.
+    index : 3D array of int, optional
+        If specified, `volume` is a sparse volume, i.e. a 2D array whose rows are the data
+        of the voxels referenced by `index` (see `make_sparse_volume`).
+    brick_size : int, optional
+        If specified, `volume` is a bricked volume, i.e. a 2D array whose rows are the data of the
+        voxels stored brick by brick (see `make_bricked_volume`).
+    shape : tuple of int, optional
+        Shape of the volume before it was bricked, i.e. (X, Y, Z). Required if `brick_size` is specified.
 
     Returns
     -------
     output : 2D array
         Values from volume.
     """
+    if index is not None:
+        return _eval_flat_volume_at_3d_coordinates(volume, index.shape, lambda x, y, z: index[x, y, z], coords)
+
+    if brick_size is not None:
+        return _eval_flat_volume_at_3d_coordinates(volume, shape, lambda x, y, z: get_bricked_rows(x, y, z, shape, brick_size), coords)
 
     if volume.ndim <= 2 or volume.ndim >= 5:
         raise ValueError("Volume must be 3D or 4D!")
 
+    # Volumes stored with a reduced precision (e.g. float16 or int16) are interpolated in float32.
+    dtype = np.result_type(volume.dtype, np.float32)
     if volume.ndim == 3:
-        return map_coordinates(volume, coords.T, order=1, mode="nearest")
+        return map_coordinates(volume.astype(dtype, copy=False), coords.T, order=1, mode="nearest")
 
     if volume.ndim == 4:
         values_4d = []
         for i in range(volume.shape[-1]):
-            values_tmp = map_coordinates(volume[..., i],
+            values_tmp = map_coordinates(volume[..., i].astype(dtype, copy=False),
                                          coords.T, order=1, mode="nearest")
             values_4d.append(values_tmp)
         return np.ascontiguousarray(np.array(values_4d).T)
 
 
+def _eval_flat_volume_at_3d_coordinates(features, shape, get_rows, coords):
+    """ Trilinear interpolation of a volume whose voxels are stored as the rows of `features`.
+
+    Equivalent to `map_coordinates(..., order=1, mode="nearest")` on the original volume of shape `shape`,
+    `get_rows(x, y, z)` giving the rows of `features` containing the data of the voxels (x, y, z).
+    """
+    shape = np.array(shape)
+    coords = np.clip(coords, 0, shape - 1)
+    corners = np.minimum(np.floor(coords).astype(np.int32), shape - 2).clip(min=0)
+    d = coords - corners
+
+    values = np.zeros((len(coords), features.shape[-1]), dtype=np.result_type(features.dtype, np.float32))
+    for offset in np.ndindex(2, 2, 2):
+        voxels = np.minimum(corners + offset, shape - 1)
+        weights = np.prod(np.where(offset, d, 1 - d), axis=1)
+        values += weights[:, None] * features[get_rows(voxels[:, 0], voxels[:, 1], voxels[:, 2])]
+
+    return values
+
+
+def iter_streamlines_endpoints(filename, chunk_size=100000):
+    """ Streams the endpoints of the streamlines contained in a tractogram file.
+
+    The file is loaded lazily, so only `chunk_size` endpoints are kept in memory
+    at the same time instead of the whole tractogram.
+
+    Parameters
+    ----------
+    filename : str
+        Tractogram file (.trk|.tck).
+    chunk_size : int, optional
+        Number of streamlines to process before yielding their endpoints.
+
+    Yields
+    ------
+    starts : 2D array, shape (N, 3)
+        First point of the streamlines (in RAS+mm).
+    ends : 2D array, shape (N, 3)
+        Last point of the streamlines (in RAS+mm).
+    """
+    tractogram = nib.streamlines.load(filename, lazy_load=True).tractogram
+
+    starts, ends = [], []
+    for streamline in tractogram.streamlines:
+        if len(streamline) == 0:
+            continue
+
+        starts.append(streamline[0])
+        ends.append(streamline[-1])
+
+        if len(starts) >= chunk_size:
+            yield np.array(starts), np.array(ends)
+            starts, ends = [], []
+
+    if len(starts) > 0:
+        yield np.array(starts), np.array(ends)
+
+
+def _spread_bits_3d(x):
+    """ Inserts two zeros between each of the lowest 21 bits of `x`. """
+    x = x.astype(np.uint64) & np.uint64(0x1fffff)
+    x = (x | x << np.uint64(32)) & np.uint64(0x1f00000000ffff)
+    x = (x | x << np.uint64(16)) & np.uint64(0x1f0000ff0000ff)
+    x = (x | x << np.uint64(8)) & np.uint64(0x100f00f00f00f00f)
+    x = (x | x << np.uint64(4)) & np.uint64(0x10c30c30c30c30c3)
+    x = (x | x << np.uint64(2)) & np.uint64(0x1249249249249249)
+    return x
+
+
+def get_morton_keys(voxels):
+    """ Computes the Morton (Z-order) key of integer 3D coordinates.
+
+    Parameters
+    ----------
+    voxels : 2D array of int, shape (N, 3)
+        Non-negative voxel coordinates (up to 21 bits per axis).
+
+    Returns
+    -------
+    keys : 1D array of uint64
+    """
+    voxels = np.asarray(voxels)
+    return _spread_bits_3d(voxels[:, 0]) << np.uint64(2) | _spread_bits_3d(voxels[:, 1]) << np.uint64(1) | _spread_bits_3d(voxels[:, 2])
+
+
+def get_hilbert_keys(voxels):
+    """ Computes the Hilbert key of integer 3D coordinates.
+
+    Parameters
+    ----------
+    voxels : 2D array of int, shape (N, 3)
+        Non-negative voxel coordinates (up to 21 bits per axis).
+
+    Returns
+    -------
+    keys : 1D array of uint64
+
+    Notes
+    -----
+    Vectorized version of Skilling (2004), "Programming the Hilbert curve".
+    """
+    voxels = np.asarray(voxels)
+    nb_bits = max(int(voxels.max()).bit_length(), 1) if len(voxels) > 0 else 1
+    X = [voxels[:, i].astype(np.uint64) for i in range(3)]
+
+    # Inverse undo excess work.
+    Q = 1 << (nb_bits - 1)
+    while Q > 1:
+        P = np.uint64(Q - 1)
+        for i in range(3):
+            is_set = (X[i] & np.uint64(Q)) != 0
+            t = (X[0] ^ X[i]) & P
+            new_X0 = np.where(is_set, X[0] ^ P, X[0] ^ t)
+            if i > 0:
+                X[i] = np.where(is_set, X[i], X[i] ^ t)
+            X[0] = new_X0
+        Q >>= 1
+
+    # Gray encode.
+    X[1] ^= X[0]
+    X[2] ^= X[1]
+    t = np.zeros_like(X[0])
+    Q = 1 << (nb_bits - 1)
+    while Q > 1:
+        t = np.where((X[2] & np.uint64(Q)) != 0, t ^ np.uint64(Q - 1), t)
+        Q >>= 1
+
+    # Interleave the transposed representation into a single key.
+    keys = np.zeros_like(X[0])
+    for bit in range(nb_bits - 1, -1, -1):
+        for i in range(3):
+            keys = keys << np.uint64(1) | ((X[i] ^ t) >> np.uint64(bit)) & np.uint64(1)
+
+    return keys
+
+
+def get_space_filling_curve_order(coords, curve="hilbert"):
+    """ Gets the ordering of 3D coordinates along a space-filling curve.
+
+    Points that are close on the curve are close in space, so processing them
+    in that order improves memory locality when sampling a volume.
+
+    Parameters
+    ----------
+    coords : 2D array, shape (N, 3)
+        Coordinates in voxel space.
+    curve : {'morton', 'hilbert'}
+        Space-filling curve to use.
+
+    Returns
+    -------
+    indices : 1D array of int
+        Indices that would sort `coords` along the curve.
+    """
+    coords = np.asarray(coords)
+    if len(coords) == 0:
+        return np.zeros(0, dtype=int)
+
+    voxels = np.floor(coords - coords.min(axis=0)).astype(np.int64)
+
+    if curve == "morton":
+        keys = get_morton_keys(voxels)
+    elif curve == "hilbert":
+        keys = get_hilbert_keys(voxels)
+    else:
+        raise ValueError("Unknown space-filling curve: {}".format(curve))
+
+    return np.argsort(keys, kind="stable")
+
+
 def normalize_dwi(weights, b0):
     """ Normalize dwi by the first b0.
 
@@ -359,8 +625,11 @@ def normalize_dwi(weights, b0):
     return weights_normed
 
 
-def get_spherical_harmonics_coefficients(dwi, bvals, bvecs, sh_order=8, smooth=0.006, first=False, mean_centering=True):
-    """ Compute coefficients of the spherical harmonics basis.
+def _project_dwi(dwi, bvals, projection, mask=None, mean_centering=True, chunk_size=2**16, nb_threads=None):
+    """ Normalizes the diffusion weights by the b0 and projects them using `projection`, one slab of voxels at a time.
+
+    Only voxels inside `mask` are processed, the others are left to zero. Slabs are processed in a pool
+    of threads and written directly into the output, so temporaries are bounded by the size of a slab.
 
     Parameters
     -----------
@@ -368,55 +637,130 @@ def get_spherical_harmonics_coefficients(dwi, bvals, bvecs, sh_order=8, smooth=0
         Diffusion signal as weighted images (4D).
     bvals : ndarray shape (N,)
         B-values used with each direction.
-    bvecs : ndarray shape (N, 3)
-        Directions of the diffusion signal. Directions are
-        assumed to be only on the hemisphere.
-    sh_order : int, optional
-        SH order. Default: 8
-    smooth : float, optional
-        Lambda-regularization in the SH fit. Default: 0.006.
+    projection : ndarray of shape (#non-b0 directions, C)
+        Linear map applied to the normalized diffusion weights of every voxel.
+    mask : ndarray of shape (X, Y, Z), optional
+        Voxels to process. Default: voxels with a positive b0 (others would be zero anyway).
     mean_centering : bool
-        If True, signal will have zero mean in each direction for all nonzero voxels
+        If True, output will have zero mean in each channel for all nonzero voxels
+    chunk_size : int, optional
+        Approximate number of voxels in a slab. Default: 65536
+    nb_threads : int, optional
+        Number of threads. Default: see `concurrent.futures.ThreadPoolExecutor`.
 
     Returns
     -------
-    sh_coeffs : ndarray of shape (X, Y, Z, #coeffs)
-        Spherical harmonics coefficients at every voxel. The actual number of
-        coeffs depends on `sh_order`.
+    ndarray of shape (X, Y, Z, C)
+        Projected diffusion weights (float32).
     """
-    bvals = np.asarray(bvals)
-    bvecs = np.asarray(bvecs)
-    dwi_weights = dwi.get_data().astype("float32")
+    data = dwi.get_data()
+    b0_idx = np.asarray(bvals) == 0
+    dwi_idx = np.logical_not(b0_idx)
+
+    shape = data.shape[:3]
+    slab_size = max(1, chunk_size // int(np.prod(shape[1:])))
+    slabs = [slice(start, min(start + slab_size, shape[0])) for start in range(0, shape[0], slab_size)]
+
+    output = np.zeros(shape + (projection.shape[1],), dtype=np.float32)
+    nonzero = np.zeros(shape, dtype=bool)
+
+    def _process(slab):
+        data_slab = data[slab]
+        mask_slab = data_slab[..., b0_idx].mean(axis=3) > 0 if mask is None else np.asarray(mask[slab], dtype=bool)
+        weights = data_slab[mask_slab].astype(np.float32)
+
+        # Extract the averaged b0 and the diffusion weights.
+        b0 = weights[:, b0_idx].mean(axis=1)[:, None]
+        weights = weights[:, dwi_idx]
 
-    # Exract the averaged b0.
-    b0_idx = bvals == 0
-    b0 = dwi_weights[..., b0_idx].mean(axis=3)
+        # Make sure in every voxels weights are lower than ones from the b0 (see `normalize_dwi`).
+        nb_erroneous_voxels = np.sum(weights > b0)
+        np.minimum(weights, b0, out=weights)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights /= b0
 
-    # Extract diffusion weights and normalize by the b0.
-    bvecs = bvecs[np.logical_not(b0_idx)]
-    weights = dwi_weights[..., np.logical_not(b0_idx)]
-    weights = normalize_dwi(weights, b0)
+        weights[np.logical_not(np.isfinite(weights))] = 0.
+
+        projected = np.dot(weights, projection)
+        output[slab][mask_slab] = projected
+
+        nonzero_slab = projected.sum(axis=-1) != 0
+        nonzero[slab][mask_slab] = nonzero_slab
+        return nb_erroneous_voxels, projected[nonzero_slab].sum(axis=0), np.sum(nonzero_slab)
+
+    with ThreadPoolExecutor(max_workers=nb_threads) as executor:
+        results = list(executor.map(_process, slabs))
+
+        nb_erroneous_voxels = sum(result[0] for result in results)
+        if nb_erroneous_voxels != 0:
+            print ("Nb. erroneous voxels: {}".format(nb_erroneous_voxels))
+
+        if mean_centering:
+            # Normalization in each direction (zero mean)
+            means = sum(result[1] for result in results) / max(sum(result[2] for result in results), 1)
+
+            def _center(slab):
+                output_slab = output[slab]
+                output_slab[nonzero[slab]] -= means
+
+            list(executor.map(_center, slabs))
+
+    return output
+
+
+def _get_sh_fitting_matrix(bvals, bvecs, sh_order=8, smooth=0.006):
+    """ Matrix fitting SH coefficients to the (normalized) diffusion weights, i.e. weights.dot(matrix). """
+    bvals = np.asarray(bvals)
+    bvecs = np.asarray(bvecs)
 
     # Assuming all directions are on the hemisphere.
-    raw_sphere = HemiSphere(xyz=bvecs)
+    raw_sphere = HemiSphere(xyz=bvecs[bvals != 0])
 
-    # Fit SH to signal
     sph_harm_basis = sph_harm_lookup.get('mrtrix')
     Ba, m, n = sph_harm_basis(sh_order, raw_sphere.theta, raw_sphere.phi)
     L = -n * (n + 1)
     invB = smooth_pinv(Ba, np.sqrt(smooth) * L)
-    data_sh = np.dot(weights, invB.T)
+    return invB.T
+
+
+def get_spherical_harmonics_coefficients(dwi, bvals, bvecs, sh_order=8, smooth=0.006, first=False, mean_centering=True,
+                                         mask=None, chunk_size=2**16, nb_threads=None):
+    """ Compute coefficients of the spherical harmonics basis.
 
-    if mean_centering:
-        # Normalization in each direction (zero mean)
-        idx = data_sh.sum(axis=-1).nonzero()
-        means = data_sh[idx].mean(axis=0)
-        data_sh[idx] -= means
+    Parameters
+    -----------
+    dwi : `nibabel.NiftiImage` object
+        Diffusion signal as weighted images (4D).
+    bvals : ndarray shape (N,)
+        B-values used with each direction.
+    bvecs : ndarray shape (N, 3)
+        Directions of the diffusion signal. Directions are
+        assumed to be only on the hemisphere.
+    sh_order : int, optional
+        SH order. Default: 8
+    smooth : float, optional
+        Lambda-regularization in the SH fit. Default: 0.006.
+    mean_centering : bool
+        If True, signal will have zero mean in each direction for all nonzero voxels
+    mask : ndarray of shape (X, Y, Z), optional
+        Brain mask, coefficients outside of it are zero. Default: voxels with a positive b0.
+    chunk_size : int, optional
+        Approximate number of voxels processed at once. Default: 65536
+    nb_threads : int, optional
+        Number of threads. Default: see `concurrent.futures.ThreadPoolExecutor`.
 
-    return data_sh
+    Returns
+    -------
+    sh_coeffs : ndarray of shape (X, Y, Z, #coeffs)
+        Spherical harmonics coefficients at every voxel (float32). The actual number of
+        coeffs depends on `sh_order`.
+    """
+    fitting_matrix = _get_sh_fitting_matrix(bvals, bvecs, sh_order=sh_order, smooth=smooth)
+    return _project_dwi(dwi, bvals, fitting_matrix, mask=mask, mean_centering=mean_centering, chunk_size=chunk_size, nb_threads=nb_threads)
 
 
-def resample_dwi(dwi, bvals, bvecs, directions=None, sh_order=8, smooth=0.006, mean_centering=True):
+def resample_dwi(dwi, bvals, bvecs, directions=None, sh_order=8, smooth=0.006, mean_centering=True,
+                 mask=None, chunk_size=2**16, nb_threads=None):
     """ Resamples a diffusion signal according to a set of directions using spherical harmonics.
 
     Parameters
@@ -438,14 +782,18 @@ def resample_dwi(dwi, bvals, bvecs, directions=None, sh_order=8, smooth=0.006, m
         Lambda-regularization in the SH fit. Default: 0.006.
     mean_centering : bool
         If True, signal will have zero mean in each direction for all nonzero voxels
+    mask : ndarray of shape (X, Y, Z), optional
+        Brain mask, resampled signal outside of it is zero. Default: voxels with a positive b0.
+    chunk_size : int, optional
+        Approximate number of voxels processed at once. Default: 65536
+    nb_threads : int, optional
+        Number of threads. Default: see `concurrent.futures.ThreadPoolExecutor`.
 
     Returns
     -------
     ndarray
-        Diffusion weights resampled according to `sphere`.
+        Diffusion weights resampled according to `sphere` (float32).
     """
-    data_sh = get_spherical_harmonics_coefficients(dwi, bvals, bvecs, sh_order=sh_order, smooth=smooth, mean_centering=False)
-
     sphere = get_sphere('repulsion100')
     # sphere = get_sphere('repulsion724')
     if directions is not None:
@@ -453,19 +801,29 @@ def resample_dwi(dwi, bvals, bvecs, directions=None, sh_order=8, smooth=0.006, m
 
     sph_harm_basis = sph_harm_lookup.get('mrtrix')
     Ba, m, n = sph_harm_basis(sh_order, sphere.theta, sphere.phi)
-    data_resampled = np.dot(data_sh, Ba.T)
 
-    if mean_centering:
-        # Normalization in each direction (zero mean)
-        idx = data_resampled.sum(axis=-1).nonzero()
-        means = data_resampled[idx].mean(axis=0)
-        data_resampled[idx] -= means
+    # Fitting the SH coefficients and evaluating them on the sphere is done in a single projection.
+    fitting_matrix = _get_sh_fitting_matrix(bvals, bvecs, sh_order=sh_order, smooth=smooth)
+    return _project_dwi(dwi, bvals, np.dot(fitting_matrix, Ba.T), mask=mask, mean_centering=mean_centering,
+                        chunk_size=chunk_size, nb_threads=nb_threads)
+
+
+def _get_similar_streamlines_candidates_features(points):
+    """ Computes, for 10-point streamlines, the mean of each half of their points (and of their flipped points).
+
+    For two streamlines, the euclidean distance between these 6D features is at most twice their MDF distance.
+    """
+    halves = np.concatenate([points[:, :5].mean(axis=1), points[:, 5:].mean(axis=1)], axis=1)
+    return halves, halves[:, [3, 4, 5, 0, 1, 2]]
 
-    return data_resampled
 
+def remove_similar_streamlines(streamlines, removal_distance=2., chunk_size=1000):
+    """ Removes streamlines closer than `removal_distance` to a previous (kept) streamline.
 
-def remove_similar_streamlines(streamlines, removal_distance=2.):
-    """ Computes a distance matrix using all streamlines, then removes streamlines closer than `removal_distance`.
+    Streamlines are processed in order: a streamline is kept, then every following streamline closer than
+    `removal_distance` to it (MDF distance, using 10 points) is removed. Candidates are found using a KD-tree
+    indexing the mean of each half of the streamlines (which gives a lower bound of the MDF distance), so
+    that the distance matrix is never computed.
 
     Parameters
     -----------
@@ -473,40 +831,47 @@ def remove_similar_streamlines(streamlines, removal_distance=2.):
         Streamlines to downsample
     removal_distance : float
         Distance for which streamlines are considered 'similar' and should be removed
+    chunk_size : int, optional
+        Number of streamlines whose candidates are looked up at the same time. Default: 1000
 
     Returns
     -------
-    `ArraySequence` object
+    list of 3D arrays
         Downsampled streamlines
     """
     # Simple trick to make it faster than using 40-60 points
-    sample_10_streamlines = set_number_of_points(streamlines, 10)
-    distance_matrix = distance_matrix_mdf(sample_10_streamlines, sample_10_streamlines)
-
-    current_id = 0
-    while True:
-        indices = np.where(distance_matrix[current_id] < removal_distance)[0]
-
-        it = 0
-        if len(indices) > 1:
-            for k in indices:
-                # Every streamlines similar to yourself (excluding yourself)
-                # should be deleted from the set of desired streamlines
-                if not current_id == k:
-                    streamlines.pop(k - it)
-                    distance_matrix = np.delete(distance_matrix, k - it, axis=0)
-                    distance_matrix = np.delete(distance_matrix, k - it, axis=1)
-                    it += 1
-
-        current_id += 1
-        # Once you reach the end of the remaining streamlines
-        if current_id >= len(streamlines):
-            break
-
-    return streamlines
-
-
-def subsample_streamlines(streamlines, clustering_threshold=6., removal_distance=2.):
+    points = np.asarray(set_number_of_points(streamlines, 10), dtype=np.float64).reshape((-1, 10, 3))
+    features, flipped_features = _get_similar_streamlines_candidates_features(points)
+    tree = cKDTree(features)
+    radius = 2 * removal_distance * (1 + 1e-6)  # Small margin for rounding errors.
+
+    removed = np.zeros(len(points), dtype=bool)
+    for start in range(0, len(points), chunk_size):
+        ids = np.arange(start, min(start + chunk_size, len(points)))
+        ids = ids[~removed[ids]]
+        if len(ids) == 0:
+            continue
+
+        candidates = tree.query_ball_point(np.concatenate([features[ids], flipped_features[ids]]), radius)
+        for i, (direct_candidates, flipped_candidates) in zip(ids, zip(candidates[:len(ids)], candidates[len(ids):])):
+            if removed[i]:
+                continue  # Removed by a streamline of the current chunk.
+
+            # Previous kept streamlines are never similar, they would have removed this one.
+            neighbors = np.unique(np.array(direct_candidates + flipped_candidates, dtype=np.intp))
+            neighbors = neighbors[neighbors > i]
+            neighbors = neighbors[~removed[neighbors]]
+            if len(neighbors) == 0:
+                continue
+
+            direct = np.mean(np.sqrt(np.sum((points[neighbors] - points[i]) ** 2, axis=2)), axis=1)
+            flipped = np.mean(np.sqrt(np.sum((points[neighbors, ::-1] - points[i]) ** 2, axis=2)), axis=1)
+            removed[neighbors[np.minimum(direct, flipped) < removal_distance]] = True
+
+    return [streamlines[i] for i in np.flatnonzero(~removed)]
+
+
+def subsample_streamlines(streamlines, clustering_threshold=6., removal_distance=2., nb_processes=1):
     """ Subsample a group of streamlines (should be used on streamlines from a single bundle or similar structure).
     Streamlines are first clustered using `clustering_threshold`, then for each cluster, similar streamlines (closer than `removal_distance`) are removed.
 
@@ -518,6 +883,9 @@ def subsample_streamlines(streamlines, clustering_threshold=6., removal_distance
         distance threshold for clustering (in the space of the tracks)
     removal_distance : float
         distance threshold for removal (in the space of the tracks)
+    nb_processes : int, optional
+        Number of processes used to process the clusters. Default: 1
+
     Returns
     -------
     `ArraySequence` object
@@ -527,13 +895,168 @@ def subsample_streamlines(streamlines, clustering_threshold=6., removal_distance
     output_streamlines = []
 
     qb = QuickBundles(streamlines, dist_thr=clustering_threshold, pts=20)
-    for i in range(len(qb.centroids)):
-        temp_streamlines = qb.label2tracks(streamlines, i)
-        output_streamlines.extend(remove_similar_streamlines(temp_streamlines, removal_distance=removal_distance))
+    clusters = [qb.label2tracks(streamlines, i) for i in range(len(qb.centroids))]
+    if nb_processes > 1:
+        with ProcessPoolExecutor(max_workers=nb_processes) as executor:
+            # Biggest clusters first, so the processes finish at about the same time.
+            futures = {i: executor.submit(remove_similar_streamlines, clusters[i], removal_distance)
+                       for i in sorted(range(len(clusters)), key=lambda i: -len(clusters[i]))}
+            for i in range(len(clusters)):
+                output_streamlines.extend(futures[i].result())
+    else:
+        for cluster in clusters:
+            output_streamlines.extend(remove_similar_streamlines(cluster, removal_distance=removal_distance))
 
     return output_streamlines
 
 
+def make_neighborhood_stacked_volume(volume, directions):
+    """ Concatenates, along the last axis, copies of `volume` shifted along each direction.
+
+    Evaluating the resulting volume at a coordinate gives the signal at every neighbor
+    position (in the order of `directions`) with a single trilinear interpolation.
+
+    Parameters
+    ----------
+    volume : 4D array
+        Data volume.
+    directions : ndarray of shape (n_directions, 3)
+        Offsets of the neighbors (in voxel space), e.g. from `get_neighborhood_directions`.
+
+    Returns
+    -------
+    stacked_volume : 4D array with shape volume.shape[:3] + (n_directions * volume.shape[-1],)
+
+    Notes
+    -----
+    Shifts that are not a whole number of voxels are resampled with trilinear interpolation,
+    so interpolating the stacked volume is then only an approximation of interpolating the
+    original volume at the neighbor positions.
+    """
+    shifted_volumes = []
+    for direction in directions:
+        if not np.any(direction):
+            shifted_volumes.append(volume)
+            continue
+
+        # shifted_volume[x] = volume[x + direction]
+        shifted_volumes.append(shift(volume, np.r_[-np.asarray(direction), 0], order=1, mode="nearest"))
+
+    return np.concatenate(shifted_volumes, axis=-1)
+
+
+def make_sparse_volume(volume):
+    """ Keeps only the data of the brain voxels of a 4D volume.
+
+    Brain voxels are the ones having at least one nonzero value. Their data are stored
+    contiguously as the rows of a feature matrix and referenced by a dense index volume.
+    Background voxels all reference the first row, which is filled with zeros, so that
+    interpolating the sparse volume gives exactly the same values as the dense one.
+
+    Parameters
+    ----------
+    volume : 4D array
+        Data volume.
+
+    Returns
+    -------
+    index : 3D array of int32 with shape volume.shape[:3]
+        Row of `features` containing the data of each voxel.
+    features : 2D array with shape (n_brain_voxels + 1, volume.shape[-1])
+        Data of the background (first row) and of the brain voxels.
+    """
+    brain = np.any(volume != 0, axis=-1)
+    index = np.zeros(brain.shape, dtype=np.int32)
+    index[brain] = np.arange(1, brain.sum() + 1, dtype=np.int32)
+
+    features = np.zeros((len(index[brain]) + 1, volume.shape[-1]), dtype=volume.dtype)
+    features[1:] = volume[brain]
+    return index, features
+
+
+def make_bricked_volume(volume, brick_size=4):
+    """ Stores a 4D volume brick by brick, to improve the locality of the trilinear interpolation.
+
+    In C order, the 8 corners of a trilinear interpolation are spread over two whole y-z planes.
+    Here, the volume is split into cubic bricks of `brick_size`**3 voxels which are stored one
+    after the other (voxels in a brick and bricks themselves being in C order), channels being
+    innermost. Most interpolations then only touch a few kilobytes of contiguous memory.
+    Use `learn2track.interpolation.get_bricked_rows` to find the row of a voxel.
+
+    Parameters
+    ----------
+    volume : 4D array
+        Data volume.
+    brick_size : int, optional
+        Size of the bricks along each axis. Default: 4
+
+    Returns
+    -------
+    bricked_volume : 2D array with shape (n_bricks * brick_size**3, volume.shape[-1])
+        Data of the voxels, the volume being zero-padded so every axis is a multiple of `brick_size`.
+    """
+    nb_bricks = [-(-size // brick_size) for size in volume.shape[:3]]
+    padded = np.zeros([n * brick_size for n in nb_bricks] + [volume.shape[-1]], dtype=volume.dtype)
+    padded[:volume.shape[0], :volume.shape[1], :volume.shape[2]] = volume
+
+    # Axes are (brick_x, x, brick_y, y, brick_z, z, channel), putting the brick axes first.
+    bricked = padded.reshape((nb_bricks[0], brick_size, nb_bricks[1], brick_size, nb_bricks[2], brick_size, -1))
+    bricked = bricked.transpose((0, 2, 4, 1, 3, 5, 6))
+    return np.ascontiguousarray(bricked).reshape((-1, volume.shape[-1]))
+
+
+def quantize_volume(volume, dtype):
+    """ Converts a volume to a type using less memory.
+
+    Values are either cast to float16, or linearly mapped to int16 using a scale and an offset
+    per channel (i.e. last axis) so that the whole range of each channel is used.
+    The original values are approximately `quantized * scale + offset`.
+
+    Parameters
+    ----------
+    volume : ndarray
+        Data volume (or sparse volume), channels are along the last axis.
+    dtype : {'float32', 'float16', 'int16'}
+        Type of the quantized volume.
+
+    Returns
+    -------
+    quantized : ndarray of `dtype`
+    scale : 1D array of float32 or None
+        Scale of each channel, None unless `dtype` is int16.
+    offset : 1D array of float32 or None
+        Offset of each channel, None unless `dtype` is int16.
+    """
+    if dtype in ("float32", "float16"):
+        return volume.astype(dtype), None, None
+
+    if dtype != "int16":
+        raise ValueError("Unknown storage dtype: {} (choices: {})".format(dtype, ", ".join(STORAGE_DTYPES)))
+
+    channels = volume.reshape((-1, volume.shape[-1]))
+    low, high = channels.min(axis=0).astype(np.float64), channels.max(axis=0).astype(np.float64)
+    max_code = np.iinfo(np.int16).max
+    offset = (high + low) / 2
+    scale = (high - low) / (2 * max_code)
+    scale[scale == 0] = 1  # Constant channels.
+
+    quantized = np.empty(volume.shape, dtype=np.int16)
+    for i in range(len(volume)):  # One slab at a time, to limit the size of the temporary arrays.
+        np.clip(np.round((volume[i] - offset) / scale), -max_code, max_code, out=quantized[i], casting="unsafe")
+
+    return quantized, scale.astype(np.float32), offset.astype(np.float32)
+
+
+def dequantize_volume(quantized, scale=None, offset=None):
+    """ Converts back a volume quantized with `quantize_volume` to float32. """
+    volume = quantized.astype(np.float32)
+    if scale is not None:
+        volume *= scale
+        volume += offset
+
+    return volume
+
+
 def get_neighborhood_directions(radius):
     """ Returns predefined neighborhood directions at exactly `radius` length
         For now: Use the 6 main axes as neighbors directions, plus (0,0,0) to keep current position
@@ -0,0 +1,174 @@
+import os
+import cProfile
+import json
+from collections import OrderedDict
+from os.path import join as pjoin
+from time import time
+
+from smartlearner import tasks
+
+TASK_HOOKS = ["init", "pre_epoch", "pre_update", "post_update", "post_epoch", "finished"]
+PROFILERS = ["cprofile", "pyinstrument"]
+
+
+class TrainingProfiler(object):
+    """ Breaks down the time spent in the training loop.
+
+    Every epoch, the time spent in each of the following phases is saved in
+    `savedir/epoch_XXXXX.json`:
+
+    - prepare_batch: building the batches (i.e. `batch_scheduler._prepare_batch`),
+    - transfer: copying the batches to the shared variables (i.e. `set_value`),
+    - tasks: each task appended to the trainer (views they trigger are included),
+    - step: the rest, i.e. the compiled optimizer step (and the overhead of the training loop).
+
+    Optionally, a range of updates can be captured with a Python profiler.
+
+    Parameters
+    ----------
+    savedir : str
+        Folder where the reports and the captures are saved.
+    profile_updates : tuple of int, optional
+        If specified, updates from `profile_updates[0]` to `profile_updates[1]`
+        (inclusively, starting at 1) are captured with a Python profiler.
+    profiler : {'cprofile', 'pyinstrument'}, optional
+        Python profiler to use for the capture. Default: 'cprofile'
+    """
+    def __init__(self, savedir, profile_updates=None, profiler="cprofile"):
+        if profiler not in PROFILERS:
+            raise ValueError("Unknown profiler: {} (choices: {})".format(profiler, ", ".join(PROFILERS)))
+
+        self.savedir = savedir
+        self.profile_updates = profile_updates
+        self.profiler = profiler
+        self._capture = None
+
+        if profile_updates is not None and profiler == "pyinstrument":
+            import pyinstrument  # Fail early if it isn't installed.
+
+        os.makedirs(self.savedir, exist_ok=True)
+        self._own_tasks = [tasks.Callback(self._on_update, each_k_update=1),
+                           tasks.Callback(self._on_epoch)]
+        self._epoch_start = None
+        self._reset()
+
+    def _reset(self):
+        self._nb_updates = 0
+        self.phases = OrderedDict([("prepare_batch", 0.), ("transfer", 0.)])
+        self.tasks = OrderedDict()
+
+    def _timed(self, func, record):
+        def _wrapped(*args, **kwargs):
+            self._start_clock()
+            start = time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(time() - start)
+
+        return _wrapped
+
+    def _add_phase(self, name):
+        def _record(elapsed):
+            self.phases[name] += elapsed
+
+        return _record
+
+    def _add_task(self, name):
+        def _record(elapsed):
+            self.tasks[name] = self.tasks.get(name, 0.) + elapsed
+
+        return _record
+
+    def _start_clock(self):
+        if self._epoch_start is None:
+            # Only start when training actually starts (i.e. after compilation).
+            self._epoch_start = time()
+            if self.profile_updates is not None and self.profile_updates[0] <= 1:
+                self._start_capture()
+
+    def instrument(self, trainer, batch_scheduler):
+        """ Instruments the batch scheduler and every task appended to the trainer from now on. """
+        if hasattr(batch_scheduler, "_prepare_batch"):
+            batch_scheduler._prepare_batch = self._timed(batch_scheduler._prepare_batch, self._add_phase("prepare_batch"))
+
+        for shared_variable in batch_scheduler.givens.values():
+            if hasattr(shared_variable, "set_value"):
+                shared_variable.set_value = self._timed(shared_variable.set_value, self._add_phase("transfer"))
+
+        append_task = trainer.append_task
+        nb_tasks = [0]
+
+        def _append_task(task):
+            if all(task is not own_task for own_task in self._own_tasks):
+                nb_tasks[0] += 1
+                self._instrument_task(task, "{:02d}_{}".format(nb_tasks[0], type(task).__name__))
+
+            return append_task(task)
+
+        trainer.append_task = _append_task
+
+    def _instrument_task(self, task, name):
+        for hook in TASK_HOOKS:
+            if hasattr(task, hook):
+                setattr(task, hook, self._timed(getattr(task, hook), self._add_task(name)))
+
+    def append_tasks(self, trainer):
+        """ Appends the tasks writing the reports. It should be done after all other tasks are appended. """
+        for task in self._own_tasks:
+            trainer.append_task(task)
+
+    def _start_capture(self):
+        if self.profiler == "pyinstrument":
+            from pyinstrument import Profiler
+            self._capture = Profiler()
+            self._capture.start()
+        else:
+            self._capture = cProfile.Profile()
+            self._capture.enable()
+
+    def _stop_capture(self):
+        filename = pjoin(self.savedir, "updates_{}-{}".format(*self.profile_updates))
+        if self.profiler == "pyinstrument":
+            self._capture.stop()
+            with open(filename + ".html", "w") as f:
+                f.write(self._capture.output_html())
+        else:
+            self._capture.disable()
+            self._capture.dump_stats(filename + ".prof")
+
+        print("Profile of updates {}-{} saved in {}".format(self.profile_updates[0], self.profile_updates[1], self.savedir))
+        self._capture = None
+
+    def _on_update(self, obj, status):
+        self._nb_updates += 1
+        if self.profile_updates is None:
+            return
+
+        if status.current_update == self.profile_updates[0] - 1 and self._capture is None:
+            self._start_capture()
+        elif status.current_update == self.profile_updates[1] and self._capture is not None:
+            self._stop_capture()
+
+    def _on_epoch(self, obj, status):
+        wall_time = time() - self._epoch_start
+        nb_updates = self._nb_updates
+        tasks_time = sum(self.tasks.values())
+        phases = OrderedDict(self.phases)
+        phases["step"] = wall_time - sum(self.phases.values()) - tasks_time
+        phases["tasks"] = tasks_time
+
+        report = OrderedDict([("epoch", status.current_epoch),
+                              ("nb_updates", nb_updates),
+                              ("wall_time", wall_time),
+                              ("phases", phases),
+                              ("tasks", self.tasks),
+                              ("per_update", OrderedDict((k, v / max(nb_updates, 1)) for k, v in phases.items()))])
+
+        with open(pjoin(self.savedir, "epoch_{:05d}.json".format(status.current_epoch)), "w") as f:
+            json.dump(report, f, indent=2)
+
+        print("Profile: " + " | ".join("{}: {:.2f}s ({:.0%})".format(k, v, v / wall_time) for k, v in phases.items()))
+
+        self._epoch_start = time()
+        self._reset()
@@ -1,8 +1,12 @@
+import sys
 import numpy as np
+from collections import OrderedDict
 from os.path import join as pjoin
 
 import theano
+import theano.tensor as T
 
+from smartlearner import views
 from smartlearner.interfaces import RecurrentTask
 import smartlearner.utils as smartutils
 
@@ -25,3 +29,119 @@ class DecayingVariable(RecurrentTask):
     def load(self, path):
         state = smartutils.load_dict_from_json_file(pjoin(path, type(self).__name__ + ".json"))
         self.var.set_value(state["var"])
+
+
+def _count_nonfinite(x):
+    return T.sum(T.or_(T.isnan(x), T.isinf(x)))
+
+
+class HealthMonitor(RecurrentTask):
+    """ Monitors the numerical health of the training.
+
+    Cheap statistics are computed inside the training graph and only a small
+    vector is brought back to the host after every update: the number of
+    non-finite values in the loss and in the gradients, and the gradient norm
+    of every layer. Training is stopped as soon as a non-finite value shows up.
+
+    Every `report_every` updates, the norm of the parameters of every layer and
+    their update ratio (i.e. norm of the change since the last report over the
+    norm of the parameters) are computed on the device, using a copy of the
+    parameters taken at the last report, and a summary is printed.
+
+    Parameters
+    ----------
+    loss : `smartlearner.interfaces.Loss` object
+        Training loss, its gradients are monitored.
+    report_every : int, optional
+        Number of updates between two reports. Default: 100
+    """
+    def __init__(self, loss, report_every=100):
+        super().__init__(each_k_update=1)
+        self.report_every = report_every
+
+        # Parameters are grouped per layer using their name (e.g. 'GRU0_W' -> 'GRU0').
+        self.layers = OrderedDict()
+        for param in loss.gradients.keys():
+            self.layers.setdefault(str(param.name).rsplit('_', 1)[0], []).append(param)
+
+        floatX = theano.config.floatX
+        gradients = loss.gradients
+        stats = [_count_nonfinite(loss.loss), sum(_count_nonfinite(g) for g in gradients.values())]
+        stats += [T.sqrt(sum(T.sqr(gradients[param]).sum() for param in params)) for params in self.layers.values()]
+        self._monitor = views.MonitorVariable(T.stack([T.cast(stat, floatX) for stat in stats]))
+        self.updates.update(self._monitor.updates)  # So the statistics are computed by the training function.
+
+        params = [param for params in self.layers.values() for param in params]
+        self._snapshots = OrderedDict((param, smartutils.sharedX(param.get_value(), name=param.name + "_snapshot")) for param in params)
+        params_stats = [sum(_count_nonfinite(param) for param in params)]
+        for params in self.layers.values():
+            norm = T.sqrt(sum(T.sqr(param).sum() for param in params))
+            change = T.sqrt(sum(T.sqr(param - self._snapshots[param]).sum() for param in params))
+            params_stats += [norm, change / (norm + 1e-8)]
+
+        self._compute_params_stats = theano.function([],
+                                                     T.stack([T.cast(stat, floatX) for stat in params_stats]),
+                                                     updates=[(snapshot, param) for param, snapshot in self._snapshots.items()],
+                                                     name="compute_params_health")
+        self._snapshot_taken = False
+        self.history = []
+        self._reset_window()
+
+    def _reset_window(self):
+        self._nb_updates = 0
+        self._sum_grad_norms = np.zeros(len(self.layers))
+        self._max_grad_norms = np.zeros(len(self.layers))
+
+    def execute(self, status):
+        if not self._snapshot_taken:
+            # Parameters might have been reloaded since this task was created.
+            self._compute_params_stats()
+            self._snapshot_taken = True
+
+        stats = self._monitor.view(status)
+        nb_nonfinite_loss, nb_nonfinite_grads, grad_norms = int(stats[0]), int(stats[1]), stats[2:]
+        if nb_nonfinite_loss > 0 or nb_nonfinite_grads > 0:
+            print("NaN/Inf detected at update {} (loss: {}, gradients: {})! Stopping training now.".format(
+                status.current_update, nb_nonfinite_loss, nb_nonfinite_grads))
+            for name, grad_norm in zip(self.layers, grad_norms):
+                print("  {}: ||g||={}".format(name, grad_norm))
+
+            sys.exit()
+
+        self._nb_updates += 1
+        self._sum_grad_norms += grad_norms
+        self._max_grad_norms = np.maximum(self._max_grad_norms, grad_norms)
+
+        if self._nb_updates < self.report_every:
+            return
+
+        params_stats = self._compute_params_stats()
+        nb_nonfinite_params, params_norms, update_ratios = int(params_stats[0]), params_stats[1::2], params_stats[2::2]
+        report = {'update': int(status.current_update),
+                  'nb_nonfinite_params': nb_nonfinite_params,
+                  'layers': OrderedDict()}
+
+        print("Health (updates {}-{}):".format(status.current_update - self._nb_updates + 1, status.current_update))
+        for i, name in enumerate(self.layers):
+            layer = {'param_norm': float(params_norms[i]),
+                     'update_ratio': float(update_ratios[i]),
+                     'mean_grad_norm': float(self._sum_grad_norms[i] / self._nb_updates),
+                     'max_grad_norm': float(self._max_grad_norms[i])}
+            report['layers'][name] = layer
+            print("  {:>20}: ||W||={param_norm:.4f}  ||dW||/||W||={update_ratio:.2e}  ||g||={mean_grad_norm:.4f} (max: {max_grad_norm:.4f})".format(name, **layer))
+
+        self.history.append(report)
+        self._reset_window()
+
+        if nb_nonfinite_params > 0:
+            print("{} NaN/Inf detected in the parameters! Stopping training now.".format(nb_nonfinite_params))
+            sys.exit()
+
+    def save(self, path):
+        state = {"version": 1,
+                 "history": self.history}
+        smartutils.save_dict_to_json_file(pjoin(path, type(self).__name__ + ".json"), state)
+
+    def load(self, path):
+        state = smartutils.load_dict_from_json_file(pjoin(path, type(self).__name__ + ".json"))
+        self.history = state["history"]
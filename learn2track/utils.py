@@ -3,17 +3,17 @@ from __future__ import print_function
 import os
 import sys
 import numpy as np
-import theano
-import theano.tensor as T
 import shutil
 import hashlib
+import atexit
+import queue
+import tempfile
+import threading
 
 from collections import OrderedDict
 from time import time
 from os.path import join as pjoin
 
-import smartlearner.utils as smartutils
-
 
 class Timer():
     """ Times code within a `with` statement. """
@@ -66,6 +66,8 @@ def find_closest(sphere, xyz, normed=True):
 
 
 def logsumexp(x, axis=None, keepdims=False):
+    import theano.tensor as T
+
     max_value = T.max(x, axis=axis, keepdims=True)
     res = max_value + T.log(T.sum(T.exp(x-max_value), axis=axis, keepdims=True))
     if not keepdims:
@@ -80,11 +82,15 @@ def logsumexp(x, axis=None, keepdims=False):
 
 
 def softmax(x, axis=None):
+    import theano.tensor as T
+
     return T.exp(x - logsumexp(x, axis=axis, keepdims=True))
 
 
 def l2distance(x, y=None, axis=-1, keepdims=False, eps=0.0):
     """ Computes the L2 distance between x and y if y is given, else computes the L2 norm of x. """
+    import theano.tensor as T
+
     if y is not None:
         diff = x - y
     else:
@@ -100,6 +106,8 @@ def chunk(sequence, n):
 
 
 def log_variables(batch_scheduler, model, *symb_vars):
+    import theano
+
     # Gather updates from the optimizer and the batch scheduler.
     f = theano.function([],
                         symb_vars,
@@ -119,6 +127,8 @@ def log_variables(batch_scheduler, model, *symb_vars):
 
 
 def maybe_create_experiment_folder(args, exclude=[], retrocompatibility_defaults={}):
+    import smartlearner.utils as smartutils
+
     # Extract experiments hyperparameters
     hyperparams = OrderedDict(sorted(vars(args).items()))
 
@@ -196,3 +206,148 @@ def get_layer_architecture(layer):
         act_name = "identity"
 
     return [layer_name, in_size, out_size, act_name]
+
+
+class CheckpointWriter(object):
+    """ Writes training checkpoints to disk in a background thread.
+
+    Snapshots are first written synchronously to a staging folder living in
+    memory (`/dev/shm` when available), which is fast. They are then moved to
+    the experiment folder by a background thread while training goes on.
+
+    The training state of every snapshot goes to `checkpoints/epoch_XXXXX/training/`
+    and `training` is a symlink, atomically swapped, pointing to the last one.
+    This way the `training/` layout read by `trainer.load` is unchanged and a
+    crash can never leave a partially written `training/` behind. The model
+    files are atomically replaced one by one in their usual folder.
+
+    Parameters
+    ----------
+    experiment_path : str
+        Folder of the experiment.
+    keep_last : int, optional
+        Number of training checkpoints to keep on disk. Default: 1
+    staging_dir : str, optional
+        Folder where snapshots are written before being moved to the experiment folder.
+        Default: `/dev/shm` if writable, otherwise the system's temporary folder.
+    max_pending : int, optional
+        Maximum number of snapshots waiting to be written. Taking a new
+        snapshot blocks until there is room for it. Default: 2
+    """
+    CHECKPOINTS_DIR = "checkpoints"
+    TRAINING_DIR = "training"
+
+    def __init__(self, experiment_path, keep_last=1, staging_dir=None, max_pending=2):
+        if keep_last < 1:
+            raise ValueError("Must keep at least one checkpoint (got {}).".format(keep_last))
+
+        self.experiment_path = experiment_path
+        self.keep_last = keep_last
+        self.staging_dir = staging_dir
+        if self.staging_dir is None:
+            self.staging_dir = "/dev/shm" if os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+
+        self.checkpoints_dir = pjoin(experiment_path, self.CHECKPOINTS_DIR)
+        self._error = None
+        self._jobs = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+        # Make sure pending snapshots get written even if the training is stopped with `sys.exit`.
+        atexit.register(self.close)
+
+    def save_training(self, trainer, epoch):
+        """ Snapshots the training state (i.e. `trainer.save`) of a given epoch. """
+        staging = self._make_staging_folder()
+        trainer.save(staging)
+        self._put((self._publish_training, staging, epoch))
+
+    def save_model(self, model):
+        """ Snapshots the model (i.e. `model.save`). """
+        staging = self._make_staging_folder()
+        model.save(staging)
+        self._put((self._publish_files, staging))
+
+    def wait(self):
+        """ Blocks until all snapshots have been written. """
+        self._jobs.join()
+        self._raise_if_failed()
+
+    def close(self):
+        if self._thread.is_alive():
+            self.wait()
+
+    def _make_staging_folder(self):
+        self._raise_if_failed()
+        return tempfile.mkdtemp(prefix="learn2track_checkpoint_", dir=self.staging_dir)
+
+    def _put(self, job):
+        self._jobs.put(job)
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Failed to write a checkpoint in '{}'.".format(self.experiment_path)) from error
+
+    def _worker(self):
+        while True:
+            publish, staging, *args = self._jobs.get()
+            try:
+                publish(staging, *args)
+            except Exception as e:
+                self._error = e
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+                self._jobs.task_done()
+
+    def _list_checkpoints(self):
+        if not os.path.isdir(self.checkpoints_dir):
+            return []
+
+        return sorted(name for name in os.listdir(self.checkpoints_dir) if name.startswith("epoch_"))
+
+    def _publish_training(self, staging, epoch):
+        os.makedirs(self.checkpoints_dir, exist_ok=True)
+        name = "epoch_{:05d}".format(epoch)
+        checkpoint = pjoin(self.checkpoints_dir, name)
+
+        # Move the snapshot next to its final location first, so the renames below are atomic.
+        tmp_checkpoint = pjoin(self.checkpoints_dir, "tmp_" + name)
+        if os.path.isdir(tmp_checkpoint):
+            shutil.rmtree(tmp_checkpoint)
+
+        shutil.move(staging, tmp_checkpoint)
+        if os.path.isdir(checkpoint):
+            shutil.rmtree(checkpoint)  # Leftover of an interrupted training.
+
+        os.rename(tmp_checkpoint, checkpoint)
+
+        link = pjoin(self.experiment_path, self.TRAINING_DIR)
+        if os.path.isdir(link) and not os.path.islink(link):
+            # Experiment started before checkpoints were kept: it becomes the oldest one.
+            os.makedirs(pjoin(self.checkpoints_dir, "epoch_00000"), exist_ok=True)
+            os.rename(link, pjoin(self.checkpoints_dir, "epoch_00000", self.TRAINING_DIR))
+
+        # Relative target, so the experiment folder can be moved around.
+        tmp_link = link + ".tmp"
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+
+        os.symlink(pjoin(self.CHECKPOINTS_DIR, name, self.TRAINING_DIR), tmp_link)
+        os.replace(tmp_link, link)
+
+        # Checkpoints more recent than this one come from an interrupted training and are stale.
+        checkpoints = self._list_checkpoints()
+        stale = [old for old in checkpoints if old > name]
+        older = [old for old in checkpoints if old < name]
+        for old in stale + older[:max(len(older) - (self.keep_last - 1), 0)]:
+            shutil.rmtree(pjoin(self.checkpoints_dir, old))
+
+    def _publish_files(self, staging):
+        for root, dirs, files in os.walk(staging):
+            dest_dir = pjoin(self.experiment_path, os.path.relpath(root, staging))
+            os.makedirs(dest_dir, exist_ok=True)
+            for filename in files:
+                dest = pjoin(dest_dir, filename)
+                shutil.move(pjoin(root, filename), dest + ".tmp")
+                os.replace(dest + ".tmp", dest)
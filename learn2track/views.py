@@ -16,6 +16,24 @@ class LossView(View):
                                              name="compute_error")
 
 
+class PeriodicLossView(views.LossView):
+    """ Loss view that is only recomputed every `each_k_epoch` epochs.
+
+    In between, the last computed value is given back, so it shouldn't be
+    monitored by early stopping unless `each_k_epoch` is 1.
+    """
+    def __init__(self, loss, batch_scheduler, each_k_epoch=1):
+        super().__init__(loss, batch_scheduler)
+        self.each_k_epoch = each_k_epoch
+        self._last_value = None
+
+    def update(self, status):
+        if self._last_value is None or status.current_epoch % self.each_k_epoch == 0:
+            self._last_value = super().update(status)
+
+        return self._last_value
+
+
 class RegressionError(View):
     def __init__(self, predict_fct, dataset, batch_size=100):
         super(RegressionError, self).__init__()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+# Hack so you don't have to put the library containing this script in the PYTHONPATH.
+sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
+
+import argparse
+import json
+import time
+from collections import OrderedDict
+from functools import partial
+
+import numpy as np
+import nibabel as nib
+import theano
+import theano.tensor as T
+
+from learn2track import neurotools
+from learn2track.interpolation import eval_volume_at_3d_coordinates_in_theano
+from learn2track.utils import Timer
+
+floatX = theano.config.floatX
+
+ORDERS = ["tracking", "training"]
+
+
+def build_argparser():
+    DESCRIPTION = ("Micro-benchmark of the trilinear interpolation of a volume stored in C order or brick by brick"
+                   " (see `learn.py --brick-size`), evaluated at streamlines coordinates.")
+    p = argparse.ArgumentParser(description=DESCRIPTION)
+
+    p.add_argument('--volume-shape', type=int, nargs=3, default=(145, 174, 145),
+                   help="shape of the synthetic volume. Default: 145 174 145 (HCP)")
+    p.add_argument('--nb-channels', type=int, default=100,
+                   help="number of channels of the synthetic volume. Default: 100 (resampled DWI)")
+    p.add_argument('--brick-sizes', type=int, nargs='+', default=[2, 4, 8],
+                   help="brick sizes to benchmark. Default: 2 4 8")
+    p.add_argument('--tractogram',
+                   help="if specified, coordinates are the points of these streamlines (.trk|.tck) instead of synthetic ones.")
+    p.add_argument('--reference',
+                   help="image defining the voxel space of --tractogram (e.g. the DWI). Its shape is used as volume shape.")
+    p.add_argument('--nb-streamlines', type=int, default=10000,
+                   help="number of (synthetic) streamlines. Default: 10000")
+    p.add_argument('--nb-points', type=int, default=100,
+                   help="number of points of the synthetic streamlines. Default: 100")
+    p.add_argument('--step-size', type=float, default=0.5,
+                   help="step size of the synthetic streamlines (in voxel). Default: 0.5")
+    p.add_argument('--batch-size', type=int, default=10000,
+                   help="number of coordinates evaluated at the same time. Default: 10000")
+    p.add_argument('--repeat', type=int, default=3,
+                   help="number of runs, the fastest is reported. Default: 3")
+    p.add_argument('--seed', type=int, default=1234,
+                   help="seed for the random generator. Default: 1234")
+    p.add_argument('--out', type=str,
+                   help="if specified, save results in this JSON file.")
+
+    return p
+
+
+def make_synthetic_streamlines(volume_shape, nb_streamlines, nb_points, step_size, rng):
+    """ Generates smooth random walks staying inside an ellipsoid fitting in the volume, like WM streamlines. """
+    center = (np.asarray(volume_shape) - 1) / 2.
+    radii = 0.4 * np.asarray(volume_shape)
+
+    # Seeds are uniformly distributed inside the ellipsoid.
+    seeds = rng.randn(nb_streamlines, 3)
+    seeds *= (rng.rand(nb_streamlines, 1) ** (1 / 3.)) / np.sqrt(np.sum(seeds ** 2, axis=1, keepdims=True))
+    points = center + seeds * radii
+
+    directions = rng.randn(nb_streamlines, 3)
+    streamlines = np.empty((nb_streamlines, nb_points, 3), dtype=np.float32)
+    for i in range(nb_points):
+        streamlines[:, i] = points
+        directions += 0.2 * rng.randn(nb_streamlines, 3)
+
+        # Steer back the streamlines leaving the ellipsoid.
+        outside = np.sum(((points - center) / radii) ** 2, axis=1) > 1
+        directions[outside] = center - points[outside]
+
+        directions /= np.sqrt(np.sum(directions ** 2, axis=1, keepdims=True))
+        points = points + step_size * directions
+
+    return streamlines
+
+
+def load_streamlines(tractogram_filename, reference_filename, nb_streamlines, nb_points):
+    """ Loads streamlines in voxel space, resampled to have the same number of points. """
+    from dipy.tracking.streamline import set_number_of_points
+
+    reference = nib.load(reference_filename)
+    tractogram = nib.streamlines.load(tractogram_filename).tractogram
+    tractogram.apply_affine(np.linalg.inv(reference.affine))
+    streamlines = [set_number_of_points(s, nb_points) for s in tractogram.streamlines[:nb_streamlines]]
+    return np.array(streamlines, dtype=np.float32), reference.shape[:3]
+
+
+def get_batches(streamlines, order, batch_size):
+    """ Orders the points like during tracking (all streamlines step by step) or training (streamline by streamline). """
+    if order == "tracking":
+        coords = streamlines.transpose((1, 0, 2)).reshape((-1, 3))
+    else:
+        coords = streamlines.reshape((-1, 3))
+
+    return [np.ascontiguousarray(coords[i:i + batch_size]) for i in range(0, len(coords), batch_size)]
+
+
+def time_it(func, batches, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.time()
+        for batch in batches:
+            func(batch)
+        best = min(best, time.time() - start)
+
+    return best
+
+
+def main():
+    parser = build_argparser()
+    args = parser.parse_args()
+    print(args)
+
+    rng = np.random.RandomState(args.seed)
+    volume_shape = tuple(args.volume_shape)
+    with Timer("Generating coordinates"):
+        if args.tractogram is not None:
+            if args.reference is None:
+                parser.error("--tractogram requires --reference.")
+
+            streamlines, volume_shape = load_streamlines(args.tractogram, args.reference, args.nb_streamlines, args.nb_points)
+        else:
+            streamlines = make_synthetic_streamlines(volume_shape, args.nb_streamlines, args.nb_points, args.step_size, rng)
+
+    with Timer("Generating synthetic volume"):
+        volume = rng.rand(*(volume_shape + (args.nb_channels,))).astype(floatX)
+        shape = np.array(volume_shape, dtype=floatX)
+        strides = np.r_[1, np.cumprod(shape[::-1])[:-1]][::-1]
+
+    coords = T.matrix("coords")
+    layouts = OrderedDict()
+    with Timer("Compiling interpolation functions"):
+        # The NumPy interpolation of a volume in C order relies on `map_coordinates`.
+        layouts["c_order"] = (partial(neurotools.eval_volume_at_3d_coordinates, volume),
+                              theano.function([coords], eval_volume_at_3d_coordinates_in_theano(theano.shared(volume), coords, strides=strides)))
+
+        for brick_size in args.brick_sizes:
+            bricked = neurotools.make_bricked_volume(volume, brick_size)
+            numpy_func = partial(neurotools.eval_volume_at_3d_coordinates, bricked, brick_size=brick_size, shape=volume_shape)
+            theano_func = theano.function([coords], eval_volume_at_3d_coordinates_in_theano(theano.shared(bricked), coords,
+                                                                                            brick_size=brick_size, shape=volume_shape))
+            layouts["bricks_{}".format(brick_size)] = (numpy_func, theano_func)
+
+    nb_coords = streamlines.shape[0] * streamlines.shape[1]
+    results = {'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+               'config': vars(args),
+               'nb_coords': nb_coords,
+               'results': OrderedDict()}
+
+    for order in ORDERS:
+        batches = get_batches(streamlines, order, args.batch_size)
+        print("\nCoordinates in {} order ({:,} coordinates, batches of {:,}):".format(order, nb_coords, args.batch_size))
+        for backend, index in [("numpy", 0), ("theano", 1)]:
+            reference = None
+            for layout, funcs in layouts.items():
+                elapsed = time_it(funcs[index], batches, args.repeat)
+                throughput = nb_coords / elapsed / 1e6
+                results['results']["{}/{}/{}".format(order, backend, layout)] = throughput
+                if reference is None:
+                    reference = throughput
+
+                print("  {:>6} {:>10}: {:8.3f} Mcoords/sec. ({:.2f}x)".format(backend, layout, throughput, throughput / reference))
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+        print("Results saved to {}".format(args.out))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+# Hack so you don't have to put the library containing this script in the PYTHONPATH.
+sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
+
+import argparse
+import time
+import numpy as np
+
+import nibabel as nib
+
+from learn2track import neurotools
+
+
+def build_argparser():
+    DESCRIPTION = ("Benchmark the effect of the seeds ordering (see `track.py --seed-ordering`) on the speed of"
+                   " the trilinear gathers done while tracking. Streamlines follow a smooth synthetic direction field"
+                   " so that the only thing changing between runs is the order in which seeds are batched.")
+    p = argparse.ArgumentParser(description=DESCRIPTION)
+
+    p.add_argument('--dwi', type=str,
+                   help="if provided, sample this volume (.nii|.nii.gz) instead of a synthetic one.")
+    p.add_argument('--shape', type=int, nargs=4, default=(128, 128, 80, 45),
+                   help="shape of the synthetic volume. Default: 128 128 80 45")
+    p.add_argument('--nb-seeds-per-voxel', type=int, default=1,
+                   help="number of seeds per voxel of the (brain) mask. Default: 1")
+    p.add_argument('--shuffle', action="store_true",
+                   help="shuffle the seeds first, e.g. to mimic seeds extracted from a tractogram (.trk|.tck).")
+    p.add_argument('--batch-size', type=int, default=10000,
+                   help="number of streamlines to track at the same time. Default: 10000")
+    p.add_argument('--nb-steps', type=int, default=50,
+                   help="number of steps taken by every streamline. Default: 50")
+    p.add_argument('--step-size', type=float, default=0.5,
+                   help="step size (in voxel). Default: 0.5")
+    p.add_argument('--orderings', nargs="+", choices=["none", "morton", "hilbert"], default=["none", "morton", "hilbert"],
+                   help="seeds orderings to benchmark. Default: all")
+    p.add_argument('--seed', type=int, default=1234,
+                   help="seed for the random generator. Default: 1234")
+
+    return p
+
+
+def make_direction_field(shape):
+    """ Smooth rotating field (in voxel space) that keeps streamlines inside the volume. """
+    center = (np.asarray(shape) - 1) / 2.
+
+    def _directions(positions):
+        offsets = positions - center
+        directions = np.stack([-offsets[:, 1], offsets[:, 0], 0.2 * np.ones(len(offsets))], axis=1)
+        return directions / np.maximum(np.sqrt(np.sum(directions**2, axis=1, keepdims=True)), 1e-6)
+
+    return _directions
+
+
+def benchmark(volume, seeds, batch_size, nb_steps, step_size):
+    directions_field = make_direction_field(volume.shape[:3])
+    upper_bound = np.asarray(volume.shape[:3], dtype=np.float32) - 1
+
+    start_time = time.time()
+    for start in range(0, len(seeds), batch_size):
+        positions = seeds[start:start+batch_size].copy()
+        for _ in range(nb_steps):
+            neurotools.eval_volume_at_3d_coordinates(volume, positions)
+            positions += step_size * directions_field(positions)
+            positions = np.clip(positions, 0, upper_bound)
+
+    return time.time() - start_time
+
+
+def main():
+    parser = build_argparser()
+    args = parser.parse_args()
+    print(args)
+
+    rng = np.random.RandomState(args.seed)
+
+    if args.dwi is not None:
+        volume = nib.load(args.dwi).get_data().astype(np.float32)
+    else:
+        volume = rng.rand(*args.shape).astype(np.float32)
+
+    # Seed an ellipsoid roughly the size of a brain.
+    shape = np.asarray(volume.shape[:3])
+    grid = np.array(np.where(np.ones(shape, dtype=bool))).T
+    mask = np.sum(((grid - (shape - 1) / 2.) / (0.45 * shape))**2, axis=1) <= 1
+    voxels = grid[mask]
+
+    seeds = np.repeat(voxels, args.nb_seeds_per_voxel, axis=0)
+    seeds = (seeds + rng.uniform(-0.5, 0.5, size=seeds.shape)).astype(np.float32)
+    if args.shuffle:
+        seeds = seeds[rng.permutation(len(seeds))]
+
+    print("Volume: {}, {:,} seeds, {:,} steps".format(volume.shape, len(seeds), args.nb_steps))
+
+    for ordering in args.orderings:
+        ordered_seeds = seeds
+        if ordering != "none":
+            ordered_seeds = seeds[neurotools.get_space_filling_curve_order(seeds, curve=ordering)]
+
+        elapsed = benchmark(volume, ordered_seeds, args.batch_size, args.nb_steps, args.step_size)
+        print("{:>8}: {:.2f} sec. ({:,.0f} streamlines/sec.)".format(ordering, elapsed, len(seeds) / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+# Hack so you don't have to put the library containing this script in the PYTHONPATH.
+sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
+
+import argparse
+import json
+import multiprocessing
+import resource
+import subprocess
+import time
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import numpy as np
+import nibabel as nib
+import theano
+from dipy.core.gradients import gradient_table
+
+from learn2track import neurotools, factories
+from learn2track.utils import Timer
+
+from scripts.track import Tracker, batch_track, make_is_outside_mask, make_is_too_long, make_is_too_curvy, make_is_unlikely, \
+    make_is_stopping, STOPPING_MASK, STOPPING_LENGTH, STOPPING_CURVATURE, STOPPING_LIKELIHOOD
+
+floatX = theano.config.floatX
+
+MODELS = ["gru_regression", "gru_gaussian", "gru_mixture", "ffnn_regression"]
+
+
+def build_argparser():
+    DESCRIPTION = ("Benchmark the tracking code on a synthetic DWI using randomly initialized models."
+                   " Results can be saved in a JSON file and compared with a previous run (e.g. from another commit).")
+    p = argparse.ArgumentParser(description=DESCRIPTION)
+
+    p.add_argument('--models', nargs="+", choices=MODELS, default=MODELS,
+                   help="models to benchmark. Default: all")
+    p.add_argument('--hidden-sizes', type=int, nargs="+", default=[500, 500],
+                   help="size of the hidden layers of the models. Default: 500 500")
+    p.add_argument('--volume-shape', type=int, nargs=3, default=(64, 64, 40),
+                   help="shape of the synthetic DWI. Default: 64 64 40")
+    p.add_argument('--nb-gradients', type=int, default=65,
+                   help="number of gradients of the synthetic DWI. Default: 65")
+    p.add_argument('--nb-seeds', type=int, default=10000,
+                   help="number of seeds to track from. Default: 10000")
+    p.add_argument('--batch-size', type=int,
+                   help="number of streamlines to track at the same time. Default: all seeds")
+    p.add_argument('--step-size', type=float, default=0.5,
+                   help="step size (in voxel). Default: 0.5")
+    p.add_argument('--max-nb-points', type=int, default=200,
+                   help="maximum number of points per streamline. Default: 200")
+    p.add_argument('--theta', type=float, default=45,
+                   help="maximum angle between 2 steps (in degree). Default: 45")
+    p.add_argument('--pft-nb-retry', type=int, default=1,
+                   help="number of PFT 'rescue' attempts. Default: 1")
+    p.add_argument('--pft-nb-backtrack-steps', type=int, default=2,
+                   help="number of steps to backtrack before a PFT 'rescue'. Default: 2")
+    p.add_argument('--seed', type=int, default=1234,
+                   help="seed for the random generator. Default: 1234")
+
+    p.add_argument('--out', type=str,
+                   help="if specified, save results in this JSON file.")
+    p.add_argument('--compare', type=str,
+                   help="if specified, compare results with the ones from this JSON file.")
+
+    return p
+
+
+class PhaseTimer(object):
+    """ Accumulates the time spent in each phase, excluding the time spent in nested phases. """
+    def __init__(self):
+        self.times = OrderedDict()
+        self._stack = []
+
+    @contextmanager
+    def __call__(self, name):
+        start = time.time()
+        self._stack.append(0.)
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            nested = self._stack.pop()
+            self.times[name] = self.times.get(name, 0.) + elapsed - nested
+            if len(self._stack) > 0:
+                self._stack[-1] += elapsed
+
+    def wrap(self, name, func):
+        def _wrapped(*args, **kwargs):
+            with self(name):
+                return func(*args, **kwargs)
+
+        return _wrapped
+
+
+def make_synthetic_dwi(volume_shape, nb_gradients, rng):
+    dwi = nib.Nifti1Image(rng.rand(*(tuple(volume_shape) + (nb_gradients,))), affine=np.eye(4))
+    bvals = [0] + [1000] * (nb_gradients - 1)
+    bvecs = rng.randn(nb_gradients, 3)
+    bvecs /= np.sqrt(np.sum(bvecs ** 2, axis=1, keepdims=True))
+    return dwi, gradient_table(bvals, bvecs)
+
+
+def make_model(name, hidden_sizes, volume_manager, seed):
+    hyperparams = {'model': name,
+                   'hidden_sizes': hidden_sizes,
+                   'learn_to_stop': False,
+                   'normalize': False,
+                   'activation': 'tanh',
+                   'feed_previous_direction': False,
+                   'predict_offset': False,
+                   'use_layer_normalization': False,
+                   'drop_prob': 0.,
+                   'dropout_prob': 0.,
+                   'use_zoneout': False,
+                   'skip_connections': False,
+                   'neighborhood_radius': None,
+                   'n_gaussians': 2,
+                   'seed': seed}
+    model = factories.model_factory(hyperparams,
+                                    input_size=volume_manager.data_dimension,
+                                    output_size=3,
+                                    volume_manager=volume_manager)
+    model.initialize(factories.weigths_initializer_factory("orthogonal", seed=seed))
+    return model
+
+
+def make_stopping_criteria(volume_shape, max_nb_points, theta, phases=None):
+    mask = np.ones(volume_shape)
+    criteria = {STOPPING_MASK: make_is_outside_mask(mask, np.eye(4), threshold=0.5),
+                STOPPING_LENGTH: make_is_too_long(max_nb_points),
+                STOPPING_CURVATURE: make_is_too_curvy(theta),
+                STOPPING_LIKELIHOOD: make_is_unlikely(0.5)}
+
+    is_stopping = make_is_stopping(criteria)
+    if phases is not None:
+        is_stopping = phases.wrap("is_stopping", is_stopping)
+
+    is_stopping.max_nb_points = max_nb_points  # Small hack
+    return is_stopping
+
+
+def benchmark_phases(model, seeds, args, volume_shape):
+    """ Runs a forward tracking pass, timing each of its phases separately. """
+    phases = PhaseTimer()
+    is_stopping = make_stopping_criteria(volume_shape, args.max_nb_points, args.theta, phases)
+
+    with phases("compile"):
+        tracker = Tracker(model, is_stopping, keep_last_n_states=args.pft_nb_backtrack_steps)
+
+    batch_size = len(seeds) if args.batch_size is None else args.batch_size
+    nb_points = 0
+    for start in range(0, len(seeds), batch_size):
+        tracker.plant(seeds[start:start+batch_size])
+
+        while not tracker.is_ripe():
+            with phases("grow_step"):
+                tracker.grow(args.step_size)
+
+            for _ in range(args.pft_nb_retry):
+                for backtrack_n_steps in range(1, args.pft_nb_backtrack_steps+1):
+                    idx = tracker.get(flag=STOPPING_MASK | STOPPING_CURVATURE | STOPPING_LIKELIHOOD)
+                    if len(idx) == 0:
+                        break
+
+                    with phases("pft_regrow"):
+                        tracker.regrow(idx, args.step_size, backtrack_n_steps=backtrack_n_steps)
+
+            with phases("harvest"):
+                tractogram = tracker.harvest()
+
+            nb_points += int(sum(map(len, tractogram.streamlines)))
+
+    return phases.times, nb_points
+
+
+def benchmark_batch_track(model, seeds, args, volume, volume_shape):
+    """ Runs the forward and backward tracking, as done by `track.py`. """
+    is_stopping = make_stopping_criteria(volume_shape, args.max_nb_points, args.theta)
+
+    track_args = SimpleNamespace(track_like_peter=False,
+                                 pft_nb_retry=args.pft_nb_retry,
+                                 pft_nb_backtrack_steps=args.pft_nb_backtrack_steps,
+                                 use_max_component=False,
+                                 flip_x=False, flip_y=False, flip_z=False,
+                                 verbose=False)
+
+    start = time.time()
+    tractogram = batch_track(model, volume, seeds,
+                             step_size=args.step_size,
+                             is_stopping=is_stopping,
+                             batch_size=args.batch_size,
+                             args=track_args)
+    elapsed = time.time() - start
+
+    nb_points = int(sum(map(len, tractogram.streamlines)))
+    return elapsed, len(tractogram), nb_points
+
+
+def get_peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.  # ru_maxrss is in KB on Linux.
+
+
+def run_in_subprocess(func, *args):
+    """ Runs `func` in a forked process, so its peak memory usage isn't mixed up with the one of other models.
+
+    The forked process starts with the memory of its parent (e.g. the DWI), which is part of its peak memory usage.
+    """
+    ctx = multiprocessing.get_context("fork")
+    recv_conn, send_conn = ctx.Pipe(duplex=False)
+
+    def _target():
+        try:
+            send_conn.send((True, func(*args)))
+        except BaseException:
+            send_conn.send((False, traceback.format_exc()))
+
+    process = ctx.Process(target=_target)
+    process.start()
+    send_conn.close()  # So `recv` fails if the process dies without sending anything.
+    try:
+        succeeded, result = recv_conn.recv()
+    except EOFError:
+        succeeded, result = False, None
+    finally:
+        process.join()
+
+    if not succeeded:
+        raise RuntimeError(result if result is not None else "Process died (exit code: {}).".format(process.exitcode))
+
+    return result
+
+
+def benchmark_model(name, volume, seeds, args):
+    volume_manager = neurotools.VolumeManager()
+    volume_manager.register(volume)
+
+    with Timer("Creating model: {}".format(name)):
+        model = make_model(name, args.hidden_sizes, volume_manager, args.seed)
+
+    with Timer("Benchmarking phases"):
+        phases, nb_points = benchmark_phases(model, seeds, args, args.volume_shape)
+
+    with Timer("Benchmarking batch_track (forward + backward)"):
+        elapsed, nb_streamlines, nb_points_batch_track = benchmark_batch_track(model, seeds, args, volume, args.volume_shape)
+
+    return {'model': name,
+            'phases': phases,
+            'forward_nb_points': nb_points,
+            'batch_track_time': elapsed,
+            'nb_streamlines': nb_streamlines,
+            'nb_points': nb_points_batch_track,
+            'streamlines_per_sec': nb_streamlines / elapsed,
+            'points_per_sec': nb_points_batch_track / elapsed,
+            'peak_rss_mb': get_peak_rss_mb()}
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def compare(results, previous_results):
+    previous = {r['model']: r for r in previous_results['results']}
+    print("\nComparison with {} (commit: {})".format(previous_results['date'], previous_results['commit']))
+    for result in results['results']:
+        if result['model'] not in previous:
+            continue
+
+        old = previous[result['model']]
+        print("{:>16}: {:+.1%} streamlines/sec. ({:,.1f} -> {:,.1f})".format(
+            result['model'],
+            result['streamlines_per_sec'] / old['streamlines_per_sec'] - 1,
+            old['streamlines_per_sec'], result['streamlines_per_sec']))
+
+        for phase, elapsed in result['phases'].items():
+            if phase in old['phases'] and old['phases'][phase] > 0:
+                print("{:>16}  {:>12}: {:+.1%}".format("", phase, elapsed / old['phases'][phase] - 1))
+
+
+def main():
+    parser = build_argparser()
+    args = parser.parse_args()
+    print(args)
+
+    rng = np.random.RandomState(args.seed)
+
+    with Timer("Generating synthetic DWI"):
+        dwi, gradients = make_synthetic_dwi(args.volume_shape, args.nb_gradients, rng)
+        volume = neurotools.resample_dwi(dwi, gradients.bvals, gradients.bvecs).astype(np.float32)
+
+    # Seeds are spread uniformly inside the volume.
+    seeds = rng.uniform(0, 1, size=(args.nb_seeds, 3)) * (np.asarray(args.volume_shape) - 1)
+    seeds = seeds.astype(floatX)
+
+    # Memory used before any model is created (synthetic DWI, seeds, ...).
+    baseline_rss_mb = get_peak_rss_mb()
+    results = {'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+               'commit': get_commit(),
+               'config': vars(args),
+               'baseline_rss_mb': baseline_rss_mb,
+               'results': []}
+
+    for name in args.models:
+        # Each model is benchmarked in its own process to measure its peak memory usage.
+        result = run_in_subprocess(benchmark_model, name, volume, seeds, args)
+        result['model_rss_mb'] = result['peak_rss_mb'] - baseline_rss_mb
+        results['results'].append(result)
+
+        print("{}: {:,.1f} streamlines/sec., {:,.1f} points/sec., peak RSS: {:,.1f} MB ({:+,.1f} MB)".format(
+            name, result['streamlines_per_sec'], result['points_per_sec'], result['peak_rss_mb'], result['model_rss_mb']))
+        for phase, elapsed in result['phases'].items():
+            print("  {:>12}: {:.3f} sec.".format(phase, elapsed))
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+        print("Results saved to {}".format(args.out))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -27,7 +27,12 @@ from learn2track.factories import model_factory
 from learn2track.factories import loss_factory
 
 from learn2track import datasets
-from learn2track.neurotools import VolumeManager
+from learn2track.neurotools import VolumeManager, get_neighborhood_directions, STORAGE_DTYPES
+from learn2track.batch_schedulers import CachedBatchScheduler
+from learn2track.views import PeriodicLossView
+from learn2track.tasks import HealthMonitor
+from learn2track.profiling import TrainingProfiler, PROFILERS
+from learn2track.data_parallel import DataParallel
 
 
 def build_train_gru_argparser(subparser):
@@ -258,9 +263,25 @@ def build_argparser():
                          help='file containing validation data (as generated by `process_streamlines.py`).')
     dataset.add_argument('--use-sh-coeffs', action='store_true',
                          help='if specified, use Spherical Harmonic coefficients as inputs to the model. Default: dwi coefficients.')
+    dataset.add_argument('--loading-processes', type=int, metavar='N', default=1,
+                         help='number of processes used to load and preprocess the subjects. Default: %(default)s')
+    dataset.add_argument('--loading-memory-budget', type=float, metavar='GB',
+                         help='if specified, limit the number of subjects loaded at once so they are expected to need at most GB gigabytes.')
     dataset.add_argument('--neighborhood-radius', type=float,
                          help='if specified, the model will add data from neighboring points to the input (6 points, along each axis), with specified length '
                               '(in voxel space). Default: None (no neighborhood)')
+    dataset.add_argument('--stack-neighborhood', action='store_true',
+                         help='if specified, the neighborhood signal is precomputed once by stacking shifted copies of the volumes (7 times more memory), '
+                              'instead of interpolating every neighbor at every step. Exact only if the neighborhood radius is a whole number of voxels.')
+    dataset.add_argument('--sparse-volumes', action='store_true',
+                         help='if specified, only the data of the brain voxels (i.e. having a nonzero value) are kept in memory. '
+                              'Results are unchanged, but more subjects fit in memory.')
+    dataset.add_argument('--volumes-dtype', choices=STORAGE_DTYPES, default='float32',
+                         help='type used to store the volumes in memory. Values are converted back to floatX when interpolated, '
+                              'use `validate_volume_precision.py` to check the impact of a reduced precision. Default: %(default)s')
+    dataset.add_argument('--brick-size', type=int,
+                         help='if specified, volumes are stored in bricks of this size (e.g. 4) instead of in C order, which makes '
+                              'the interpolation more cache-friendly (see `benchmark_bricked_volume.py`). Incompatible with --sparse-volumes.')
 
     duration = p.add_argument_group("Training duration options")
     duration.add_argument('--max-epoch', type=int, metavar='N', default=100,
@@ -269,6 +290,18 @@ def build_argparser():
                           help='use early stopping with a lookahead of K. Default: %(default)s')
     duration.add_argument('--lookahead-eps', type=float, default=1e-3,
                           help='in early stopping, an improvement is whenever the objective improve of at least `eps`. Default: %(default)s',)
+    duration.add_argument('--early-stopping-on', choices=['full', 'subsample'], default='full',
+                          help='validation loss monitored by early stopping: the full validset or the subsample given by --valid-subsample. Default: full')
+
+    validation = p.add_argument_group("Validation options")
+    validation.add_argument('--valid-subsample', type=float, metavar='P',
+                            help='if specified, also evaluate a fixed subsample (proportion P of the streamlines, stratified by subject and length)'
+                                 ' of the validset every epoch.')
+    validation.add_argument('--full-valid-every', type=int, metavar='N', default=1,
+                            help='evaluate the full validset every N epochs. If N > 1, early stopping must be done on the subsample'
+                                 ' (see --early-stopping-on). Default: %(default)s')
+    validation.add_argument('--cache-valid-batches', action='store_true',
+                            help='if specified, validation batches are built once and memory-mapped from the experiment folder.')
 
     # Training options
     training = p.add_argument_group("Training options")
@@ -284,6 +317,21 @@ def build_argparser():
                           help='if specified, training streamlines will not be resampled between batches (streamlines will keep their original step size)')
     training.add_argument('--sort-streamlines', action="store_true",
                           help='if specified, streamlines will be approximatively regrouped according to their lengths. (Training speedup).')
+    training.add_argument('--tbptt-window', type=int, metavar='W',
+                          help='if specified, use truncated backpropagation through time: streamlines are split into windows of W steps,'
+                               ' hidden states are carried from one window to the next but gradients only flow within a window.'
+                               ' Only for GRU models (except gru_multistep).')
+    training.add_argument('--workers', type=int, metavar='N',
+                          help='if specified, use synchronous data-parallel training on CPU: every batch is split among N worker processes,'
+                               ' each one computing the gradients of its shard with its own replica of the model. Gradients are averaged'
+                               ' and a single update is done. Results depend on N, so an experiment must be resumed with the same N.'
+                               ' Only for GRU models (except gru_multistep), without --tbptt-window.')
+    training.add_argument('--cache-features', action="store_true",
+                          help='if specified, the diffusion data are evaluated once at every point of the streamlines and memory-mapped from the experiment folder,'
+                               ' instead of being interpolated at every epoch. Requires --keep-step-size and no --noisy-streamlines-sigma.'
+                               ' Only for GRU models (except gru_multistep).')
+    training.add_argument('--cache-features-dtype', choices=['float16', 'float32'], default='float32',
+                          help='type used to store the cached features. Default: float32')
 
     # Optimizer options
     optimizer = p.add_argument_group("Optimizer (required)")
@@ -301,6 +349,19 @@ def build_argparser():
 
     general.add_argument('-f', '--force', action='store_true', help='restart training from scratch instead of resuming.')
     general.add_argument('--view', action='store_true', help='display learning curves.')
+    general.add_argument('--health-report-every', type=int, metavar='K', default=100,
+                         help='print gradient norms, parameter norms and update ratios of every layer every K updates. Default: %(default)s')
+    general.add_argument('--keep-checkpoints', type=int, metavar='N', default=1,
+                         help='number of training checkpoints (`checkpoints/epoch_*/training/`) to keep. They are written to disk in the background. Default: %(default)s')
+
+    profiling = p.add_argument_group("Profiling options")
+    profiling.add_argument('--profile', action='store_true',
+                           help='if specified, save the time spent in each phase of the training loop (batch preparation, transfer to the shared variables,'
+                                ' optimizer step and every task) in `profiling/epoch_*.json` of the experiment folder.')
+    profiling.add_argument('--profile-updates', type=int, nargs=2, metavar=('START', 'END'),
+                           help='if specified, capture updates START to END (inclusively) with a Python profiler. Implies --profile.')
+    profiling.add_argument('--profiler', choices=PROFILERS, default='cprofile',
+                           help='Python profiler used by --profile-updates. Default: %(default)s')
 
     subparser = p.add_subparsers(title="Models", dest="model")
     subparser.required = True   # force 'required' testing
@@ -313,13 +374,82 @@ def build_argparser():
     return p
 
 
+def load_or_compute_features(dataset, volume_manager, neighborhood_directions, dtype, filename, subjects, params):
+    """ Loads the features cached in `filename` unless they were computed from other subject files or `params`. """
+    nb_directions = 1 if neighborhood_directions is None else len(neighborhood_directions)
+    shape = (len(dataset.streamlines._data), volume_manager.volumes[0].get_value(borrow=True).shape[-1] * nb_directions)
+
+    # Subject files are identified by their path and modification time.
+    subjects = [(os.path.abspath(subject), os.path.getmtime(subject)) for subject in subjects]
+    uid = utils.generate_uid_from_string(repr((subjects, sorted(params.items()), shape, np.dtype(dtype).str)))
+    uid_filename = os.path.splitext(filename)[0] + ".uid"
+    if os.path.isfile(filename) and os.path.isfile(uid_filename):
+        with open(uid_filename) as f:
+            cached_uid = f.read().strip()
+
+        features = np.load(filename, mmap_mode='r')
+        if cached_uid == uid and features.dtype == dtype and features.shape == shape:
+            return features
+
+    if os.path.isfile(uid_filename):
+        os.remove(uid_filename)  # In case computing the features gets interrupted.
+
+    features = datasets.compute_streamlines_features(dataset, volume_manager, neighborhood_directions, dtype=dtype, filename=filename)
+    with open(uid_filename, 'w') as f:
+        f.write(uid)
+
+    return features
+
+
 def main():
     parser = build_argparser()
     args = parser.parse_args()
     print(args)
     print("Using Theano v.{}".format(theano.version.short_version))
 
-    hyperparams_to_exclude = ['max_epoch', 'force', 'name', 'view', 'shuffle_streamlines']
+    if args.tbptt_window is not None and args.model not in ['gru_regression', 'gru_gaussian', 'gru_mixture']:
+        parser.error("--tbptt-window is not supported by model: {}".format(args.model))
+
+    if args.workers is not None:
+        if args.model not in ['gru_regression', 'gru_gaussian', 'gru_mixture'] or args.tbptt_window is not None:
+            parser.error("--workers is only supported by models gru_regression, gru_gaussian and gru_mixture, without --tbptt-window.")
+
+        if not theano.config.device.startswith("cpu"):
+            parser.error("--workers is only supported on CPU (Theano device: {}).".format(theano.config.device))
+
+    if args.valid_subsample is not None and not 0 < args.valid_subsample <= 1:
+        parser.error("--valid-subsample must be in (0, 1], got {}.".format(args.valid_subsample))
+
+    if args.valid_subsample is not None and args.model == 'gru_multistep':
+        parser.error("--valid-subsample is not supported by model: {}".format(args.model))
+
+    if args.early_stopping_on == 'subsample' and args.valid_subsample is None:
+        parser.error("--early-stopping-on subsample requires --valid-subsample.")
+
+    if args.full_valid_every < 1:
+        parser.error("--full-valid-every must be at least 1.")
+
+    if args.full_valid_every > 1 and args.early_stopping_on == 'full':
+        # Otherwise, early stopping would see the same (stale) full validation loss N-1 epochs out of N.
+        parser.error("--full-valid-every > 1 requires --early-stopping-on subsample.")
+
+    if args.cache_features:
+        if args.model not in ['gru_regression', 'gru_gaussian', 'gru_mixture']:
+            parser.error("--cache-features is not supported by model: {}".format(args.model))
+
+        if not args.keep_step_size or args.noisy_streamlines_sigma is not None:
+            parser.error("--cache-features requires --keep-step-size and no --noisy-streamlines-sigma.")
+
+    if args.profile_updates is not None and args.profile_updates[0] > args.profile_updates[1]:
+        parser.error("--profile-updates START must be lower or equal to END, got {} {}.".format(*args.profile_updates))
+
+    if args.brick_size is not None and args.sparse_volumes:
+        parser.error("--brick-size can't be used with --sparse-volumes.")
+
+    hyperparams_to_exclude = ['max_epoch', 'force', 'name', 'view', 'shuffle_streamlines', 'stack_neighborhood', 'cache_features', 'cache_features_dtype',
+                              'cache_valid_batches', 'keep_checkpoints', 'health_report_every',
+                              'profile', 'profile_updates', 'profiler', 'loading_processes', 'loading_memory_budget',
+                              'sparse_volumes', 'volumes_dtype', 'brick_size']
     # Use this for hyperparams added in a new version, but nonexistent from older versions
     retrocompatibility_defaults = {'feed_previous_direction': False,
                                    'predict_offset': False,
@@ -331,7 +461,12 @@ def main():
                                    'use_zoneout': False,
                                    'skip_connections': False,
                                    'neighborhood_radius': False,
-                                   'learn_to_stop': False}
+                                   'learn_to_stop': False,
+                                   'tbptt_window': None,
+                                   'early_stopping_on': 'full',
+                                   'valid_subsample': None,
+                                   'full_valid_every': 1,
+                                   'workers': None}
     experiment_path, hyperparams, resuming = utils.maybe_create_experiment_folder(args, exclude=hyperparams_to_exclude,
                                                                                   retrocompatibility_defaults=retrocompatibility_defaults)
 
@@ -342,15 +477,42 @@ def main():
     print("Resuming:" if resuming else "Creating:", experiment_path)
 
     with Timer("Loading dataset", newline=True):
-        trainset_volume_manager = VolumeManager()
-        validset_volume_manager = VolumeManager()
+        loading_memory_budget = None if args.loading_memory_budget is None else int(args.loading_memory_budget * 1024**3)
+        neighborhood_directions = None
+        if args.stack_neighborhood and hyperparams['neighborhood_radius']:
+            neighborhood_directions = get_neighborhood_directions(hyperparams['neighborhood_radius'])
+
+        trainset_volume_manager = VolumeManager(neighborhood_directions=neighborhood_directions, sparse=args.sparse_volumes,
+                                                storage_dtype=args.volumes_dtype, brick_size=args.brick_size)
+        validset_volume_manager = VolumeManager(neighborhood_directions=neighborhood_directions, sparse=args.sparse_volumes,
+                                                storage_dtype=args.volumes_dtype, brick_size=args.brick_size)
         trainset = datasets.load_tractography_dataset(args.train_subjects, trainset_volume_manager, name="trainset",
-                                                      use_sh_coeffs=args.use_sh_coeffs)
+                                                      use_sh_coeffs=args.use_sh_coeffs, nb_processes=args.loading_processes,
+                                                      memory_budget=loading_memory_budget)
         validset = datasets.load_tractography_dataset(args.valid_subjects, validset_volume_manager, name="validset",
-                                                      use_sh_coeffs=args.use_sh_coeffs)
+                                                      use_sh_coeffs=args.use_sh_coeffs, nb_processes=args.loading_processes,
+                                                      memory_budget=loading_memory_budget)
         print("Dataset sizes:", len(trainset), " |", len(validset))
 
-        batch_scheduler = batch_scheduler_factory(hyperparams, dataset=trainset, train_mode=True)
+        trainset_features = None
+        validset_features = None
+        if args.cache_features:
+            features_directions = None
+            if hyperparams['neighborhood_radius'] and neighborhood_directions is None:
+                features_directions = get_neighborhood_directions(hyperparams['neighborhood_radius'])
+
+            features_params = {'use_sh_coeffs': args.use_sh_coeffs,
+                               'neighborhood_radius': hyperparams['neighborhood_radius'],
+                               'stack_neighborhood': args.stack_neighborhood,
+                               'volumes_dtype': args.volumes_dtype}
+
+            with Timer("  Precomputing features"):
+                trainset_features = load_or_compute_features(trainset, trainset_volume_manager, features_directions, args.cache_features_dtype,
+                                                             pjoin(experiment_path, "trainset_features.npy"), args.train_subjects, features_params)
+                validset_features = load_or_compute_features(validset, validset_volume_manager, features_directions, args.cache_features_dtype,
+                                                             pjoin(experiment_path, "validset_features.npy"), args.valid_subjects, features_params)
+
+        batch_scheduler = batch_scheduler_factory(hyperparams, dataset=trainset, train_mode=True, features=trainset_features)
         print("An epoch will be composed of {} updates.".format(batch_scheduler.nb_updates_per_epoch))
 
         print("Volume data dimensions: {}".format(trainset_volume_manager.data_dimension))
@@ -367,11 +529,25 @@ def main():
                               volume_manager=trainset_volume_manager)
         model.initialize(weigths_initializer_factory(args.weights_initialization,
                                                      seed=args.initialization_seed))
+        model.use_precomputed_features = args.cache_features
 
         print("Network architecture: ", get_model_architecture(model))
 
     with Timer("Building optimizer"):
-        loss = loss_factory(hyperparams, model, trainset)
+        if hyperparams['tbptt_window'] is not None:
+            model.enable_truncated_bptt()
+
+        if args.workers is not None:
+            # Workers are forked before any Theano function is compiled.
+            data_parallel = DataParallel(model, lambda replica: loss_factory(hyperparams, replica, trainset), batch_scheduler,
+                                         nb_workers=args.workers, seed=hyperparams['seed'])
+            loss = data_parallel.loss
+            batch_scheduler = data_parallel.batch_scheduler
+        else:
+            loss = loss_factory(hyperparams, model, trainset)
+
+        if hyperparams['tbptt_window'] is not None:
+            batch_scheduler.set_model_states(model.init_states, model.final_states)
 
         if args.clip_gradient is not None:
             loss.append_gradient_modifier(DirectionClipping(threshold=args.clip_gradient))
@@ -381,6 +557,11 @@ def main():
     with Timer("Building trainer"):
         trainer = Trainer(optimizer, batch_scheduler)
 
+        profiler = None
+        if args.profile or args.profile_updates is not None:
+            profiler = TrainingProfiler(pjoin(experiment_path, "profiling"), profile_updates=args.profile_updates, profiler=args.profiler)
+            profiler.instrument(trainer, batch_scheduler)
+
         # Log training error
         loss_monitor = views.MonitorVariable(loss.loss)
         avg_loss = tasks.AveragePerEpoch(loss_monitor)
@@ -416,13 +597,32 @@ def main():
         # HACK: To make sure all subjects in the volume_manager are used in a batch, we have to split the trainset/validset in 2 volume managers
         model.volume_manager = validset_volume_manager
         model.drop_prob = 0.  # Do not use dropout/zoneout for evaluation
+        model.init_states = None  # Evaluate on whole streamlines (no TBPTT)
         valid_loss = loss_factory(hyperparams, model, validset)
         valid_batch_scheduler = batch_scheduler_factory(hyperparams,
                                                         dataset=validset,
-                                                        train_mode=False)
-
-        valid_error = views.LossView(loss=valid_loss, batch_scheduler=valid_batch_scheduler)
-        trainer.append_task(tasks.Print("Validset - Error        : {0:.2f} | {1:.2f}", valid_error.sum, valid_error.mean))
+                                                        train_mode=False,
+                                                        features=validset_features)
+        if args.cache_valid_batches:
+            valid_batch_scheduler = CachedBatchScheduler(valid_batch_scheduler, cache_dir=pjoin(experiment_path, "valid_batches", "full"))
+
+        valid_error = PeriodicLossView(loss=valid_loss, batch_scheduler=valid_batch_scheduler, each_k_epoch=hyperparams['full_valid_every'])
+        trainer.append_task(tasks.Print("Validset - Error        : {0:.2f} | {1:.2f}", valid_error.sum, valid_error.mean,
+                                        each_k_epoch=hyperparams['full_valid_every']))
+
+        if hyperparams['valid_subsample'] is not None:
+            valid_subsample_batch_scheduler = batch_scheduler_factory(hyperparams,
+                                                                      dataset=validset,
+                                                                      train_mode=False,
+                                                                      features=validset_features)
+            valid_subsample_batch_scheduler.indices = datasets.get_stratified_subsample_indices(validset, hyperparams['valid_subsample'])
+            print("Validset subsample size: {}".format(len(valid_subsample_batch_scheduler.indices)))
+            if args.cache_valid_batches:
+                valid_subsample_batch_scheduler = CachedBatchScheduler(valid_subsample_batch_scheduler,
+                                                                       cache_dir=pjoin(experiment_path, "valid_batches", "subsample"))
+
+            valid_subsample_error = views.LossView(loss=valid_loss, batch_scheduler=valid_subsample_batch_scheduler)
+            trainer.append_task(tasks.Print("Validset (subsample) - Error : {0:.2f} | {1:.2f}", valid_subsample_error.sum, valid_subsample_error.mean))
 
         if hyperparams['model'] == 'ffnn_regression':
             valid_batch_scheduler2 = batch_scheduler_factory(hyperparams,
@@ -438,6 +638,8 @@ def main():
         model.drop_prob = hyperparams['drop_prob']  # Restore dropout
 
         lookahead_loss = valid_error.sum
+        if hyperparams['early_stopping_on'] == 'subsample':
+            lookahead_loss = valid_subsample_error.sum
 
         direction_norm = views.MonitorVariable(T.sqrt(sum(map(lambda d: T.sqr(d).sum(), loss.gradients.values()))))
         # trainer.append_task(tasks.Print("||d|| : {0:.4f}", direction_norm))
@@ -464,17 +666,14 @@ def main():
 
             trainer.append_task(tasks.Callback(_plot))
 
-        # Callback function to stop training if NaN is detected.
-        def detect_nan(obj, status):
-            if np.isnan(model.parameters[0].get_value().sum()):
-                print("NaN detected! Stopping training now.")
-                sys.exit()
-
-        trainer.append_task(tasks.Callback(detect_nan, each_k_update=1))
+        # Stop training if NaN is detected and report gradient/parameter statistics.
+        trainer.append_task(HealthMonitor(loss, report_every=args.health_report_every))
 
         # Callback function to save training progression.
+        checkpoint_writer = utils.CheckpointWriter(experiment_path, keep_last=args.keep_checkpoints)
+
         def save_training(obj, status):
-            trainer.save(experiment_path)
+            checkpoint_writer.save_training(trainer, status.current_epoch)
 
         trainer.append_task(tasks.Callback(save_training))
 
@@ -486,7 +685,7 @@ def main():
                 sys.exit()
 
             print("*** Best epoch: {0} ***\n".format(obj.best_epoch))
-            model.save(experiment_path)
+            checkpoint_writer.save_model(model)
 
         # Print time for one epoch
         trainer.append_task(tasks.PrintEpochDuration())
@@ -498,6 +697,9 @@ def main():
         early_stopping = stopping_criteria.EarlyStopping(lookahead_loss, lookahead=args.lookahead, eps=args.lookahead_eps, callback=save_improvement)
         trainer.append_task(early_stopping)
 
+        if profiler is not None:
+            profiler.append_tasks(trainer)
+
     with Timer("Compiling Theano graph"):
         trainer.build_theano_graph()
 
@@ -512,6 +714,9 @@ def main():
     with Timer("Training"):
         trainer.train()
 
+    with Timer("Writing last checkpoint"):
+        checkpoint_writer.wait()
+
 
 if __name__ == "__main__":
     main()
@@ -63,6 +63,10 @@ def build_argparser():
                          help='file containing validation data (as generated by `process_mask_classifier_data.py`).')
     dataset.add_argument('--use-sh-coeffs', action='store_true',
                          help='if specified, use Spherical Harmonic coefficients as inputs to the model. Default: dwi coefficients.')
+    dataset.add_argument('--loading-processes', type=int, metavar='N', default=1,
+                         help='number of processes used to load and preprocess the subjects. Default: %(default)s')
+    dataset.add_argument('--loading-memory-budget', type=float, metavar='GB',
+                         help='if specified, limit the number of subjects loaded at once so they are expected to need at most GB gigabytes.')
 
     duration = p.add_argument_group("Training duration options")
     duration.add_argument('--max-epoch', type=int, metavar='N', default=100,
@@ -111,7 +115,7 @@ def main():
     print(args)
     print("Using Theano v.{}".format(theano.version.short_version))
 
-    hyperparams_to_exclude = ['max_epoch', 'force', 'name', 'view']
+    hyperparams_to_exclude = ['max_epoch', 'force', 'name', 'view', 'loading_processes', 'loading_memory_budget']
     # Use this for hyperparams added in a new version, but nonexistent from older versions
     retrocompatibility_defaults = {'use_layer_normalization': False}
     experiment_path, hyperparams, resuming = utils.maybe_create_experiment_folder(args, exclude=hyperparams_to_exclude,
@@ -124,12 +128,15 @@ def main():
     print("Resuming:" if resuming else "Creating:", experiment_path)
 
     with Timer("Loading dataset", newline=True):
+        loading_memory_budget = None if args.loading_memory_budget is None else int(args.loading_memory_budget * 1024**3)
         trainset_volume_manager = VolumeManager()
         validset_volume_manager = VolumeManager()
         trainset = datasets.load_mask_classifier_dataset(args.train_subjects, trainset_volume_manager, name="trainset",
-                                                         use_sh_coeffs=args.use_sh_coeffs)
+                                                         use_sh_coeffs=args.use_sh_coeffs, nb_processes=args.loading_processes,
+                                                         memory_budget=loading_memory_budget)
         validset = datasets.load_mask_classifier_dataset(args.valid_subjects, validset_volume_manager, name="validset",
-                                                         use_sh_coeffs=args.use_sh_coeffs)
+                                                         use_sh_coeffs=args.use_sh_coeffs, nb_processes=args.loading_processes,
+                                                         memory_budget=loading_memory_budget)
         print("Dataset sizes:", len(trainset), " |", len(validset))
 
         batch_scheduler = MaskClassifierBatchScheduler(trainset, hyperparams['batch_size'], seed=hyperparams['seed'])
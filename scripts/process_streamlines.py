@@ -43,8 +43,9 @@ def build_argparser():
                                     help="Downsample every bundle using QuickBundles. "
                                          "A clustering threshold of 6 and a removal distance of 2 are used by default, but can be changed. "
                                          "NOTE: Changing the default values will have no effect if this flag is not given")
-    subsampling_parser.add_argument('--clustering_threshold', default=6, help="Threshold used to cluster streamlines before computing distance matrix")
-    subsampling_parser.add_argument('--removal_distance', default=2, help="Streamlines closer than this distance will be reduced to a single streamline")
+    subsampling_parser.add_argument('--clustering_threshold', type=float, default=6, help="Threshold used to cluster streamlines before removing similar ones")
+    subsampling_parser.add_argument('--removal_distance', type=float, default=2, help="Streamlines closer than this distance will be reduced to a single streamline")
+    subsampling_parser.add_argument('--nb-processes', type=int, default=1, help="Number of processes used to subsample the clusters of a bundle")
 
     # General options (optional)
     general_parser = argparse.ArgumentParser(add_help=False)
@@ -122,7 +123,7 @@ def main():
             if len(streamlines) > 0:
                 if args.subsample_streamlines:
                     output_streamlines = subsample_streamlines(streamlines, args.clustering_threshold,
-                                                               args.removal_distance)
+                                                               args.removal_distance, nb_processes=args.nb_processes)
 
                     print("Total difference: {} / {}".format(len(original_streamlines), len(output_streamlines)))
                     new_tractogram = nib.streamlines.Tractogram(output_streamlines,
@@ -4,6 +4,7 @@
 import sys
 
 import os
+import hashlib
 
 # Hack so you don't have to put the library containing this script in the PYTHONPATH.
 sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
@@ -14,17 +15,17 @@ from os.path import join as pjoin
 
 import theano
 import time
+import json
+from contextlib import contextmanager
 
 import dipy
 import nibabel as nib
 from nibabel.streamlines import Tractogram
 from dipy.tracking.streamline import compress_streamlines
 
-from smartlearner import views
 from smartlearner import utils as smartutils
 
-from learn2track import datasets
-from learn2track.factories import loss_factory, batch_scheduler_factory
+from learn2track.factories import step_loss_factory
 from learn2track.utils import Timer
 
 from learn2track import neurotools
@@ -37,6 +38,8 @@ STOPPING_LENGTH =     int('00000010', 2)
 STOPPING_CURVATURE =  int('00000100', 2)
 STOPPING_LIKELIHOOD = int('00001000', 2)
 
+RNG_SEED = 1234  # Random streams of the chunk of seeds starting at `start` use `RNG_SEED + 2*start` (+1 for backward tracking).
+
 
 def build_argparser():
     DESCRIPTION = "Generate a tractogram from a LSTM model trained on ismrm2015 challenge data."
@@ -53,8 +56,14 @@ def build_argparser():
                    help="use extermities of the streamlines in these tractograms (.trk|.tck) as seed points.")
     p.add_argument('--nb-seeds-per-voxel', type=int, default=1,
                    help="number of seeds per voxel, only if --seeds is a seeding mask (i.e. a nifti file). Default: 1")
+    p.add_argument('--samples-per-seed', type=int, default=1,
+                   help="number of streamlines to sample from every seed. Unlike --nb-seeds-per-voxel, the first step"
+                        " of a seed is only computed once then forked. Only for gru_gaussian and gru_mixture models. Default: 1")
     p.add_argument('--seeding-rng-seed', type=int, default=1234,
                    help="seed for the random generator responsible of generating the seeds in the voxels. Default: 1234")
+    p.add_argument('--seed-ordering', choices=["none", "morton", "hilbert"], default="none",
+                   help="order seeds along a space-filling curve before batching them, so streamlines tracked"
+                        " at the same time access nearby parts of the volume. Default: none")
 
     deviation_angle = p.add_mutually_exclusive_group()
     deviation_angle.add_argument('--theta', metavar='ANGLE', type=float,
@@ -74,6 +83,9 @@ def build_argparser():
                    help="If specified, only streamlines with a loss value lower than the specified value will be kept.")
 
     p.add_argument('--batch-size', type=int, help="number of streamlines to process at the same time. Default: the biggest possible")
+    p.add_argument('--checkpoint-dir', type=str,
+                   help="if specified, streamlines of every completed chunk of seeds are saved in this folder."
+                        " Rerunning the same command will resume tracking from there.")
 
     p.add_argument('--dilate-mask', action="store_true",
                    help="if specified, apply binary dilation on the tracking mask.")
@@ -110,6 +122,11 @@ def build_argparser():
     # Other options
     p.add_argument('--save-rejected', action="store_true",
                    help="if specified, save rejected streamlines in a separate file")
+    p.add_argument('--metrics-file', type=str,
+                   help="if specified, periodically write tracking metrics (timings, active sprouts, stopping reasons) in this file."
+                        " Use a '.prom' extension for the Prometheus text format, otherwise metrics are appended as JSON lines.")
+    p.add_argument('--metrics-interval', type=float, default=10.,
+                   help="minimum number of seconds between two writes of the metrics. Default: 10")
 
     deprecated = p.add_argument_group("Deprecated")
     deprecated.add_argument('--append-previous-direction', action="store_true",
@@ -135,22 +152,6 @@ def count_flags(flags, ref_flag):
     return is_flag_set(flags, ref_flag).sum()
 
 
-def compute_loss_errors(streamlines, model, hyperparams):
-    # Create dummy dataset for these new streamlines.
-    tracto_data = neurotools.TractographyData(None, None, None)
-    tracto_data.add(streamlines, bundle_name="Generated")
-    tracto_data.subject_id = 0
-    dataset = datasets.TractographyDataset([tracto_data], "Generated", keep_on_cpu=True)
-
-    # Override K for gru_multistep
-    if 'k' in hyperparams:
-        hyperparams['k'] = 1
-    batch_scheduler = batch_scheduler_factory(hyperparams, dataset, train_mode=False, batch_size_override=1000, use_data_augment=False)
-    loss = loss_factory(hyperparams, model, dataset)
-    loss_view = views.LossView(loss=loss, batch_scheduler=batch_scheduler)
-    return loss_view.losses.view()
-
-
 def make_is_outside_mask(mask, affine, threshold=0):
     """ Makes a function that checks which streamlines have their last coordinates outside a mask.
 
@@ -367,12 +368,150 @@ def rotate(directions, axis, degree=180):
     return np.stack(new_directions, axis=0)
 
 
+STOPPING_FLAGS = [("mask", STOPPING_MASK), ("length", STOPPING_LENGTH), ("curvature", STOPPING_CURVATURE), ("likelihood", STOPPING_LIKELIHOOD)]
+
+
+class TrackingMetrics(object):
+    """ Collects timings and counters while tracking.
+
+    Parameters
+    ----------
+    filename : str, optional
+        If provided, metrics are periodically written in this file. If it ends with '.prom', the file is
+        overwritten with the latest metrics in the Prometheus text format (e.g. for node_exporter's textfile
+        collector). Otherwise, a snapshot of the metrics is appended as a JSON line.
+    interval : float, optional
+        Minimum number of seconds between two writes. Default: 10 sec.
+    """
+    PHASES = ["model", "stopping", "harvest", "regrow", "history"]
+
+    def __init__(self, filename=None, interval=10.):
+        self.filename = filename
+        self.interval = interval
+        self.times = {phase: 0. for phase in self.PHASES}
+        self.nb_steps = 0
+        self.nb_points = 0
+        self.nb_active_sprouts = 0
+        self.nb_streamlines = 0
+        self.stopping_reasons = {name: 0 for name, _ in STOPPING_FLAGS}
+        self._nested_times = []
+        self._start_time = time.time()
+        self._last_write = self._start_time
+
+    @contextmanager
+    def timer(self, phase):
+        """ Times a phase, excluding the time spent in nested phases (e.g. stopping checks during harvest). """
+        start = time.perf_counter()
+        self._nested_times.append(0.)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.times[phase] += elapsed - self._nested_times.pop()
+            if len(self._nested_times) > 0:
+                self._nested_times[-1] += elapsed
+
+    def record_step(self, nb_active_sprouts):
+        self.nb_steps += 1
+        self.nb_points += nb_active_sprouts
+        self.nb_active_sprouts = nb_active_sprouts
+
+    def record_harvest(self, stopping_flags):
+        self.nb_streamlines += len(stopping_flags)
+        for name, flag in STOPPING_FLAGS:
+            self.stopping_reasons[name] += int(count_flags(stopping_flags, flag))
+
+    def to_dict(self):
+        return {'time': time.time(),
+                'elapsed': time.time() - self._start_time,
+                'nb_steps': self.nb_steps,
+                'nb_points': self.nb_points,
+                'nb_active_sprouts': self.nb_active_sprouts,
+                'nb_streamlines': self.nb_streamlines,
+                'stopping_reasons': dict(self.stopping_reasons),
+                'times': dict(self.times)}
+
+    def to_prometheus(self):
+        metrics = self.to_dict()
+        lines = ["# TYPE learn2track_tracking_steps_total counter",
+                 "learn2track_tracking_steps_total {}".format(metrics['nb_steps']),
+                 "# TYPE learn2track_tracking_points_total counter",
+                 "learn2track_tracking_points_total {}".format(metrics['nb_points']),
+                 "# TYPE learn2track_tracking_active_sprouts gauge",
+                 "learn2track_tracking_active_sprouts {}".format(metrics['nb_active_sprouts']),
+                 "# TYPE learn2track_tracking_streamlines_total counter",
+                 "learn2track_tracking_streamlines_total {}".format(metrics['nb_streamlines']),
+                 "# TYPE learn2track_tracking_stopped_total counter"]
+        lines += ['learn2track_tracking_stopped_total{{reason="{}"}} {}'.format(name, count)
+                  for name, count in metrics['stopping_reasons'].items()]
+        lines += ["# TYPE learn2track_tracking_seconds_total counter"]
+        lines += ['learn2track_tracking_seconds_total{{phase="{}"}} {:.6f}'.format(phase, elapsed)
+                  for phase, elapsed in metrics['times'].items()]
+        return "\n".join(lines) + "\n"
+
+    def write(self, force=False):
+        """ Writes the metrics, if enough time has passed since the last write. """
+        if self.filename is None or (not force and time.time() - self._last_write < self.interval):
+            return
+
+        self._last_write = time.time()
+        if self.filename.endswith(".prom"):
+            # Write to a temporary file first so the metrics are never read half-written.
+            with open(self.filename + ".tmp", 'w') as f:
+                f.write(self.to_prometheus())
+
+            os.replace(self.filename + ".tmp", self.filename)
+        else:
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(self.to_dict()) + "\n")
+
+    def summary(self):
+        total = sum(self.times.values())
+        times = ", ".join("{}: {:.1f}s ({:.0%})".format(phase, elapsed, elapsed / total if total > 0 else 0)
+                          for phase, elapsed in self.times.items())
+        reasons = ", ".join("{}: {:,}".format(name, count) for name, count in self.stopping_reasons.items())
+        return "{:,} steps, {:,} points, {:,} streamlines.\n  Time per phase - {}\n  Stopped because of - {}".format(
+            self.nb_steps, self.nb_points, self.nb_streamlines, times, reasons)
+
+
 class Tracker(object):
-    def __init__(self, model, is_stopping, keep_last_n_states=1, use_max_component=False, flip_x=False, flip_y=False, flip_z=False, compress_streamlines=False):
+    def __init__(self, model, is_stopping, keep_last_n_states=1, use_max_component=False, flip_x=False, flip_y=False, flip_z=False, compress_streamlines=False,
+                 step_loss=None, filter_threshold=None, keep_rejected=False, samples_per_seed=1, rng_seed=None, metrics=None):
+        """
+        Parameters
+        ----------
+        step_loss : function, optional
+            If provided, the loss of every step is accumulated while sprouts are growing (see `step_loss_factory`).
+            Harvested streamlines will have their mean loss in `data_per_streamline['loss']`.
+        filter_threshold : float, optional
+            If provided (requires `step_loss`), only harvest streamlines with a loss lower or equal than this value.
+        keep_rejected : bool, optional
+            If specified, streamlines filtered out at harvest are kept in `self.rejected_tractogram`.
+        samples_per_seed : int, optional
+            Number of streamlines to sample from every seed. The first step is computed once per seed,
+            then sprouts are forked (requires a model supporting `samples_per_input`, e.g. `GRU_Gaussian`).
+        rng_seed : int, optional
+            If provided, the random stream used to sample directions is restarted from this seed, so the
+            streamlines don't depend on what the model's sequence generators have been used for before.
+        metrics : `TrackingMetrics` object, optional
+            If provided, timings and counters are collected there.
+        """
         self.model = model
+        self.metrics = TrackingMetrics() if metrics is None else metrics
         self.learn_to_stop = model.learn_to_stop
         self._is_stopping = is_stopping
-        self.grower = model.make_sequence_generator(use_max_component=use_max_component)
+        self.step_loss = step_loss
+        self.track_loss = step_loss is not None
+        self.grower = model.make_sequence_generator(use_max_component=use_max_component, return_regression_output=self.track_loss)
+        self.samples_per_seed = samples_per_seed
+        if self.samples_per_seed > 1:
+            self.forking_grower = model.make_sequence_generator(use_max_component=use_max_component, return_regression_output=self.track_loss,
+                                                                samples_per_input=self.samples_per_seed)
+
+        if rng_seed is not None:
+            for grower in [self.grower, getattr(self, "forking_grower", None)]:
+                if hasattr(grower, "seed"):  # Only stochastic growers have a random stream.
+                    grower.seed(rng_seed)
         self.keep_last_n_states = max(keep_last_n_states, 1)
         self._history = []
         self.flip_x = flip_x
@@ -380,21 +519,32 @@ class Tracker(object):
         self.flip_z = flip_z
         self.compress_streamlines = compress_streamlines
 
+        self.filter_threshold = filter_threshold
+        if self.filter_threshold is not None:
+            assert self.track_loss, "Filtering streamlines at harvest needs `step_loss`."
+
+        self.keep_rejected = keep_rejected
+        self.rejected_tractogram = None
+        self.nb_rejected = 0
+
     @property
     def states(self):
         return self._states
 
     @states.setter
     def states(self, values):
-        # Add new states to history; free space if needed.
-        self._history += [self._states.copy()]
-        if len(self._history) > self.keep_last_n_states:
-            self._history = self._history[1:]
+        with self.metrics.timer("history"):
+            # Add new states to history; free space if needed.
+            self._history += [self._states.copy()]
+            if len(self._history) > self.keep_last_n_states:
+                self._history = self._history[1:]
 
-        self._states = values.copy()
+            self._states = values.copy()
 
     def is_stopping(self, sprouts, sprouts_stop):
-        undone, done, stopping_flags = self._is_stopping(sprouts, sprouts_stop)
+        with self.metrics.timer("stopping"):
+            undone, done, stopping_flags = self._is_stopping(sprouts, sprouts_stop)
+
         return undone, done, stopping_flags
 
     def is_ripe(self):
@@ -410,9 +560,11 @@ class Tracker(object):
 
         self.sprouts = seeds.copy()
         self.sprouts_stop = np.ones((self.sprouts.shape[0], 1))
+        self.sprouts_losses = np.zeros((self.sprouts.shape[0], 0), dtype=np.float32)
         self._states = self.model.get_init_states(batch_size=len(seeds))
 
-    def _grow_step(self, sprouts, states, step_size):
+    def _grow_step(self, sprouts, states, step_size, grower=None):
+        grower = self.grower if grower is None else grower
 
         # Always feed previous direction, grower will choose to use it or not
         if sprouts.shape[1] >= 2:
@@ -423,7 +575,12 @@ class Tracker(object):
         previous_direction = previous_direction / np.sqrt(np.sum(previous_direction ** 2, axis=1, keepdims=True) + 1e-6)
 
         # Get next unnormalized directions
-        outputs, new_states = self.grower(x_t=sprouts[:, -1, :], states=states, previous_direction=previous_direction)
+        regression_output = None
+        with self.metrics.timer("model"):
+            if self.track_loss:
+                outputs, new_states, regression_output = grower(x_t=sprouts[:, -1, :], states=states, previous_direction=previous_direction)
+            else:
+                outputs, new_states = grower(x_t=sprouts[:, -1, :], states=states, previous_direction=previous_direction)
 
         if self.learn_to_stop:
             directions, stopping = outputs
@@ -443,17 +600,49 @@ class Tracker(object):
             normalized_directions = directions / np.sqrt(np.sum(directions**2, axis=1, keepdims=True))
             directions = normalized_directions * step_size
 
+        if len(directions) > len(sprouts):
+            # The grower forked the sprouts, i.e. it sampled multiple directions per sprout.
+            sprouts = np.repeat(sprouts, len(directions) // len(sprouts), axis=0)
+
         # Take a step i.e. it's growing!
         new_sprouts = np.concatenate([sprouts, sprouts[:, [-1], :] + directions[:, None, :]], axis=1)
-        return new_sprouts, stopping, new_states
+        return new_sprouts, stopping, new_states, regression_output
+
+    def _grow_losses(self, losses, sprouts, regression_output):
+        """ Appends the loss of the last step taken by every sprout. """
+        if not self.track_loss:
+            return losses
+
+        # Use the step that was actually taken (i.e. after flipping and rescaling).
+        step_losses = self.step_loss(regression_output, sprouts[:, -1] - sprouts[:, -2])
+        return np.concatenate([losses, step_losses[:, None].astype(losses.dtype)], axis=1)
 
     def grow(self, step_size):
-        self.sprouts, self.sprouts_stop, self.states = self._grow_step(self.sprouts, self.states, step_size)
+        if self.samples_per_seed > 1 and self.sprouts.shape[1] == 1:
+            self._fork_and_grow(step_size)
+            return
+
+        self.sprouts, self.sprouts_stop, self.states, regression_output = self._grow_step(self.sprouts, self.states, step_size)
+        self.sprouts_losses = self._grow_losses(self.sprouts_losses, self.sprouts, regression_output)
+
+    def _fork_and_grow(self, step_size):
+        """ Takes the first step of every seed once and forks it into `samples_per_seed` sprouts. """
+        self.sprouts, self.sprouts_stop, new_states, regression_output = self._grow_step(self.sprouts, self.states, step_size,
+                                                                                         grower=self.forking_grower)
+
+        # Fork the history as well, so regrowing can still backtrack.
+        self._history = [[np.repeat(s, self.samples_per_seed, axis=0) for s in states] for states in self._history]
+        self._states = [np.repeat(s, self.samples_per_seed, axis=0) for s in self._states]
+        self.states = new_states
+
+        self.sprouts_losses = np.repeat(self.sprouts_losses, self.samples_per_seed, axis=0)
+        self.sprouts_losses = self._grow_losses(self.sprouts_losses, self.sprouts, regression_output)
 
     def _keep(self, idx):
         # Update remaining sprouts and their states.
         self.sprouts = self.sprouts[idx]
         self.sprouts_stop = self.sprouts_stop[idx]
+        self.sprouts_losses = self.sprouts_losses[idx]
         self._states = [s[idx] for s in self._states]
 
         # Rewrite history
@@ -462,14 +651,36 @@ class Tracker(object):
 
     def harvest(self):
         undone, done, stopping_flags = self.is_stopping(self.sprouts, self.sprouts_stop)
+        self.metrics.record_harvest(stopping_flags)
 
         # Do not keep last point since it almost surely raised the stopping flag.
         streamlines = list(self.sprouts[done, :-1])
         if self.compress_streamlines:
             streamlines = compress_streamlines(streamlines)
 
+        data_per_streamline = {"stopping_flags": stopping_flags}
+        if self.track_loss:
+            # Likewise, do not count the loss of the last step.
+            losses = self.sprouts_losses[done, :-1]
+            if losses.shape[1] > 0:
+                data_per_streamline["loss"] = losses.mean(axis=1)
+            else:
+                data_per_streamline["loss"] = np.zeros(len(losses), dtype=np.float32)
+
         tractogram = Tractogram(streamlines=streamlines,
-                                data_per_streamline={"stopping_flags": stopping_flags})
+                                data_per_streamline=data_per_streamline)
+
+        if self.filter_threshold is not None:
+            # Remove streamlines that produces a loss higher than a certain threshold.
+            losses = data_per_streamline["loss"]
+            self.nb_rejected += np.sum(losses > self.filter_threshold)
+            if self.keep_rejected:
+                if self.rejected_tractogram is None:
+                    self.rejected_tractogram = tractogram[losses > self.filter_threshold]
+                else:
+                    self.rejected_tractogram += tractogram[losses > self.filter_threshold]
+
+            tractogram = tractogram[losses <= self.filter_threshold]
 
         # Keep only undone sprouts
         self._keep(undone)
@@ -483,6 +694,7 @@ class Tracker(object):
 
         # Get sprouts that needs regrowing.
         sprouts = self.sprouts[idx, :-backtrack_n_steps]
+        losses = self.sprouts_losses[idx, :-backtrack_n_steps]
         stopping = np.ones((sprouts.shape[0], 1))
         states = [s[idx] for s in self._history[-backtrack_n_steps]]
         idx_to_keep = np.arange(len(sprouts))
@@ -494,11 +706,13 @@ class Tracker(object):
                 return 0
 
             local_history += [states]
-            sprouts, stopping, states = self._grow_step(sprouts, states, step_size)
+            sprouts, stopping, states, regression_output = self._grow_step(sprouts, states, step_size)
+            losses = self._grow_losses(losses, sprouts, regression_output)
 
             undone, _, _ = self.is_stopping(sprouts, stopping)
             sprouts = sprouts[undone]
             stopping = stopping[undone]
+            losses = losses[undone]
             states = [s[undone] for s in states]
             idx_to_keep = idx_to_keep[undone]
 
@@ -509,6 +723,7 @@ class Tracker(object):
         # Update original sprouts and their states.
         self.sprouts[idx[idx_to_keep]] = sprouts
         self.sprouts_stop[idx[idx_to_keep]] = stopping
+        self.sprouts_losses[idx[idx_to_keep]] = losses
         for i, state in enumerate(self._states):
             self._states[i][idx[idx_to_keep]] = states[i]
 
@@ -570,10 +785,11 @@ class BackwardTracker(Tracker):
         self.seeds = seeds
         self.nb_init_steps = np.asarray(list(map(len, seeds)))
         self.sprouts = np.asarray([s[0] for s in seeds])[:, None, :]
+        self.sprouts_losses = np.zeros((len(seeds), 0), dtype=np.float32)
         self._states = self.model.get_init_states(batch_size=len(seeds))
 
     def is_stopping(self, sprouts, sprouts_stop):
-        undone, done, stopping_flags = self._is_stopping(sprouts, sprouts_stop)
+        undone, done, stopping_flags = super().is_stopping(sprouts, sprouts_stop)
 
         # Ignore sprouts that haven't finished initializing.
         init_undone = self.nb_init_steps >= self.sprouts.shape[1]
@@ -588,7 +804,7 @@ class BackwardTracker(Tracker):
         return undone, done, stopping_flags
 
     def grow(self, step_size):
-        new_sprouts, stopping, self.states = self._grow_step(self.sprouts, self.states, step_size)
+        new_sprouts, stopping, self.states, regression_output = self._grow_step(self.sprouts, self.states, step_size)
 
         # Only update sprouts once they are done initializing.
         # However always update their states.
@@ -599,6 +815,8 @@ class BackwardTracker(Tracker):
 
         self.sprouts = new_sprouts
         self.sprouts_stop = stopping
+        # Initializing sprouts are scored against the points they were forced to follow.
+        self.sprouts_losses = self._grow_losses(self.sprouts_losses, self.sprouts, regression_output)
 
     def regrow(self, idx, step_size, backtrack_n_steps):
         init_done = self.nb_init_steps < self.sprouts.shape[1]
@@ -619,6 +837,142 @@ class BackwardPeterTracker(BackwardTracker, PeterTracker):
         return PeterTracker.regrow(self, idx, step_size, backtrack_n_steps)
 
 
+class TrackingCheckpoint(object):
+    """ Keeps track of which chunks of seeds have already been tracked.
+
+    Streamlines harvested from each chunk are saved (in voxel space) in their own
+    shard file and a manifest lists the seed ranges that are completed. Shards are
+    never modified once written, so a killed job can be restarted and will only
+    track the chunks that are missing.
+
+    Parameters
+    ----------
+    checkpoint_dir : str
+        Folder where the manifest and the shards are saved.
+    seeds : 2D array
+        Seeds (in voxel space) used for tracking. They are used to make sure
+        we resume the same tracking job.
+    params : dict, optional
+        Everything else the streamlines depend on (model, step size, stopping criteria, ...).
+        Values must be JSON serializable, they are compared when resuming.
+    """
+    MANIFEST = "manifest.json"
+
+    def __init__(self, checkpoint_dir, seeds, params=None):
+        self.checkpoint_dir = checkpoint_dir
+        self.manifest_file = pjoin(checkpoint_dir, self.MANIFEST)
+        self.seeds_hash = hashlib.sha256(np.ascontiguousarray(seeds).tobytes()).hexdigest()
+        self.nb_seeds = len(seeds)
+        # Round trip through JSON so values compare the same way once reloaded (e.g. tuples become lists).
+        self.params = json.loads(json.dumps(params if params is not None else {}, sort_keys=True))
+        self.chunks = []
+
+        if os.path.isfile(self.manifest_file):
+            manifest = smartutils.load_dict_from_json_file(self.manifest_file)
+            if manifest['seeds_hash'] != self.seeds_hash or manifest['nb_seeds'] != self.nb_seeds:
+                raise ValueError("Checkpoint '{}' was created with different seeds!".format(checkpoint_dir))
+
+            saved_params = manifest.get('params', {})
+            different = sorted(k for k in set(saved_params) | set(self.params) if saved_params.get(k) != self.params.get(k))
+            if len(different) > 0:
+                raise ValueError("Checkpoint '{}' was created with different tracking parameters: {}!".format(checkpoint_dir, ", ".join(different)))
+
+            self.chunks = manifest['chunks']
+        else:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            self._save_manifest()
+
+    def update_params(self, **params):
+        """ Changes some parameters of the tracking job, only possible before any chunk is completed. """
+        if len(self.chunks) > 0:
+            raise ValueError("Checkpoint '{}' already has completed chunks, its parameters can't change: {}!".format(
+                self.checkpoint_dir, ", ".join(sorted(params))))
+
+        self.params.update(json.loads(json.dumps(params, sort_keys=True)))
+        self._save_manifest()
+
+    @property
+    def nb_completed_seeds(self):
+        return sum(chunk['end'] - chunk['start'] for chunk in self.chunks)
+
+    def get_chunk(self, start):
+        """ Returns the completed chunk beginning at `start`, if any. """
+        for chunk in self.chunks:
+            if chunk['start'] == start:
+                return chunk
+
+        return None
+
+    def next_start(self, start):
+        """ Returns the beginning of the first completed chunk after `start`. """
+        starts = [chunk['start'] for chunk in self.chunks if chunk['start'] > start]
+        return min(starts, default=self.nb_seeds)
+
+    def add_chunk(self, start, end, tractogram, rejected_tractogram=None, nb_rejected=0):
+        chunk = {'start': int(start), 'end': int(end),
+                 'shard': "chunk_{:012d}-{:012d}.npz".format(start, end),
+                 'nb_streamlines': len(tractogram),
+                 'nb_rejected': int(nb_rejected)}
+        self._save_shard(chunk['shard'], tractogram)
+
+        if rejected_tractogram is not None:
+            chunk['rejected_shard'] = "rejected_" + chunk['shard']
+            self._save_shard(chunk['rejected_shard'], rejected_tractogram)
+
+        # Only mark the chunk as completed once its shards are safely on disk.
+        self.chunks.append(chunk)
+        self._save_manifest()
+
+    def load_chunk(self, chunk, rejected=False):
+        shard = chunk.get('rejected_shard') if rejected else chunk['shard']
+        if shard is None:
+            return None
+
+        return self._load_shard(shard)
+
+    def merge(self, rejected=False):
+        """ Concatenates the shards of all completed chunks, ordered by seed index. """
+        shards = [self.load_chunk(chunk, rejected) for chunk in sorted(self.chunks, key=lambda c: c['start'])]
+        shards = [shard for shard in shards if shard is not None]
+        if len(shards) == 0:
+            return Tractogram()
+
+        tractogram = shards[0]
+        for shard in shards[1:]:
+            tractogram += shard
+
+        return tractogram
+
+    def _save_manifest(self):
+        manifest = {'version': 2,
+                    'nb_seeds': self.nb_seeds,
+                    'seeds_hash': self.seeds_hash,
+                    'params': self.params,
+                    'chunks': self.chunks}
+
+        # Write to a temporary file first so a crash can't leave a corrupted manifest.
+        tmp_file = self.manifest_file + ".tmp"
+        smartutils.save_dict_to_json_file(tmp_file, manifest)
+        os.replace(tmp_file, self.manifest_file)
+
+    def _save_shard(self, filename, tractogram):
+        streamlines = tractogram.streamlines
+        arrays = {'points': np.concatenate(list(streamlines)) if len(streamlines) > 0 else np.zeros((0, 3), dtype=floatX),
+                  'lengths': np.asarray(list(map(len, streamlines)), dtype=np.int64)}
+        for k, v in tractogram.data_per_streamline.items():
+            arrays['dps_' + k] = np.asarray(v)
+
+        tmp_file = pjoin(self.checkpoint_dir, filename + ".tmp.npz")
+        np.savez(tmp_file, **arrays)
+        os.replace(tmp_file, pjoin(self.checkpoint_dir, filename))
+
+    def _load_shard(self, filename):
+        shard = np.load(pjoin(self.checkpoint_dir, filename))
+        streamlines = np.split(shard['points'], np.cumsum(shard['lengths'])[:-1]) if len(shard['lengths']) > 0 else []
+        data_per_streamline = {k[len('dps_'):]: shard[k] for k in shard.files if k.startswith('dps_')}
+        return Tractogram(streamlines=streamlines, data_per_streamline=data_per_streamline)
+
+
 def track(tracker, seeds, step_size, is_stopping, nb_retry=0, nb_backtrack_steps=0, verbose=False):
     """ Generates streamlines using the Particle Filtering Tractography algorithm.
 
@@ -635,6 +989,7 @@ def track(tracker, seeds, step_size, is_stopping, nb_retry=0, nb_backtrack_steps
     """
     tractogram = None
     tracker.plant(seeds)
+    metrics = tracker.metrics
 
     i = 1
     while not tracker.is_ripe():
@@ -642,6 +997,7 @@ def track(tracker, seeds, step_size, is_stopping, nb_retry=0, nb_backtrack_steps
             print("pts: {}/{} ({:,} remaining)".format(i+1, is_stopping.max_nb_points, len(tracker.sprouts)), end="")
 
         tracker.grow(step_size)
+        metrics.record_step(len(tracker.sprouts))
 
         for _ in range(nb_retry):
             if verbose:
@@ -654,17 +1010,22 @@ def track(tracker, seeds, step_size, is_stopping, nb_retry=0, nb_backtrack_steps
                     # No sprouts to be saved.
                     break
 
-                nb_saved = tracker.regrow(idx, step_size, backtrack_n_steps=backtrack_n_steps)
+                with metrics.timer("regrow"):
+                    nb_saved = tracker.regrow(idx, step_size, backtrack_n_steps=backtrack_n_steps)
+
                 print("{}/{} saved.".format(nb_saved, len(idx)))
 
             if len(idx) == 0:
                 # No sprouts to be saved.
                 break
 
-        if tractogram is None:
-            tractogram = tracker.harvest()
-        else:
-            tractogram += tracker.harvest()
+        with metrics.timer("harvest"):
+            if tractogram is None:
+                tractogram = tracker.harvest()
+            else:
+                tractogram += tracker.harvest()
+
+        metrics.write()
 
         if verbose and nb_retry == 0:
             print("")
@@ -674,9 +1035,55 @@ def track(tracker, seeds, step_size, is_stopping, nb_retry=0, nb_backtrack_steps
     return tractogram
 
 
-def batch_track(model, dwi, seeds, step_size, batch_size, is_stopping, args):
+def hash_model_parameters(model):
+    """ Fingerprint of the model's weights, e.g. to make sure a checkpoint is resumed with the same model. """
+    sha = hashlib.sha256()
+    for param in model.parameters:
+        sha.update(np.ascontiguousarray(param.get_value()).tobytes())
+
+    return sha.hexdigest()
+
+
+def batch_track(model, dwi, seeds, step_size, batch_size, is_stopping, args, step_loss=None, filter_threshold=None, rejected_tractogram=None,
+                checkpoint_dir=None, checkpoint_params=None, samples_per_seed=1, metrics=None):
+    """
+    Parameters
+    ----------
+    step_loss : function, optional
+        If provided, the loss of each streamline is accumulated while tracking and
+        stored in `data_per_streamline['loss']` (see `step_loss_factory`).
+    filter_threshold : float, optional
+        If provided, streamlines with a loss higher than this value are discarded as they are harvested.
+    rejected_tractogram : `nib.streamlines.Tractogram` object, optional
+        If provided, streamlines discarded because of `filter_threshold` are appended to it (in voxel space).
+    checkpoint_dir : str, optional
+        If provided, streamlines of every completed chunk of seeds are saved in this folder
+        and chunks already completed by a previous (interrupted) run are not tracked again.
+    checkpoint_params : dict, optional
+        Parameters of the tracking job not given to this function (e.g. stopping criteria). A checkpoint
+        can only be resumed with the same ones, the same model and the same tracking options.
+    samples_per_seed : int, optional
+        Number of streamlines to sample from every seed (see `Tracker`).
+    metrics : `TrackingMetrics` object, optional
+        If provided, timings and counters of both forward and backward tracking are collected there.
+    """
     if batch_size is None:
-        batch_size = len(seeds)
+        batch_size = len(seeds) * samples_per_seed
+
+    checkpoint = None
+    if checkpoint_dir is not None:
+        params = dict(checkpoint_params if checkpoint_params is not None else {},
+                      model=hash_model_parameters(model),
+                      step_size=None if step_size is None else float(step_size),
+                      filter_threshold=filter_threshold,
+                      samples_per_seed=samples_per_seed,
+                      # Random streams are seeded per chunk, so streamlines depend on where chunks start.
+                      chunk_size=max(batch_size // samples_per_seed, 1),
+                      **{k: getattr(args, k) for k in ['track_like_peter', 'pft_nb_retry', 'pft_nb_backtrack_steps',
+                                                        'use_max_component', 'flip_x', 'flip_y', 'flip_z']})
+        checkpoint = TrackingCheckpoint(checkpoint_dir, seeds, params)
+        if len(checkpoint.chunks) > 0:
+            print("Resuming from checkpoint: {:,} / {:,} seeds already tracked.".format(checkpoint.nb_completed_seeds, len(seeds)))
 
     nb_retry = 1 if args.track_like_peter else args.pft_nb_retry
     nb_backtrack_steps = 1 if args.track_like_peter else args.pft_nb_backtrack_steps
@@ -688,14 +1095,29 @@ def batch_track(model, dwi, seeds, step_size, batch_size, is_stopping, args):
             time.sleep(1)
             print("Trying to track {:,} streamlines at the same time.".format(batch_size))
             tractogram = None#nib.streamlines.Tractogram()
+            rejected_tractograms = []
+            nb_rejected = 0
+
+            start = 0
+            while start < len(seeds):
+                chunk = checkpoint.get_chunk(start) if checkpoint is not None else None
+                if chunk is not None:
+                    # Already tracked by a previous run, shards will be merged at the end.
+                    nb_rejected += chunk['nb_rejected']
+                    start = chunk['end']
+                    continue
 
-            for start in range(0, len(seeds), batch_size):
                 print("{:,} / {:,}".format(start, len(seeds)))
-                end = start + batch_size
+                # Every seed produces `samples_per_seed` sprouts.
+                end = min(start + max(batch_size // samples_per_seed, 1), len(seeds))
+                if checkpoint is not None:
+                    end = min(end, checkpoint.next_start(start))
 
                 # Forward tracking
+                # Random streams are seeded from the chunk, so a resumed job samples the same directions.
                 tracker = TrackerCls(model, is_stopping, args.pft_nb_backtrack_steps, args.use_max_component,
-                                     args.flip_x, args.flip_y, args.flip_z, compress_streamlines=False)
+                                     args.flip_x, args.flip_y, args.flip_z, compress_streamlines=False,
+                                     samples_per_seed=samples_per_seed, rng_seed=RNG_SEED + 2 * start, metrics=metrics)
                 batch_tractogram = track(tracker=tracker, seeds=seeds[start:end], step_size=step_size, is_stopping=is_stopping,
                                          nb_retry=nb_retry, nb_backtrack_steps=nb_backtrack_steps, verbose=args.verbose)
 
@@ -708,11 +1130,17 @@ def batch_track(model, dwi, seeds, step_size, batch_size, is_stopping, args):
 
                 # Backward tracking
                 tracker = BackwardTrackerCls(model, is_stopping, args.pft_nb_backtrack_steps, args.use_max_component,
-                                             args.flip_x, args.flip_y, args.flip_z, compress_streamlines=True)
+                                             args.flip_x, args.flip_y, args.flip_z, compress_streamlines=True,
+                                             step_loss=step_loss, filter_threshold=filter_threshold,
+                                             keep_rejected=rejected_tractogram is not None, rng_seed=RNG_SEED + 2 * start + 1, metrics=metrics)
                 streamlines = [s[::-1] for s in batch_tractogram.streamlines]  # Flip streamlines (the first half).
                 batch_tractogram = track(tracker=tracker, seeds=streamlines, step_size=step_size, is_stopping=is_stopping,
                                          nb_retry=nb_retry, nb_backtrack_steps=nb_backtrack_steps, verbose=args.verbose)
 
+                nb_rejected += tracker.nb_rejected
+                if tracker.rejected_tractogram is not None and checkpoint is None:
+                    rejected_tractograms.append(tracker.rejected_tractogram)
+
                 stopping_flags = batch_tractogram.data_per_streamline['stopping_flags'].astype(np.uint8)
                 print("Backward pass stopped because of - mask: {:,}\t curv: {:,}\t length: {:,}\t likelihood: {:,}".format(
                     count_flags(stopping_flags, STOPPING_MASK),
@@ -720,11 +1148,35 @@ def batch_track(model, dwi, seeds, step_size, batch_size, is_stopping, args):
                     count_flags(stopping_flags, STOPPING_LENGTH),
                     count_flags(stopping_flags, STOPPING_LIKELIHOOD)))
 
-                if tractogram is None:
+                if checkpoint is not None:
+                    checkpoint.add_chunk(start, end, batch_tractogram, tracker.rejected_tractogram, nb_rejected=tracker.nb_rejected)
+                elif tractogram is None:
                     tractogram = batch_tractogram
                 else:
                     tractogram += batch_tractogram
 
+                start = end
+
+            if checkpoint is not None:
+                with Timer("Merging checkpointed chunks"):
+                    tractogram = checkpoint.merge()
+                    if rejected_tractogram is not None:
+                        rejected_tractograms = [checkpoint.merge(rejected=True)]
+
+            if filter_threshold is not None:
+                losses = tractogram.data_per_streamline.get('loss', [])
+                if len(losses) > 0:
+                    print("Mean loss: {:.4f} ± {:.4f}".format(np.mean(losses), np.std(losses, ddof=1) / np.sqrt(len(losses))))
+                print("Removed {:,} streamlines producing a loss higher than {:.2f}".format(nb_rejected, filter_threshold))
+
+            if metrics is not None:
+                metrics.write(force=True)
+                print(metrics.summary())
+
+            # Only keep rejected streamlines once tracking has succeeded (i.e. no retry).
+            for rejected in rejected_tractograms:
+                rejected_tractogram += rejected
+
             return tractogram
 
         except MemoryError:
@@ -743,6 +1195,14 @@ def batch_track(model, dwi, seeds, step_size, batch_size, is_stopping, args):
             else:
                 raise e
 
+        if checkpoint is not None:
+            if len(checkpoint.chunks) > 0:
+                # Smaller chunks would not give the same streamlines as the ones already saved.
+                raise MemoryError("Out of memory after {:,} seeds were tracked. Use a smaller --batch-size"
+                                  " with a new --checkpoint-dir.".format(checkpoint.nb_completed_seeds))
+
+            checkpoint.update_params(chunk_size=max(batch_size // samples_per_seed, 1))
+
 
 def get_max_angle_from_curvature(curvature, step_size):
     """
@@ -765,28 +1225,22 @@ def get_max_angle_from_curvature(curvature, step_size):
     return theta
 
 
-def main():
-    parser = build_argparser()
-    args = parser.parse_args()
-
-    # Get experiment folder
-    experiment_path = args.name
-    if not os.path.isdir(experiment_path):
-        # If not a directory, it must be the name of the experiment.
-        experiment_path = pjoin(".", "experiments", args.name)
-
-    if not os.path.isdir(experiment_path):
-        parser.error('Cannot find experiment: {0}!'.format(args.name))
+class Loader(object):
+    """ Loads the data and the model needed for tracking.
 
-    # Load experiments hyperparameters
-    try:
-        hyperparams = smartutils.load_dict_from_json_file(pjoin(experiment_path, "hyperparams.json"))
-    except FileNotFoundError:
-        hyperparams = smartutils.load_dict_from_json_file(pjoin(experiment_path, "..", "hyperparams.json"))
+    Each step is a method so it can be overridden, e.g. to keep things in memory between tracking jobs.
+    """
+    def load_dwi(self, dwi_filename, hyperparams):
+        """ Loads a DWI and its gradients table, then prepares the diffusion signal as expected by the model.
 
-    with Timer("Loading DWIs"):
+        Returns
+        -------
+        dwi : `nib.Nifti1Image` object
+        weights : 4D array
+            Diffusion signal (SH coefficients or resampled DWI).
+        """
         # Load gradients table
-        dwi_name = args.dwi
+        dwi_name = dwi_filename
         if dwi_name.endswith(".gz"):
             dwi_name = dwi_name[:-3]
         if dwi_name.endswith(".nii"):
@@ -805,7 +1259,7 @@ def main():
                 print("Could not find .bvals/.bvecs or .bval/.bvec files...")
                 raise e
 
-        dwi = nib.load(args.dwi)
+        dwi = nib.load(dwi_filename)
         if hyperparams["use_sh_coeffs"]:
             # Use 45 spherical harmonic coefficients to represent the diffusion signal.
             weights = neurotools.get_spherical_harmonics_coefficients(dwi, bvals, bvecs).astype(np.float32)
@@ -813,9 +1267,9 @@ def main():
             # Resample the diffusion signal to have 100 directions.
             weights = neurotools.resample_dwi(dwi, bvals, bvecs).astype(np.float32)
 
-        affine_rasmm2dwivox = np.linalg.inv(dwi.affine)
+        return dwi, weights
 
-    with Timer("Loading model"):
+    def load_model(self, experiment_path, hyperparams, weights):
         if hyperparams["model"] == "gru_regression":
             from learn2track.models import GRU_Regression
             model_class = GRU_Regression
@@ -842,33 +1296,97 @@ def main():
         # Load the actual model.
         model = model_class.create(pjoin(experiment_path), **kwargs)  # Create new instance and restore model.
         model.drop_prob = 0.
+        return model
+
+    def load_mask(self, mask_filename, affine_rasmm2dwivox, dilate=False):
+        """ Loads a tracking mask.
+
+        Returns
+        -------
+        mask : 3D array
+        affine_maskvox2dwivox : ndarray of shape (4, 4)
+            Affine allowing to evaluate the mask at some coordinates (in DWI voxel space) correctly.
+        """
+        mask_nii = nib.load(mask_filename)
+        mask = mask_nii.get_data()
+
+        # affine_maskvox2dwivox = mask_vox => rasmm space => dwi_vox
+        affine_maskvox2dwivox = np.dot(affine_rasmm2dwivox, mask_nii.affine)
+        if dilate:
+            import scipy
+            mask = scipy.ndimage.morphology.binary_dilation(mask).astype(mask.dtype)
+
+        return mask, affine_maskvox2dwivox
+
+
+def main(argv=None, loader=None, cwd=None):
+    """
+    Parameters
+    ----------
+    argv : list of str, optional
+        Command line arguments. Default: `sys.argv[1:]`
+    loader : `Loader` object, optional
+        Loads the data and the model. Default: `Loader()`
+    cwd : str, optional
+        Folder relative paths given in `argv` are relative to. Default: the current working directory
+    """
+    parser = build_argparser()
+    args = parser.parse_args(argv)
+    loader = Loader() if loader is None else loader
+    cwd = os.getcwd() if cwd is None else cwd
+
+    def _abspath(path):
+        # Arguments are kept as given since some of them are used to name the output tractogram.
+        return None if path is None else os.path.join(cwd, path)
+
+    # Get experiment folder
+    experiment_path = _abspath(args.name)
+    if not os.path.isdir(experiment_path):
+        # If not a directory, it must be the name of the experiment.
+        experiment_path = _abspath(pjoin("experiments", args.name))
+
+    if not os.path.isdir(experiment_path):
+        parser.error('Cannot find experiment: {0}!'.format(args.name))
+
+    # Load experiments hyperparameters
+    try:
+        hyperparams = smartutils.load_dict_from_json_file(pjoin(experiment_path, "hyperparams.json"))
+    except FileNotFoundError:
+        hyperparams = smartutils.load_dict_from_json_file(pjoin(experiment_path, "..", "hyperparams.json"))
+
+    if args.samples_per_seed > 1:
+        if hyperparams['model'] not in ['gru_gaussian', 'gru_mixture']:
+            parser.error("--samples-per-seed is only supported by gru_gaussian and gru_mixture models.")
+        if args.use_max_component:
+            parser.error("--samples-per-seed requires sampling, i.e. it can't be used with --use-max-component.")
+
+    with Timer("Loading DWIs"):
+        dwi, weights = loader.load_dwi(_abspath(args.dwi), hyperparams)
+        affine_rasmm2dwivox = np.linalg.inv(dwi.affine)
+
+    with Timer("Loading model"):
+        model = loader.load_model(experiment_path, hyperparams, weights)
         print(str(model))
 
     mask = None
     if args.mask is not None:
         with Timer("Loading mask"):
-            mask_nii = nib.load(args.mask)
-            mask = mask_nii.get_data()
-            # Compute the affine allowing to evaluate the mask at some coordinates correctly.
-
-            # affine_maskvox2dwivox = mask_vox => rasmm space => dwi_vox
-            affine_maskvox2dwivox = np.dot(affine_rasmm2dwivox, mask_nii.affine)
-            if args.dilate_mask:
-                import scipy
-                mask = scipy.ndimage.morphology.binary_dilation(mask).astype(mask.dtype)
+            mask, affine_maskvox2dwivox = loader.load_mask(_abspath(args.mask), affine_rasmm2dwivox, dilate=args.dilate_mask)
 
     with Timer("Generating seeds"):
         seeds = []
 
-        for filename in args.seeds:
+        for filename in map(_abspath, args.seeds):
             if filename.endswith('.trk') or filename.endswith('.tck'):
-                tfile = nib.streamlines.load(filename)
-                # Send the streamlines to voxel since that's where we'll track.
-                tfile.tractogram.apply_affine(affine_rasmm2dwivox)
-
                 # Use extremities of the streamlines as seeding points.
-                seeds += [s[0] for s in tfile.streamlines]
-                seeds += [s[-1] for s in tfile.streamlines]
+                # Only the endpoints are sent to voxel since that's where we'll track.
+                starts, ends = [], []
+                for chunk_starts, chunk_ends in neurotools.iter_streamlines_endpoints(filename):
+                    starts.append(nib.affines.apply_affine(affine_rasmm2dwivox, chunk_starts))
+                    ends.append(nib.affines.apply_affine(affine_rasmm2dwivox, chunk_ends))
+
+                seeds.extend(seed for chunk in starts for seed in chunk)
+                seeds.extend(seed for chunk in ends for seed in chunk)
 
             else:
                 # Assume it is a binary mask.
@@ -892,6 +1410,9 @@ def main():
 
         seeds = np.array(seeds, dtype=theano.config.floatX)
 
+        if args.seed_ordering != "none":
+            seeds = seeds[neurotools.get_space_filling_curve_order(seeds, curve=args.seed_ordering)]
+
     with Timer("Tracking in the diffusion voxel space"):
         voxel_sizes = np.asarray(dwi.header.get_zooms()[:3])
         if not np.all(voxel_sizes == dwi.header.get_zooms()[0]):
@@ -928,22 +1449,45 @@ def main():
 
         is_stopping.max_nb_points = max_nb_points  # Small hack
 
+        step_loss = None
+        if args.filter_threshold is not None:
+            # Streamlines are scored while being tracked, then filtered when harvested.
+            step_loss = step_loss_factory(hyperparams, model)
+
+        rejected_tractogram = None
+        if args.save_rejected:
+            rejected_tractogram = Tractogram()
+
         tractogram = batch_track(model, weights, seeds,
                                  step_size=step_size,
                                  is_stopping=is_stopping,
                                  batch_size=args.batch_size,
-                                 args=args)
+                                 args=args,
+                                 step_loss=step_loss,
+                                 filter_threshold=args.filter_threshold,
+                                 rejected_tractogram=rejected_tractogram,
+                                 checkpoint_dir=_abspath(args.checkpoint_dir),
+                                 checkpoint_params={'experiment': os.path.realpath(experiment_path),
+                                                    'dwi': os.path.realpath(_abspath(args.dwi)),
+                                                    'mask': None if args.mask is None else os.path.realpath(_abspath(args.mask)),
+                                                    'mask_threshold': args.mask_threshold,
+                                                    'dilate_mask': args.dilate_mask,
+                                                    'theta': float(np.rad2deg(theta)),
+                                                    'max_nb_points': max_nb_points,
+                                                    'seeding_rng_seed': args.seeding_rng_seed},
+                                 samples_per_seed=args.samples_per_seed,
+                                 metrics=TrackingMetrics(_abspath(args.metrics_file), args.metrics_interval))
 
         # Streamlines have been generated in voxel space.
         # Transform them them back to RAS+mm space using the dwi's affine.
         tractogram.affine_to_rasmm = dwi.affine
         tractogram.to_world()  # Performed in-place.
 
-    nb_streamlines = len(tractogram)
+        if args.save_rejected:
+            rejected_tractogram.affine_to_rasmm = dwi.affine
+            rejected_tractogram.to_world()  # Performed in-place.
 
-    if args.save_rejected:
-        rejected_tractogram = Tractogram()
-        rejected_tractogram.affine_to_rasmm = tractogram._affine_to_rasmm
+    nb_streamlines = len(tractogram)
 
     print("Generated {:,} (compressed) streamlines".format(nb_streamlines))
     with Timer("Cleaning streamlines", newline=True):
@@ -979,18 +1523,6 @@ def main():
             print("Removed {:,} streamlines stopped for having a curvature higher than {:.2f} degree".format(nb_streamlines - len(tractogram),
                                                                                                              np.rad2deg(theta)))
 
-        if args.filter_threshold is not None:
-            # Remove streamlines that produces a reconstruction error higher than a certain threshold.
-            nb_streamlines = len(tractogram)
-            losses = compute_loss_errors(tractogram.streamlines, model, hyperparams)
-            print("Mean loss: {:.4f} ± {:.4f}".format(np.mean(losses), np.std(losses, ddof=1) / np.sqrt(len(losses))))
-
-            if args.save_rejected:
-                rejected_tractogram += tractogram[losses > args.filter_threshold]
-
-            tractogram = tractogram[losses <= args.filter_threshold]
-            print("Removed {:,} streamlines producing a loss lower than {:.2f} mm".format(nb_streamlines - len(tractogram),
-                                                                                          args.filter_threshold))
 
     with Timer("Saving {:,} (compressed) streamlines".format(len(tractogram))):
         filename = args.out
@@ -1096,5 +1628,8 @@ def main():
         print("Saving rejected streamlines to {}".format(rejected_save_path))
         nib.streamlines.save(rejected_tractogram, rejected_save_path)
 
+    return save_path
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import stat
+import argparse
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+
+DEFAULT_ADDRESS = "/tmp/learn2track_track.sock"
+DEFAULT_AUTHKEY_FILE = os.path.join(os.path.expanduser("~"), ".learn2track", "track_server.key")
+
+
+def build_argparser():
+    DESCRIPTION = ("Send a tracking job to a running `track_server.py`. All arguments not listed here are forwarded"
+                   " as-is, i.e. they are the same as the ones of `track.py` (see `track.py --help`).")
+    p = argparse.ArgumentParser(description=DESCRIPTION)
+
+    p.add_argument('--address', default=DEFAULT_ADDRESS,
+                   help="Unix socket (path) or localhost port (int) the server is listening to. Default: {}".format(DEFAULT_ADDRESS))
+    p.add_argument('--authkey-file', default=DEFAULT_AUTHKEY_FILE,
+                   help="secret shared with the server to authenticate the connection. Default: {}".format(DEFAULT_AUTHKEY_FILE))
+
+    return p
+
+
+def load_authkey(filename, create=False):
+    """ Reads the secret shared by the server and its clients, only readable by its owner.
+
+    If `create` is True and the file doesn't exist yet, a new random secret is generated.
+    """
+    if create and not os.path.exists(filename):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), mode=0o700, exist_ok=True)
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(os.urandom(32).hex())
+
+    if stat.S_IMODE(os.stat(filename).st_mode) & 0o077:
+        raise PermissionError("{} must only be accessible by its owner (chmod 600).".format(filename))
+
+    with open(filename) as f:
+        return f.read().strip().encode()
+
+
+def main():
+    parser = build_argparser()
+    args, track_argv = parser.parse_known_args()
+
+    try:
+        authkey = load_authkey(args.authkey_file)
+    except FileNotFoundError:
+        parser.error("Cannot find {}. It is created by `track_server.py` when it starts.".format(args.authkey_file))
+    except PermissionError as e:
+        parser.error(str(e))
+
+    address = ("localhost", int(args.address)) if args.address.isdigit() else args.address
+    try:
+        conn = Client(address, authkey=authkey)
+    except (FileNotFoundError, ConnectionRefusedError):
+        parser.error("Cannot connect to the tracking server at {}. Is `track_server.py` running?".format(args.address))
+    except AuthenticationError:
+        parser.error("Authentication with the tracking server failed. Is it using the same --authkey-file?")
+
+    with conn:
+        conn.send({'argv': track_argv, 'cwd': os.getcwd()})
+
+        # Stream the job's output until it is done.
+        while True:
+            try:
+                kind, message = conn.recv()
+            except EOFError:
+                print("Lost connection with the tracking server.", file=sys.stderr)
+                sys.exit(1)
+
+            if kind == "log":
+                sys.stdout.write(message)
+                sys.stdout.flush()
+            elif kind == "done":
+                print("Tractogram saved to {}".format(message))
+                break
+            elif kind == "error":
+                print(message, file=sys.stderr)
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+
+import os
+
+# Hack so you don't have to put the library containing this script in the PYTHONPATH.
+sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
+
+import argparse
+import queue
+import threading
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+
+from scripts import track
+from scripts.track_client import DEFAULT_ADDRESS, DEFAULT_AUTHKEY_FILE, load_authkey
+
+
+def build_argparser():
+    DESCRIPTION = ("Tracking service keeping models (with their compiled sequence generators) and preprocessed DWIs"
+                   " in memory between tracking jobs. Jobs are sent using `track_client.py` with the same arguments"
+                   " as `track.py` and are processed one at a time, in the order they were received.")
+    p = argparse.ArgumentParser(description=DESCRIPTION)
+
+    p.add_argument('--address', default=DEFAULT_ADDRESS,
+                   help="Unix socket (path) or localhost port (int) to listen to. Default: {}".format(DEFAULT_ADDRESS))
+    p.add_argument('--authkey-file', default=DEFAULT_AUTHKEY_FILE,
+                   help="secret shared with the clients to authenticate connections, created (chmod 600) if it doesn't exist."
+                        " Default: {}".format(DEFAULT_AUTHKEY_FILE))
+    p.add_argument('--max-cached', type=int, default=4,
+                   help="maximum number of (experiment, DWI) pairs to keep in memory. Default: 4")
+
+    return p
+
+
+def parse_address(address):
+    """ Converts a port number into a localhost address, otherwise assume it is a Unix socket. """
+    if address.isdigit():
+        return ("localhost", int(address))
+
+    return address
+
+
+class LRUCache(OrderedDict):
+    def __init__(self, max_size, on_evict=None):
+        super().__init__()
+        self.max_size = max_size
+        self.on_evict = on_evict
+
+    def get_or_create(self, key, create):
+        if key in self:
+            self.move_to_end(key)
+            return self[key]
+
+        value = create()
+        self[key] = value
+        while len(self) > self.max_size:
+            evicted_key, _ = self.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(evicted_key)
+
+        return value
+
+
+class CachingLoader(track.Loader):
+    """ Keeps preprocessed DWIs, models and masks in memory, keyed by their files. """
+    def __init__(self, max_cached):
+        self.dwis = LRUCache(max_cached, on_evict=self._evict_models)
+        self.models = LRUCache(max_cached)
+        self.masks = LRUCache(max_cached)
+
+    def _evict_models(self, dwi_key):
+        # Models hold a copy of the DWI they were loaded with.
+        for key in [key for key in self.models if key[1:] == dwi_key]:
+            del self.models[key]
+
+    def load_dwi(self, dwi_filename, hyperparams):
+        key = (os.path.realpath(dwi_filename), hyperparams['use_sh_coeffs'])
+        return self.dwis.get_or_create(key, lambda: super(CachingLoader, self).load_dwi(dwi_filename, hyperparams))
+
+    def load_model(self, experiment_path, hyperparams, weights):
+        def _create():
+            model = super(CachingLoader, self).load_model(experiment_path, hyperparams, weights)
+            self._cache_sequence_generators(model)
+            return model
+
+        # Preprocessed DWIs are cached, so `weights` can be traced back to their file.
+        dwi_key = next((key for key, (_, cached_weights) in self.dwis.items() if cached_weights is weights), None)
+        if dwi_key is None:
+            return _create()
+
+        key = (os.path.realpath(experiment_path),) + dwi_key
+        return self.models.get_or_create(key, _create)
+
+    def load_mask(self, mask_filename, affine_rasmm2dwivox, dilate=False):
+        key = (os.path.realpath(mask_filename), affine_rasmm2dwivox.tobytes(), dilate)
+        return self.masks.get_or_create(key, lambda: super(CachingLoader, self).load_mask(mask_filename, affine_rasmm2dwivox, dilate))
+
+    @staticmethod
+    def _cache_sequence_generators(model):
+        """ Avoids compiling the same sequence generator for every new tracker.
+
+        Trackers restart the random stream of the generators for every chunk of seeds (see `batch_track`),
+        so streamlines are the same as the ones `track.py` gives, whatever jobs came before.
+        """
+        make_sequence_generator = model.make_sequence_generator
+        generators = {}
+
+        def _make_sequence_generator(**kwargs):
+            key = tuple(sorted(kwargs.items()))
+            if key not in generators:
+                generators[key] = make_sequence_generator(**kwargs)
+
+            return generators[key]
+
+        model.make_sequence_generator = _make_sequence_generator
+
+
+class ConnectionWriter(object):
+    """ File-like object streaming everything written to it back to the client. """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, text):
+        if len(text) > 0:
+            self.conn.send(("log", text))
+
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class ThreadOutput(object):
+    """ File-like object sending what a thread writes to its own writer (see `redirect`), or to `default` otherwise.
+
+    Installed once as `sys.stdout`/`sys.stderr`, so the output of a job doesn't get mixed with the one of other threads.
+    """
+    def __init__(self, default):
+        self.default = default
+        self._local = threading.local()
+
+    @property
+    def stream(self):
+        return getattr(self._local, "writer", None) or self.default
+
+    @contextmanager
+    def redirect(self, writer):
+        self._local.writer = writer
+        try:
+            yield
+        finally:
+            self._local.writer = None
+
+    def write(self, text):
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def process_job(job, conn, loader):
+    writer = ConnectionWriter(conn)
+    try:
+        with sys.stdout.redirect(writer), sys.stderr.redirect(writer):
+            # Relative paths are relative to where the client has been called.
+            save_path = track.main(job['argv'], loader=loader, cwd=job['cwd'])
+
+        conn.send(("done", save_path))
+
+    except SystemExit as e:  # Raised by argparse.
+        conn.send(("error", "Invalid arguments (exit code: {}).".format(e.code)))
+
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+
+    finally:
+        conn.close()
+
+
+def worker(jobs, loader):
+    # Only one job is processed at a time since the models aren't thread-safe (and may be on the GPU).
+    while True:
+        job, conn = jobs.get()
+        try:
+            process_job(job, conn, loader)
+        except (EOFError, OSError):
+            print("Client disconnected.", file=sys.stderr)
+        finally:
+            jobs.task_done()
+
+
+def receive_job(conn, jobs):
+    try:
+        job = conn.recv()
+    except EOFError:
+        conn.close()
+        return
+
+    conn.send(("log", "Job queued ({} job(s) ahead).\n".format(jobs.unfinished_tasks)))
+    jobs.put((job, conn))
+
+
+def main():
+    parser = build_argparser()
+    args = parser.parse_args()
+    print(args)
+
+    # The output of a job is streamed back to its client, the one of the other threads stays here.
+    sys.stdout = ThreadOutput(sys.stdout)
+    sys.stderr = ThreadOutput(sys.stderr)
+
+    address = parse_address(args.address)
+    if isinstance(address, str) and os.path.exists(address):
+        os.remove(address)  # Stale socket from a previous server.
+
+    try:
+        # Only clients knowing the secret can connect, since jobs are unpickled.
+        authkey = load_authkey(args.authkey_file, create=True)
+    except PermissionError as e:
+        parser.error(str(e))
+
+    loader = CachingLoader(max_cached=args.max_cached)
+    jobs = queue.Queue()
+    threading.Thread(target=worker, args=(jobs, loader), daemon=True).start()
+
+    umask = os.umask(0o177)  # The Unix socket is only accessible by its owner.
+    try:
+        listener = Listener(address, authkey=authkey)
+    finally:
+        os.umask(umask)
+
+    with listener:
+        print("Listening on {}".format(args.address))
+        while True:
+            try:
+                conn = listener.accept()
+            except AuthenticationError:
+                print("Rejected a client that failed to authenticate.", file=sys.stderr)
+                continue
+            except (EOFError, OSError):
+                print("Client disconnected during authentication.", file=sys.stderr)
+                continue
+
+            threading.Thread(target=receive_job, args=(conn, jobs), daemon=True).start()
+
+
+if __name__ == "__main__":
+    main()
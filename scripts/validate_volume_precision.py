@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+# Hack so you don't have to put the library containing this script in the PYTHONPATH.
+sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
+
+import argparse
+import json
+from os.path import join as pjoin
+from types import SimpleNamespace
+
+import numpy as np
+import theano
+from dipy.tracking.streamline import set_number_of_points
+
+from smartlearner import views
+from smartlearner.status import Status
+from smartlearner import utils as smartutils
+
+from learn2track import datasets, models
+from learn2track.factories import loss_factory, batch_scheduler_factory
+from learn2track.neurotools import VolumeManager, STORAGE_DTYPES
+from learn2track.utils import Timer
+
+from scripts.track import batch_track, make_is_outside_mask, make_is_too_long, make_is_too_curvy, make_is_stopping, \
+    STOPPING_MASK, STOPPING_LENGTH, STOPPING_CURVATURE
+
+floatX = theano.config.floatX
+
+MODELS = {'gru_regression': 'GRU_Regression',
+          'gru_gaussian': 'GRU_Gaussian',
+          'gru_mixture': 'GRU_Mixture',
+          'gru_multistep': 'GRU_Multistep_Gaussian',
+          'ffnn_regression': 'FFNN_Regression'}
+
+
+def build_parser():
+    DESCRIPTION = ("Compare a model using volumes stored with a reduced precision (see `learn.py --volumes-dtype`) to the same"
+                   " model using float32 volumes, on held-out subjects: interpolated signal, loss and tracked streamlines.")
+    p = argparse.ArgumentParser(description=DESCRIPTION)
+
+    p.add_argument('name', type=str, help='name/path of the experiment.')
+    p.add_argument('--subjects', nargs='+', required=True, help='file containing held-out data (as generated by `process_streamlines.py`).')
+    p.add_argument('--dtypes', nargs='+', choices=STORAGE_DTYPES[1:], default=STORAGE_DTYPES[1:],
+                   help='reduced precisions to validate. Default: all')
+    p.add_argument('--batch-size', type=int, default=100, help='size of the batch. Default: %(default)s')
+
+    tracking = p.add_argument_group("Tracking options")
+    tracking.add_argument('--nb-seeds', type=int, default=1000,
+                          help='number of seeds (first point of randomly chosen streamlines). Use 0 to skip tracking. Default: %(default)s')
+    tracking.add_argument('--step-size', type=float, default=0.5, help='step size (in voxel). Default: %(default)s')
+    tracking.add_argument('--max-nb-points', type=int, default=500, help='maximum number of points per streamline. Default: %(default)s')
+    tracking.add_argument('--theta', type=float, default=45, help='maximum angle between 2 steps (in degree). Default: %(default)s')
+    tracking.add_argument('--seed', type=int, default=1234, help='seed used to choose the seeds. Default: %(default)s')
+
+    p.add_argument('--out', type=str, help='if specified, save results in this JSON file.')
+    return p
+
+
+def load_model(experiment_path, hyperparams, volume_manager):
+    if hyperparams['model'] not in MODELS:
+        raise NameError("Unknown model: {}".format(hyperparams['model']))
+
+    model = getattr(models, MODELS[hyperparams['model']]).create(experiment_path, volume_manager=volume_manager)
+    model.drop_prob = 0.  # Make sure dropout/zoneout is not used when testing
+    if hyperparams['model'] == 'gru_multistep':
+        model.k = 1
+        model.m = 1
+
+    return model
+
+
+def compare_signal(dataset, reference_manager, volume_manager):
+    """ Compares the signal interpolated at every point of the streamlines. """
+    reference = datasets.compute_streamlines_features(dataset, reference_manager)
+    values = datasets.compute_streamlines_features(dataset, volume_manager)
+    errors = np.abs(values - reference)
+    return {'max_abs_error': float(errors.max()),
+            'mean_abs_error': float(errors.mean()),
+            'relative_rms_error': float(np.sqrt(np.mean(errors ** 2) / np.mean(reference ** 2)))}
+
+
+def evaluate_loss(hyperparams, model, dataset, batch_size):
+    batch_scheduler = batch_scheduler_factory(hyperparams, dataset, train_mode=False, batch_size_override=batch_size)
+    loss = loss_factory(hyperparams, model, dataset)
+    loss_view = views.LossView(loss=loss, batch_scheduler=batch_scheduler)
+    dummy_status = Status()
+    return float(loss_view.mean.view(dummy_status)), float(loss_view.stderror.view(dummy_status))
+
+
+def track(model, volume, seeds, args):
+    criteria = {STOPPING_MASK: make_is_outside_mask(np.any(volume != 0, axis=-1).astype(np.float32), np.eye(4), threshold=0.5),
+                STOPPING_LENGTH: make_is_too_long(args.max_nb_points),
+                STOPPING_CURVATURE: make_is_too_curvy(args.theta)}
+    is_stopping = make_is_stopping(criteria)
+    is_stopping.max_nb_points = args.max_nb_points  # Small hack
+
+    track_args = SimpleNamespace(track_like_peter=False, pft_nb_retry=0, pft_nb_backtrack_steps=1, use_max_component=True,
+                                 flip_x=False, flip_y=False, flip_z=False, verbose=False)
+    tractogram = batch_track(model, volume, seeds, step_size=args.step_size, batch_size=args.batch_size * 10,
+                             is_stopping=is_stopping, args=track_args)
+    return tractogram.streamlines
+
+
+def compare_streamlines(reference, streamlines, nb_points=20):
+    """ Compares the streamlines tracked from the same seeds, using the MDF distance. """
+    lengths = np.array(list(map(len, streamlines)))
+    reference_lengths = np.array(list(map(len, reference)))
+    results = {'nb_streamlines': len(streamlines),
+               'mean_nb_points': float(lengths.mean()),
+               'reference_mean_nb_points': float(reference_lengths.mean())}
+    if len(streamlines) != len(reference):
+        return results  # Streamlines can't be paired.
+
+    distances = []
+    for s1, s2 in zip(reference, streamlines):
+        if len(s1) < 2 or len(s2) < 2:
+            continue
+
+        s1, s2 = set_number_of_points(s1, nb_points), set_number_of_points(s2, nb_points)
+        direct = np.mean(np.sqrt(np.sum((s1 - s2) ** 2, axis=1)))
+        flipped = np.mean(np.sqrt(np.sum((s1 - s2[::-1]) ** 2, axis=1)))
+        distances.append(min(direct, flipped))
+
+    distances = np.array(distances)
+    results['mean_mdf'] = float(distances.mean())
+    results['median_mdf'] = float(np.median(distances))
+    results['max_mdf'] = float(distances.max())
+    results['changed_nb_points'] = float(np.mean(lengths != reference_lengths))
+    return results
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+    print(args)
+
+    experiment_path = args.name
+    if not os.path.isdir(experiment_path):
+        # If not a directory, it must be the name of the experiment.
+        experiment_path = pjoin(".", "experiments", args.name)
+
+    if not os.path.isdir(experiment_path):
+        parser.error('Cannot find experiment: {0}!'.format(args.name))
+
+    hyperparams = smartutils.load_dict_from_json_file(pjoin(experiment_path, "hyperparams.json"))
+    # Use this for hyperparams added in a new version, but nonexistent from older versions
+    retrocompatibility_defaults = {'feed_previous_direction': False,
+                                   'predict_offset': False,
+                                   'normalize': False,
+                                   'keep_step_size': False,
+                                   'sort_streamlines': False,
+                                   'use_layer_normalization': False,
+                                   'drop_prob': 0.,
+                                   'use_zoneout': False}
+    for new_hyperparams, default_value in retrocompatibility_defaults.items():
+        if new_hyperparams not in hyperparams:
+            hyperparams[new_hyperparams] = default_value
+
+    if 'k' in hyperparams:
+        hyperparams['k'] = 1
+
+    with Timer("Loading dataset", newline=True):
+        reference_manager = VolumeManager()
+        dataset = datasets.load_tractography_dataset(args.subjects, reference_manager, name="dataset", use_sh_coeffs=hyperparams['use_sh_coeffs'])
+        volumes = [volume.get_value() for volume in reference_manager.volumes]
+        print("Dataset size:", len(dataset))
+
+    # Streamlines of the first subject are used as seeds.
+    rng = np.random.RandomState(args.seed)
+    first_subject = dataset.subjects[0]
+    nb_seeds = min(args.nb_seeds, len(first_subject.streamlines))
+    seeds = [first_subject.streamlines[i][0] for i in rng.choice(len(first_subject.streamlines), size=nb_seeds, replace=False)]
+    seeds = np.array(seeds, dtype=floatX).reshape((-1, 3))
+
+    results = {'experiment': experiment_path, 'subjects': args.subjects, 'results': {}}
+    reference_streamlines = None
+    for dtype in ["float32"] + args.dtypes:
+        with Timer("Validating {}".format(dtype), newline=True):
+            if dtype == "float32":
+                volume_manager = reference_manager
+            else:
+                volume_manager = VolumeManager(storage_dtype=dtype)
+                for volume in volumes:
+                    volume_manager.register(volume)
+
+            result = {'volumes_nbytes': int(sum(volume.get_value(borrow=True).nbytes for volume in volume_manager.volumes))}
+            if dtype != "float32":
+                result['signal'] = compare_signal(dataset, reference_manager, volume_manager)
+
+            model = load_model(experiment_path, hyperparams, volume_manager)
+            result['loss'], result['loss_stderror'] = evaluate_loss(hyperparams, model, dataset, args.batch_size)
+
+            if nb_seeds > 0:
+                # Only the first subject is registered in the tracking model.
+                tracking_manager = VolumeManager(storage_dtype=dtype)
+                tracking_manager.register(volumes[first_subject.subject_id])
+                streamlines = track(load_model(experiment_path, hyperparams, tracking_manager), volumes[first_subject.subject_id], seeds, args)
+                if reference_streamlines is None:
+                    reference_streamlines = streamlines
+                else:
+                    result['tracking'] = compare_streamlines(reference_streamlines, streamlines)
+
+            results['results'][dtype] = result
+
+        print("{}: {:,.1f} MB of volumes, loss: {:.6f} ± {:.6f}".format(dtype, result['volumes_nbytes'] / 1024**2,
+                                                                        result['loss'], result['loss_stderror']))
+        if 'signal' in result:
+            print("  signal: max abs. error {max_abs_error:.6f}, relative RMS error {relative_rms_error:.2e}".format(**result['signal']))
+        if 'tracking' in result and 'mean_mdf' in result['tracking']:
+            print("  tracking: MDF to float32 streamlines mean {mean_mdf:.4f}, median {median_mdf:.4f}, max {max_mdf:.4f} (in voxel)".format(**result['tracking']))
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+        print("Results saved to {}".format(args.out))
+
+
+if __name__ == "__main__":
+    main()
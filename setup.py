@@ -13,7 +13,7 @@ setup(
     license='LICENSE',
     description='Learn to do tractography directly from diffusion weighted images.',
     long_description=open('README.md').read(),
-    install_requires=['smartlearner', 'dipy', 'nibabel>=2.2.0.dev0'],
+    install_requires=['numpy', 'scipy', 'smartlearner', 'dipy', 'nibabel>=2.2.0.dev0'],
     dependency_links=['https://github.com/SMART-Lab/smartlearner/archive/master.zip#egg=smartlearner-0.0.1',
                       'https://github.com/MarcCote/nibabel/archive/bleeding_edge.zip#egg=nibabel-2.2.0.dev0'],
     scripts=[pjoin('scripts', 'process_streamlines.py'),
@@ -7,7 +7,7 @@ from types import SimpleNamespace
 sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
 
 from scripts.track import make_is_outside_mask, make_is_too_long, make_is_too_curvy, make_is_stopping, STOPPING_MASK, STOPPING_LENGTH, STOPPING_CURVATURE, \
-    batch_track, make_is_unlikely, STOPPING_LIKELIHOOD
+    batch_track, make_is_unlikely, STOPPING_LIKELIHOOD, Tracker, track
 
 import theano
 
@@ -92,6 +92,100 @@ def test_gru_mixture_track():
     return True
 
 
+def test_gru_mixture_track_samples_per_seed():
+    hidden_sizes = 50
+
+    with Timer("Creating dummy volume", newline=True):
+        volume_manager = neurotools.VolumeManager()
+        dwi, gradients = make_dummy_dwi(nb_gradients=30, volume_shape=(10, 10, 10), seed=1234)
+        volume = neurotools.resample_dwi(dwi, gradients.bvals, gradients.bvecs).astype(np.float32)
+
+        volume_manager.register(volume)
+
+    with Timer("Creating model"):
+        hyperparams = {'model': 'gru_mixture',
+                       'SGD': "1e-2",
+                       'hidden_sizes': hidden_sizes,
+                       'learn_to_stop': False,
+                       'normalize': False,
+                       'activation': 'tanh',
+                       'feed_previous_direction': False,
+                       'predict_offset': False,
+                       'use_layer_normalization': False,
+                       'drop_prob': 0.,
+                       'use_zoneout': False,
+                       'skip_connections': False,
+                       'neighborhood_radius': None,
+                       'nb_seeds_per_voxel': 2,
+                       'step_size': 0.5,
+                       'batch_size': 200,
+                       'n_gaussians': 2,
+                       'seed': 1234}
+        model = factories.model_factory(hyperparams,
+                                        input_size=volume_manager.data_dimension,
+                                        output_size=3,
+                                        volume_manager=volume_manager)
+        model.initialize(factories.weigths_initializer_factory("orthogonal", seed=1234))
+
+    rng = np.random.RandomState(1234)
+    mask = np.ones(volume.shape[:3])
+    seeding_mask = np.random.randint(2, size=mask.shape)
+    seeds = []
+    indices = np.array(np.where(seeding_mask)).T
+    for idx in indices:
+        seeds_in_voxel = idx + rng.uniform(-0.5, 0.5, size=(hyperparams['nb_seeds_per_voxel'], 3))
+        seeds.extend(seeds_in_voxel)
+    seeds = np.array(seeds, dtype=theano.config.floatX)
+
+    is_outside_mask = make_is_outside_mask(mask, np.eye(4), threshold=0.5)
+    is_too_long = make_is_too_long(150)
+    is_too_curvy = make_is_too_curvy(np.rad2deg(30))
+    is_unlikely = make_is_unlikely(0.5)
+    is_stopping = make_is_stopping({STOPPING_MASK: is_outside_mask,
+                                    STOPPING_LENGTH: is_too_long,
+                                    STOPPING_CURVATURE: is_too_curvy,
+                                    STOPPING_LIKELIHOOD: is_unlikely})
+    is_stopping.max_nb_points = 150
+
+    args = SimpleNamespace()
+    args.track_like_peter = False
+    args.pft_nb_retry = 0
+    args.pft_nb_backtrack_steps = 0
+    args.use_max_component = False
+    args.flip_x = False
+    args.flip_y = False
+    args.flip_z = False
+    args.verbose = True
+
+    samples_per_seed = 3
+    tractogram = batch_track(model, volume, seeds,
+                             step_size=hyperparams['step_size'],
+                             is_stopping=is_stopping,
+                             batch_size=hyperparams['batch_size'],
+                             args=args,
+                             samples_per_seed=samples_per_seed)
+
+    # Each seed is forked into 3 sprouts after the first step.
+    assert len(tractogram) == samples_per_seed * len(seeds)
+
+    # Forward pass only, so every streamline still starts at the seed it was forked from.
+    tracker = Tracker(model, is_stopping, args.pft_nb_backtrack_steps, args.use_max_component, samples_per_seed=samples_per_seed, rng_seed=1234)
+    tractogram = track(tracker=tracker, seeds=seeds, step_size=hyperparams['step_size'], is_stopping=is_stopping)
+    assert len(tractogram) == samples_per_seed * len(seeds)
+    assert len(tractogram.data_per_streamline['stopping_flags']) == len(tractogram)
+
+    first_points = np.array([s[0] for s in tractogram.streamlines])
+    for seed in seeds:
+        is_forked_from_seed = np.all(first_points == seed, axis=1)
+        assert is_forked_from_seed.sum() == samples_per_seed
+
+        # Every fork samples its own first direction.
+        second_points = [tuple(s[1]) for s, forked in zip(tractogram.streamlines, is_forked_from_seed) if forked and len(s) > 1]
+        assert len(set(second_points)) == len(second_points)
+
+    return True
+
+
 def test_gru_mixture_track_neighborhood():
     hidden_sizes = 50
 
@@ -244,3 +338,4 @@ if __name__ == "__main__":
     test_gru_mixture_track()
     test_gru_mixture_track_neighborhood()
     test_gru_mixture_track_stopping()
+    test_gru_mixture_track_samples_per_seed()
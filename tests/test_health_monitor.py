@@ -0,0 +1,64 @@
+import os
+import sys
+
+# Hack so you don't have to put the library containing this script in the PYTHONPATH.
+sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
+
+import numpy as np
+from numpy.testing import assert_raises, assert_equal
+
+from smartlearner import Trainer, stopping_criteria
+
+from learn2track import batch_schedulers, neurotools, factories
+from learn2track.tasks import HealthMonitor
+from learn2track.utils import Timer
+from tests.utils import make_dummy_dataset
+
+
+def test_health_monitor_stops_training_on_nan_loss():
+    with Timer("Creating dataset", newline=True):
+        volume_manager = neurotools.VolumeManager()
+        trainset = make_dummy_dataset(volume_manager)
+        batch_scheduler = batch_schedulers.TractographyBatchScheduler(trainset,
+                                                                      batch_size=16,
+                                                                      noisy_streamlines_sigma=None,
+                                                                      seed=1234)
+
+    with Timer("Creating model"):
+        hyperparams = {'model': 'gru_regression',
+                       'SGD': "1e-2",
+                       'hidden_sizes': 50,
+                       'learn_to_stop': False,
+                       'normalize': False,
+                       'activation': 'tanh',
+                       'feed_previous_direction': False,
+                       'predict_offset': False,
+                       'use_layer_normalization': False,
+                       'drop_prob': 0.,
+                       'use_zoneout': False,
+                       'skip_connections': False,
+                       'neighborhood_radius': None,
+                       'seed': 1234}
+        model = factories.model_factory(hyperparams,
+                                        input_size=volume_manager.data_dimension,
+                                        output_size=batch_scheduler.target_size,
+                                        volume_manager=volume_manager)
+        model.initialize(factories.weigths_initializer_factory("orthogonal", seed=1234))
+
+    with Timer("Building optimizer"):
+        loss = factories.loss_factory(hyperparams, model, trainset)
+        optimizer = factories.optimizer_factory(hyperparams, loss)
+
+    with Timer("Building trainer"):
+        trainer = Trainer(optimizer, batch_scheduler)
+        trainer.append_task(stopping_criteria.MaxEpochStopping(1))
+        trainer.append_task(HealthMonitor(loss, report_every=1000))
+
+    # A NaN in the weights makes the loss NaN at the very first update.
+    param = model.parameters[0]
+    value = param.get_value()
+    value.flat[0] = np.nan
+    param.set_value(value)
+
+    assert_raises(SystemExit, trainer.train)
+    assert_equal(trainer.status.current_update, 1)
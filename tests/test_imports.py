@@ -0,0 +1,15 @@
+import os
+import sys
+import subprocess
+
+# Hack so you don't have to put the library containing this script in the PYTHONPATH.
+sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
+
+
+def test_data_modules_dont_import_theano():
+    # Run in a fresh interpreter since other tests already imported Theano.
+    code = ("import sys\n"
+            "import learn2track.neurotools, learn2track.interpolation, learn2track.utils\n"
+            "assert 'theano' not in sys.modules, 'theano'\n"
+            "assert 'smartlearner' not in sys.modules, 'smartlearner'\n")
+    subprocess.check_call([sys.executable, "-c", code], cwd=os.path.abspath(os.path.join(__file__, '..', '..')))
@@ -13,7 +13,7 @@ import theano
 import theano.tensor as T
 
 from learn2track.interpolation import eval_volume_at_3d_coordinates_in_theano
-from learn2track.neurotools import eval_volume_at_3d_coordinates
+from learn2track.neurotools import eval_volume_at_3d_coordinates, make_sparse_volume, make_bricked_volume, quantize_volume
 
 
 def test_interpolation():
@@ -114,5 +114,72 @@ def test_trilinear_interpolation():
     assert_array_almost_equal(values, expected, decimal=4)
 
 
+def test_sparse_volume_interpolation():
+    trk = nib.streamlines.load(os.path.abspath(pjoin(__file__, '..', 'data', 'CA.trk')))
+    trk.tractogram.apply_affine(np.linalg.inv(trk.affine))
+
+    dwi = nib.load(os.path.abspath(pjoin(__file__, '..', 'data', 'dwi.nii.gz')))
+    data = dwi.get_data().astype('float32')
+    data[data[..., 0] < np.median(data[..., 0])] = 0  # Some background voxels.
+    index, features = make_sparse_volume(data)
+    assert len(features) < np.prod(data.shape[:3])
+
+    # Coordinates outside the volume are clipped.
+    for coords in [trk.streamlines._data, trk.streamlines._data * np.max(dwi.shape), -trk.streamlines._data]:
+        coords = coords.astype('float32')
+        expected = eval_volume_at_3d_coordinates(data, coords)
+        assert_array_almost_equal(eval_volume_at_3d_coordinates(features, coords, index=index), expected, decimal=4)
+
+        values = eval_volume_at_3d_coordinates_in_theano(theano.shared(features), theano.shared(coords),
+                                                         index=theano.shared(index)).eval()
+        assert_array_almost_equal(values, expected, decimal=4)
+
+
+def test_bricked_volume_interpolation():
+    trk = nib.streamlines.load(os.path.abspath(pjoin(__file__, '..', 'data', 'CA.trk')))
+    trk.tractogram.apply_affine(np.linalg.inv(trk.affine))
+
+    dwi = nib.load(os.path.abspath(pjoin(__file__, '..', 'data', 'dwi.nii.gz')))
+    data = dwi.get_data().astype('float32')
+    shape = data.shape[:3]
+
+    # Coordinates outside the volume are clipped.
+    for brick_size in [2, 4, 8]:
+        bricked = make_bricked_volume(data, brick_size)
+        for coords in [trk.streamlines._data, trk.streamlines._data * np.max(dwi.shape), -trk.streamlines._data]:
+            coords = coords.astype('float32')
+            expected = eval_volume_at_3d_coordinates(data, coords)
+            values = eval_volume_at_3d_coordinates(bricked, coords, brick_size=brick_size, shape=shape)
+            assert_array_almost_equal(values, expected, decimal=4)
+
+            values = eval_volume_at_3d_coordinates_in_theano(theano.shared(bricked), theano.shared(coords),
+                                                             brick_size=brick_size, shape=shape).eval()
+            assert_array_almost_equal(values, expected, decimal=4)
+
+
+def test_quantized_volume_interpolation():
+    trk = nib.streamlines.load(os.path.abspath(pjoin(__file__, '..', 'data', 'CA.trk')))
+    trk.tractogram.apply_affine(np.linalg.inv(trk.affine))
+    coords = trk.streamlines._data.astype('float32')
+
+    dwi = nib.load(os.path.abspath(pjoin(__file__, '..', 'data', 'dwi.nii.gz')))
+    data = dwi.get_data().astype('float32')
+    expected = eval_volume_at_3d_coordinates(data, coords)
+
+    for dtype in ['float16', 'int16']:
+        quantized, scale, offset = quantize_volume(data, dtype)
+        assert quantized.dtype == dtype
+
+        values = eval_volume_at_3d_coordinates(quantized, coords)
+        theano_values = eval_volume_at_3d_coordinates_in_theano(theano.shared(quantized), theano.shared(coords)).eval()
+        assert_array_almost_equal(theano_values, values, decimal=2)
+
+        if scale is not None:
+            values = values * scale + offset
+
+        # Errors are relative to the range of each channel.
+        assert np.all(np.abs(values - expected) <= 1e-3 * np.abs(data).reshape((-1, data.shape[-1])).max(axis=0))
+
+
 test_interpolation()
 #test_trilinear_interpolation()
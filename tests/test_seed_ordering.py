@@ -0,0 +1,44 @@
+import os
+import sys
+
+# Hack so you don't have to put the library containing this script in the PYTHONPATH.
+sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from learn2track.neurotools import get_morton_keys, get_hilbert_keys, get_space_filling_curve_order
+
+
+def test_morton_keys():
+    voxels = np.array([(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0), (1, 1, 1), (2, 0, 0)])
+    assert_array_equal(get_morton_keys(voxels), [0, 1, 2, 4, 7, 32])
+
+
+def test_hilbert_keys():
+    for size in [2, 4, 8]:
+        voxels = np.array(np.where(np.ones((size, size, size)))).T
+
+        # Hilbert keys are a permutation of the voxels.
+        keys = get_hilbert_keys(voxels)
+        assert_array_equal(np.sort(keys), np.arange(size**3))
+
+        # Consecutive voxels along the curve are always neighbors.
+        ordered_voxels = voxels[np.argsort(keys)]
+        assert_array_equal(np.sum(np.abs(np.diff(ordered_voxels, axis=0)), axis=1), 1)
+
+
+def test_space_filling_curve_order():
+    rng = np.random.RandomState(1234)
+    coords = rng.uniform(-10, 10, size=(1000, 3)).astype(np.float32)
+
+    for curve in ["morton", "hilbert"]:
+        indices = get_space_filling_curve_order(coords, curve=curve)
+        assert_array_equal(np.sort(indices), np.arange(len(coords)))
+
+        # Seeds ordered along the curve should be much closer to each other.
+        ordered_dist = np.mean(np.sqrt(np.sum(np.diff(coords[indices], axis=0)**2, axis=1)))
+        original_dist = np.mean(np.sqrt(np.sum(np.diff(coords, axis=0)**2, axis=1)))
+        assert ordered_dist < original_dist / 2
+
+    assert len(get_space_filling_curve_order(np.zeros((0, 3)))) == 0
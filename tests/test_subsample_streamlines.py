@@ -0,0 +1,42 @@
+import os
+import sys
+
+# Hack so you don't have to put the library containing this script in the PYTHONPATH.
+sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
+
+import numpy as np
+from dipy.align.bundlemin import distance_matrix_mdf
+from dipy.tracking.streamline import set_number_of_points
+
+from learn2track.neurotools import remove_similar_streamlines
+
+
+def _make_bundle(nb_streamlines, rng):
+    streamlines = []
+    for _ in range(nb_streamlines):
+        t = np.linspace(0, 1, rng.randint(15, 60))[:, None]
+        streamline = np.c_[40 * t, 10 * np.sin(3 * t), 5 * t ** 2] + rng.randn(1, 3) * [1, 3, 3] + rng.randn(1, 3) * 2 * t
+        streamline = streamline.astype(np.float32)
+        streamlines.append(streamline[::-1] if rng.rand() < 0.5 else streamline)  # Random orientation.
+
+    return streamlines
+
+
+def test_remove_similar_streamlines():
+    rng = np.random.RandomState(1234)
+    streamlines = _make_bundle(500, rng)
+
+    for removal_distance in [0.5, 2., 5.]:
+        # Reference: greedy removal using the whole distance matrix.
+        points = set_number_of_points(streamlines, 10)
+        distance_matrix = distance_matrix_mdf(points, points)
+        removed = np.zeros(len(streamlines), dtype=bool)
+        for i in range(len(streamlines)):
+            if not removed[i]:
+                removed[i + 1:] |= distance_matrix[i, i + 1:] < removal_distance
+
+        expected = [streamlines[i] for i in np.flatnonzero(~removed)]
+        for chunk_size in [1, 64, 1000]:
+            kept = remove_similar_streamlines(streamlines, removal_distance, chunk_size=chunk_size)
+            assert len(kept) == len(expected)
+            assert all(s1 is s2 for s1, s2 in zip(kept, expected))
@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import tempfile
+from types import SimpleNamespace
+
+# Hack so you don't have to put the library containing this script in the PYTHONPATH.
+sys.path = [os.path.abspath(os.path.join(__file__, '..', '..'))] + sys.path
+
+import numpy as np
+import theano
+from numpy.testing import assert_equal, assert_array_equal, assert_raises
+
+from scripts import track
+from scripts.track import make_is_outside_mask, make_is_too_long, make_is_too_curvy, make_is_stopping, STOPPING_MASK, STOPPING_LENGTH, \
+    STOPPING_CURVATURE, batch_track
+
+from learn2track import neurotools, factories
+from learn2track.utils import Timer
+from tests.utils import make_dummy_dwi
+
+
+class Killed(Exception):
+    pass
+
+
+def _make_tracking_job():
+    with Timer("Creating dummy volume", newline=True):
+        volume_manager = neurotools.VolumeManager()
+        dwi, gradients = make_dummy_dwi(nb_gradients=30, volume_shape=(10, 10, 10), seed=1234)
+        volume = neurotools.resample_dwi(dwi, gradients.bvals, gradients.bvecs).astype(np.float32)
+        volume_manager.register(volume)
+
+    with Timer("Creating model"):
+        hyperparams = {'model': 'gru_regression',
+                       'SGD': "1e-2",
+                       'hidden_sizes': 50,
+                       'learn_to_stop': False,
+                       'normalize': False,
+                       'activation': 'tanh',
+                       'feed_previous_direction': False,
+                       'predict_offset': False,
+                       'use_layer_normalization': False,
+                       'drop_prob': 0.,
+                       'use_zoneout': False,
+                       'skip_connections': False,
+                       'neighborhood_radius': None,
+                       'seed': 1234}
+        model = factories.model_factory(hyperparams,
+                                        input_size=volume_manager.data_dimension,
+                                        output_size=3,
+                                        volume_manager=volume_manager)
+        model.initialize(factories.weigths_initializer_factory("orthogonal", seed=1234))
+
+    rng = np.random.RandomState(1234)
+    mask = np.ones(volume.shape[:3])
+    seeds = np.array(np.where(mask)).T + rng.uniform(-0.5, 0.5, size=(int(mask.sum()), 3))
+    seeds = seeds.astype(theano.config.floatX)
+
+    is_stopping = make_is_stopping({STOPPING_MASK: make_is_outside_mask(mask, np.eye(4), threshold=0.5),
+                                    STOPPING_LENGTH: make_is_too_long(150),
+                                    STOPPING_CURVATURE: make_is_too_curvy(30)})
+    is_stopping.max_nb_points = 150
+
+    args = SimpleNamespace(track_like_peter=False, pft_nb_retry=0, pft_nb_backtrack_steps=0, use_max_component=False,
+                           flip_x=False, flip_y=False, flip_z=False, verbose=False)
+
+    return model, volume, seeds, is_stopping, args
+
+
+def test_resume_from_checkpoint():
+    model, volume, seeds, is_stopping, args = _make_tracking_job()
+    batch_size = 200  # I.e. 5 chunks of seeds.
+    expected = batch_track(model, volume, seeds, step_size=0.5, is_stopping=is_stopping, batch_size=batch_size, args=args)
+
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        # Kill the job once 2 chunks have been saved.
+        add_chunk = track.TrackingCheckpoint.add_chunk
+        nb_chunks = []
+
+        def _add_chunk_then_die(self, *chunk_args, **chunk_kwargs):
+            add_chunk(self, *chunk_args, **chunk_kwargs)
+            nb_chunks.append(1)
+            if len(nb_chunks) == 2:
+                raise Killed()
+
+        track.TrackingCheckpoint.add_chunk = _add_chunk_then_die
+        try:
+            assert_raises(Killed, batch_track, model, volume, seeds, step_size=0.5, is_stopping=is_stopping, batch_size=batch_size,
+                          args=args, checkpoint_dir=checkpoint_dir)
+        finally:
+            track.TrackingCheckpoint.add_chunk = add_chunk
+
+        with open(os.path.join(checkpoint_dir, track.TrackingCheckpoint.MANIFEST)) as f:
+            assert_equal(len(json.load(f)['chunks']), 2)
+
+        # Resuming with other tracking parameters isn't allowed, chunks of seeds included.
+        assert_raises(ValueError, batch_track, model, volume, seeds, step_size=0.25, is_stopping=is_stopping, batch_size=batch_size,
+                      args=args, checkpoint_dir=checkpoint_dir)
+        assert_raises(ValueError, batch_track, model, volume, seeds, step_size=0.5, is_stopping=is_stopping, batch_size=batch_size // 2,
+                      args=args, checkpoint_dir=checkpoint_dir)
+
+        tractogram = batch_track(model, volume, seeds, step_size=0.5, is_stopping=is_stopping, batch_size=batch_size,
+                                 args=args, checkpoint_dir=checkpoint_dir)
+
+    assert_equal(len(tractogram), len(expected))
+    for streamline, expected_streamline in zip(tractogram.streamlines, expected.streamlines):
+        assert_array_equal(streamline, expected_streamline)
+
+    for k, v in expected.data_per_streamline.items():
+        assert_array_equal(tractogram.data_per_streamline[k], v)
+
+
+def test_merge_empty_checkpoint():
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        checkpoint = track.TrackingCheckpoint(checkpoint_dir, np.zeros((10, 3), dtype=np.float32))
+        assert_equal(len(checkpoint.merge()), 0)
+        assert_equal(len(checkpoint.merge(rejected=True)), 0)
+
+
+if __name__ == "__main__":
+    test_resume_from_checkpoint()
+    test_merge_empty_checkpoint()